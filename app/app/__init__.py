@@ -1,6 +1,6 @@
 import os
 import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
+from logging.handlers import RotatingFileHandler
 
 from flask import current_app, Flask, request
 from flask_babel import Babel
@@ -10,11 +10,12 @@ from flask_login import LoginManager
 from flask_mail import Mail
 from flask_migrate import Migrate
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 
+from app.replicas import RoutingSQLAlchemy
 from config import Config
 
-db = SQLAlchemy()
+# Reads may go to replicas, see app.replicas
+db = RoutingSQLAlchemy()
 migrate = Migrate()
 
 login = LoginManager()
@@ -31,6 +32,15 @@ def create_app(config_class = Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
+    # Spool uploaded files to disk instead of memory
+    from app.uploads import UploadRequest
+    app.request_class = UploadRequest
+
+    # Pool settings must be in the config before the engine is created
+    from app import database, replicas
+    database.init_app(app)
+    replicas.init_app(app)
+
     db.init_app(app)
     migrate.init_app(app, db)
     login.init_app(app)
@@ -39,6 +49,42 @@ def create_app(config_class = Config):
     moment.init_app(app)
     babel.init_app(app)
 
+    from app.passwords import passwords
+    passwords.init_app(app)
+
+    from app.ratelimit import limiter
+    limiter.init_app(app)
+
+    from app.jobs import jobs
+    jobs.init_app(app)
+
+    from app.timeline import timeline
+    timeline.init_app(app)
+
+    from app.last_seen import last_seen
+    last_seen.init_app(app)
+
+    from app.fragments import fragments
+    fragments.init_app(app)
+
+    from app.page_cache import page_cache
+    page_cache.init_app(app)
+
+    from app.avatars import avatars
+    avatars.init_app(app)
+
+    from app.user_cache import user_cache
+    user_cache.init_app(app)
+
+    from app.instrumentation import instrumentation
+    instrumentation.init_app(app)
+
+    from app.slow_queries import slow_queries
+    slow_queries.init_app(app)
+
+    from app import profiler
+    profiler.init_app(app)
+
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
 
@@ -49,6 +95,10 @@ def create_app(config_class = Config):
     app.register_blueprint(main_bp)
 
     if not app.debug and not app.testing:
+        # The handlers run behind a queue, see app.log_handlers
+        from app.log_handlers import AsyncHandler, DigestSMTPHandler
+        handlers = []
+
         # Setup email notifications for errors
         if app.config['MAIL_SERVER']:
             auth = None
@@ -59,14 +109,16 @@ def create_app(config_class = Config):
             if app.config['MAIL_USE_TLS']:
                 secure = ()
 
-            mail_handler = SMTPHandler(
+            mail_handler = DigestSMTPHandler(
                 mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
                 fromaddr='no-reply@' + app.config['MAIL_SERVER'],
                 toaddrs=app.config['ADMINS'], subject='Microblog Failure',
-                credentials=auth, secure=secure)
+                credentials=auth, secure=secure,
+                interval=app.config['LOG_MAIL_DIGEST_INTERVAL'],
+                max_records=app.config['LOG_MAIL_DIGEST_MAX_RECORDS'])
             mail_handler.setLevel(logging.ERROR)
 
-            app.logger.addHandler(mail_handler)
+            handlers.append(mail_handler)
 
         # Setup file logging
         if not os.path.exists('logs'):
@@ -77,7 +129,9 @@ def create_app(config_class = Config):
         file_handler.setFormatter(logging.Formatter(
             '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
         file_handler.setLevel(logging.INFO)
-        app.logger.addHandler(file_handler)
+        handlers.append(file_handler)
+
+        app.logger.addHandler(AsyncHandler(handlers, app.config['LOG_QUEUE_SIZE']))
 
         app.logger.setLevel(logging.INFO)
         app.logger.info('Microblog startup')
@@ -9,8 +9,12 @@ from app.auth import bp
 from app.auth.email import send_password_reset_email
 from app.auth.forms import LoginForm, RegistrationForm, ResetPasswordForm, ResetPasswordRequestForm
 from app.models import User
+from app.ratelimit import form_field, limiter
+from app.user_cache import user_cache
 
 @bp.route("/login", methods = ["GET", "POST"])
+@limiter.limit("login-ip")
+@limiter.limit("login-account", key = form_field("username"))
 def login():
     if current_user.is_authenticated:
         return redirect(url_for("main.index"))
@@ -22,6 +26,11 @@ def login():
             flash(_T("Invalit username or password"))
             return redirect(url_for("auth.login"))
 
+        # The hashing parameters changed since the password was set
+        if user.password_needs_rehash():
+            user.set_password(form.password.data)
+            db.session.commit()
+
         # Login user in Flask-Login
         login_user(user, remember = form.remember_me.data)
 
@@ -41,6 +50,7 @@ def logout():
     return redirect(url_for("main.index"))
 
 @bp.route("/register", methods = ["GET", "POST"])
+@limiter.limit("register-ip")
 def register():
     if current_user.is_authenticated:
         return redirect(url_for("main.index"))
@@ -58,6 +68,8 @@ def register():
     return render_template("auth/register.html", form = form)
 
 @bp.route("/reset_password_request", methods = ["GET", "POST"])
+@limiter.limit("reset-password-ip")
+@limiter.limit("reset-password-account", key = form_field("email"))
 def reset_password_request():
     if current_user.is_authenticated:
         return redirect(url_for("main.index"))
@@ -87,6 +99,7 @@ def reset_password(token):
     if form.validate_on_submit():
         user.set_password(form.password.data)
         db.session.commit()
+        user_cache.invalidate(user)
         flash(_T("Your password has been reset."))
         return redirect(url_for("auth.login"))
 
@@ -0,0 +1,159 @@
+import os
+import re
+from tempfile import NamedTemporaryFile
+from time import time
+from urllib.request import urlopen
+
+from flask import abort, current_app, send_file
+
+from app.derivatives import prune
+from app.jobs import jobs
+
+"""
+Self-hosted avatar cache.
+
+User.avatar() points at /avatar/<user id>/<digest>/<size> instead of
+gravatar.com, so pages never wait on a third party. The first request for a
+digest and size goes through the configured fetcher, the result is kept in
+AVATAR_DIR and every later request is a static file with long-lived caching
+headers. A new email is a new digest, hence a new URL. Only the current
+digest of an existing user in one of AVATAR_SIZES is fetched, and the
+directory is bounded to AVATAR_MAX_BYTES by a periodic job that evicts the
+least recently accessed files.
+
+If the fetcher fails (e.g. the server is offline) a locally generated
+identicon is served instead and the fetch is retried after AVATAR_RETRY
+seconds.
+"""
+
+CONTENT_TYPES = {
+    "image/png": "png",
+    "image/jpeg": "jpg",
+    "image/gif": "gif",
+    "image/svg+xml": "svg",
+}
+
+DIGEST = re.compile(r"^[0-9a-f]{32}$")
+
+class GravatarFetcher(object):
+    URL = "https://www.gravatar.com/avatar/{}?d=identicon&s={}"
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+
+    def fetch(self, digest, size):
+        """
+        Returns (content type, bytes), raises if the avatar can't be fetched.
+        """
+        with urlopen(self.URL.format(digest, size), timeout = self.timeout) as response:
+            content_type = response.headers.get_content_type()
+            # No SVG from a third party, it could carry scripts
+            if content_type not in CONTENT_TYPES or content_type == "image/svg+xml":
+                raise ValueError("Unexpected avatar type {}".format(content_type))
+            return content_type, response.read()
+
+class IdenticonFetcher(object):
+    """
+    Symmetric 5x5 pattern coloured by the digest, like Gravatar's identicons.
+    Never leaves the server.
+    """
+    def fetch(self, digest, size):
+        value = int(digest, 16)
+        color = "#" + digest[-6:]
+        cell = size / 5.0
+        rects = []
+        for column in range(3):
+            for row in range(5):
+                if value >> (column * 5 + row) & 1:
+                    for x in {column, 4 - column}:
+                        rects.append('<rect x="{:g}" y="{:g}" width="{:g}" height="{:g}"/>'.format(
+                            x * cell, row * cell, cell, cell))
+        svg = ('<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{0}" '
+               'viewBox="0 0 {0} {0}"><rect width="{0}" height="{0}" fill="#f0f0f0"/>'
+               '<g fill="{1}">{2}</g></svg>').format(size, color, "".join(rects))
+        return "image/svg+xml", svg.encode("utf-8")
+
+def make_fetcher(app):
+    name = app.config["AVATAR_FETCHER"]
+    if name == "gravatar":
+        return GravatarFetcher(app.config["AVATAR_FETCH_TIMEOUT"])
+    if name == "identicon":
+        return IdenticonFetcher()
+    raise ValueError("Unknown avatar fetcher: {}".format(name))
+
+class Avatars(object):
+    def __init__(self, app = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["avatars"] = make_fetcher(app)
+
+    @property
+    def fetcher(self):
+        return current_app.extensions["avatars"]
+
+    def _lookup(self, directory, size):
+        """
+        Path of the cached avatar and whether it is a fallback, or (None, None).
+        """
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return None, None
+        prefix = "{}.".format(size)
+        for name in names:
+            if name.startswith(prefix):
+                return os.path.join(directory, name), ".fallback." in name
+        return None, None
+
+    def _store(self, directory, name, data):
+        os.makedirs(directory, exist_ok = True)
+        with NamedTemporaryFile(dir = directory, prefix = ".tmp", delete = False) as f:
+            f.write(data)
+        os.replace(f.name, os.path.join(directory, name))
+        return os.path.join(directory, name)
+
+    def path(self, digest, size):
+        """
+        Path of the avatar on disk, fetching it if it isn't cached yet.
+        """
+        config = current_app.config
+        directory = os.path.join(config["AVATAR_DIR"], digest[:2], digest)
+        path, fallback = self._lookup(directory, size)
+        if path is not None:
+            if not fallback or os.path.getmtime(path) > time() - config["AVATAR_RETRY"]:
+                return path
+
+        try:
+            content_type, data = self.fetcher.fetch(digest, size)
+        except Exception as e:
+            current_app.logger.warning("Avatar %s could not be fetched: %s", digest, e)
+            content_type, data = IdenticonFetcher().fetch(digest, size)
+            name = "{}.fallback.svg".format(size)
+        else:
+            name = "{}.{}".format(size, CONTENT_TYPES[content_type])
+        if path is not None and not path.endswith(name):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another worker replaced it first
+                pass
+        return self._store(directory, name, data)
+
+    def serve(self, digest, size):
+        config = current_app.config
+        if not DIGEST.match(digest) or size not in config["AVATAR_SIZES"]:
+            abort(404)
+        path = self.path(digest, size)
+        # Browsers shouldn't keep a fallback longer than it is kept here
+        max_age = config["AVATAR_RETRY"] if ".fallback." in path else config["AVATAR_MAX_AGE"]
+        response = send_file(path, conditional = True, cache_timeout = max_age)
+        response.cache_control.public = True
+        return response
+
+avatars = Avatars()
+
+@jobs.task("prune_avatars", every = "AVATAR_PRUNE_INTERVAL")
+def prune_avatars(payload):
+    prune(current_app.config["AVATAR_DIR"], current_app.config["AVATAR_MAX_BYTES"])
@@ -0,0 +1,327 @@
+import csv
+import io
+import json
+import os
+import random
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate, islice
+from tempfile import NamedTemporaryFile
+from time import perf_counter
+
+from sqlalchemy.dialects import postgresql, sqlite
+
+from app import db
+from app.models import Post, TimelineEntry, User, followers
+from app.passwords import passwords
+from app.replicas import primary
+from app.search import search
+from app.timeline import timeline
+
+"""
+Bulk loading of users, posts and follows, for `flask data import` and
+`flask data seed`.
+
+Records are read as a stream, JSON lines or CSV with a header row, and
+inserted in batches with one executemany per batch, or COPY for the posts on
+PostgreSQL. The fields are the columns of the models, with usernames in
+place of ids:
+
+    users:   username, email, password or password_hash, about_me, last_seen
+    posts:   username, body, timestamp
+    follows: follower, followed
+
+Each batch is committed on its own and the number of records done is then
+saved next to the input file, in <file>.progress. After a failure, --resume
+skips the records of the committed batches. Users and follows that already
+exist are skipped, posts have no natural key: a crash between a commit and
+the save of the progress file inserts that batch twice on resume.
+
+The ORM events that keep the counters, the search index and the timelines
+in sync don't fire for bulk inserts. Each batch of posts is added to the
+search index in its own transaction, the Loader remembers the users whose
+counters and timelines changed and finish() recomputes those once the
+loading is over, or failed. With defer_indexes the secondary indexes of the
+big tables are dropped during the load and created again by finish(). A run
+killed before finish() leaves its users behind, finish(full = True)
+recomputes everything.
+"""
+
+KINDS = ("users", "follows", "posts")
+
+# Tables whose secondary indexes may be created after the load
+DEFERRABLE = (Post.__table__, followers, TimelineEntry.__table__)
+
+def read_records(path):
+    """
+    The records of a JSON lines or, for a .csv file, CSV file.
+    """
+    with open(path, newline = "", encoding = "utf-8") as f:
+        if path.endswith(".csv"):
+            for record in csv.DictReader(f):
+                yield record
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+def batches(records, size):
+    records = iter(records)
+    while True:
+        batch = list(islice(records, size))
+        if not batch:
+            return
+        yield batch
+
+def parse_timestamp(value):
+    if not value:
+        return None
+    if not isinstance(value, datetime):
+        value = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    # Naive UTC, like the rest of the app, values with an offset are converted
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo = None)
+    return value
+
+class Progress(object):
+    """
+    Number of records of an input that are in the database, in a file.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            return json.load(f)["records"]
+
+    def save(self, records):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        with NamedTemporaryFile("w", dir = directory, delete = False) as f:
+            json.dump({ "records": records }, f)
+        os.replace(f.name, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def user_ids(connection, usernames):
+    usernames = set(name for name in usernames if name)
+    if not usernames:
+        return {}
+    table = User.__table__
+    rows = connection.execute(db.select([table.c.username, table.c.id])
+                                .where(table.c.username.in_(usernames)))
+    return dict((username, id) for username, id in rows)
+
+def insert(connection, table, rows, skip_existing = False):
+    """
+    One executemany of `rows`, leaving out those that would break a
+    unique constraint when `skip_existing`.
+    """
+    if not rows:
+        return
+    statement = table.insert()
+    if skip_existing and connection.dialect.name == "postgresql":
+        statement = postgresql.insert(table).on_conflict_do_nothing()
+    elif skip_existing and connection.dialect.name == "sqlite":
+        statement = sqlite.insert(table).on_conflict_do_nothing()
+    connection.execute(statement, rows)
+
+def copy_value(value):
+    # Quoted, so that only a missing value reads as NULL
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return '"{}"'.format(str(value).replace('"', '""'))
+
+def copy(connection, table, rows):
+    """
+    COPY `rows` into `table`, PostgreSQL only.
+    """
+    if not rows:
+        return
+    columns = list(rows[0])
+    data = io.StringIO()
+    for row in rows:
+        data.write(",".join(copy_value(row[column]) for column in columns) + "\n")
+    data.seek(0)
+    cursor = connection.connection.cursor()
+    try:
+        cursor.copy_expert('COPY "{}" ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            table.name, ", ".join(columns)), data)
+    finally:
+        cursor.close()
+
+class Loader(object):
+    def __init__(self, batch_size = 1000, hash_processes = None, use_copy = True):
+        self.batch_size = batch_size
+        self.hash_processes = hash_processes
+        self.use_copy = use_copy
+        self.pool = None
+        # Users whose counters changed, whose timelines changed, who posted
+        self.counted = set()
+        self.readers = set()
+        self.authors = set()
+
+    def _users(self, connection, records):
+        plain = [record for record in records
+                 if record.get("password") and not record.get("password_hash")]
+        if plain:
+            if self.pool is None and self.hash_processes != 1:
+                self.pool = ProcessPoolExecutor(max_workers = self.hash_processes)
+            hashes = passwords.hash_many([record["password"] for record in plain], self.pool)
+            for record, pwhash in zip(plain, hashes):
+                record["password_hash"] = pwhash
+
+        rows = [{
+            "username": record["username"],
+            "email": record["email"],
+            "password_hash": record.get("password_hash") or None,
+            "about_me": record.get("about_me") or None,
+            "last_seen": parse_timestamp(record.get("last_seen")) or datetime.utcnow(),
+        } for record in records if record.get("username") and record.get("email")]
+        insert(connection, User.__table__, rows, skip_existing = True)
+        return len(records) - len(rows)
+
+    def _follows(self, connection, records):
+        ids = user_ids(connection, [record.get(field) for record in records
+                                    for field in ("follower", "followed")])
+        rows = dict(((ids[record["follower"]], ids[record["followed"]]), None)
+                    for record in records
+                    if record.get("follower") in ids and record.get("followed") in ids
+                    and record["follower"] != record["followed"])
+        insert(connection, followers, [
+            { "follower_id": follower_id, "followed_id": followed_id }
+            for follower_id, followed_id in rows], skip_existing = True)
+        for follower_id, followed_id in rows:
+            self.counted.update((follower_id, followed_id))
+            self.readers.add(follower_id)
+        return len(records) - len(rows)
+
+    def _posts(self, connection, records):
+        ids = user_ids(connection, [record.get("username") for record in records])
+        rows = [{
+            "body": record.get("body"),
+            "timestamp": parse_timestamp(record.get("timestamp")) or datetime.utcnow(),
+            "user_id": ids[record["username"]],
+        } for record in records if record.get("username") in ids]
+        last_id = connection.execute(db.select([db.func.max(Post.id)])).scalar() or 0
+        if self.use_copy and connection.dialect.name == "postgresql":
+            copy(connection, Post.__table__, rows)
+        else:
+            insert(connection, Post.__table__, rows)
+        search.add_after(connection, last_id)
+        self.authors.update(row["user_id"] for row in rows)
+        return len(records) - len(rows)
+
+    def load(self, kind, records, progress = None, resume = False):
+        """
+        Insert the records, a batch at a time. Yields the number of
+        records done, skipped (invalid, unknown users) and per second.
+        """
+        insert_batch = { "users": self._users, "follows": self._follows, "posts": self._posts }[kind]
+        done = progress.load() if progress is not None and resume else 0
+        records = islice(records, done, None)
+        skipped = 0
+        start = perf_counter()
+        loaded = 0
+        for batch in batches(records, self.batch_size):
+            with db.engine.begin() as connection:
+                skipped += insert_batch(connection, batch)
+            done += len(batch)
+            loaded += len(batch)
+            if progress is not None:
+                progress.save(done)
+            yield done, skipped, loaded / max(perf_counter() - start, 1e-6)
+        if progress is not None:
+            progress.clear()
+
+    def timeline_owners(self, chunk_size = 500):
+        """
+        Users whose timeline has new entries: the new followers, the authors
+        and their followers.
+        """
+        owners = self.readers | self.authors
+        authors = sorted(self.authors)
+        with primary(db.session):
+            for i in range(0, len(authors), chunk_size):
+                rows = db.session.query(followers.c.follower_id)\
+                                 .filter(followers.c.followed_id.in_(authors[i:i + chunk_size]))
+                owners.update(follower_id for (follower_id,) in rows)
+        return owners
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+def secondary_indexes():
+    return [index for table in DEFERRABLE for index in table.indexes if not index.unique]
+
+def drop_indexes():
+    with db.engine.begin() as connection:
+        for index in secondary_indexes():
+            index.drop(bind = connection, checkfirst = True)
+
+def create_indexes():
+    with db.engine.begin() as connection:
+        for index in secondary_indexes():
+            index.create(bind = connection, checkfirst = True)
+
+def finish(loader, full = False):
+    """
+    Bring back what the bulk inserts skipped: the deferred indexes, then the
+    counters and timelines of the users `loader` touched, or of everyone and
+    the whole search index when `full`.
+    """
+    create_indexes()
+    # The batches were just committed, a lagging replica may not have them
+    with primary(db.session):
+        if full:
+            User.reconcile_counters()
+            timeline.rebuild_all()
+            db.session.commit()
+            search.reindex()
+            return
+        User.reconcile_counters(loader.counted | loader.authors)
+        timeline.rebuild_all(loader.timeline_owners())
+        db.session.commit()
+
+def seed_records(users, posts, follows, password, seed = None):
+    """
+    Generated records: `users` users, following on average about `follows`
+    others, picked by popularity so a few have most followers, and `posts`
+    posts mostly by the popular users over the last 30 days.
+    """
+    rng = random.Random(seed)
+    # One hash for everyone, hashing thousands of passwords would take minutes
+    pwhash = passwords.hash(password)
+    usernames = ["user{}".format(i) for i in range(users)]
+    popularity = list(accumulate(1.0 / (rank + 1) ** 1.1 for rank in range(users)))
+
+    def user_records():
+        for username in usernames:
+            yield { "username": username, "email": username + "@example.com",
+                    "password_hash": pwhash }
+
+    def follow_records():
+        for username in usernames:
+            # Pareto out-degree, mean of 3 times its scale with alpha = 1.5
+            degree = min(users - 1, int(rng.paretovariate(1.5) * follows / 3.0))
+            # Sorted, the order of a set of strings changes with PYTHONHASHSEED
+            # and --resume counts on the same records in the same order
+            for followed in sorted(set(rng.choices(usernames, cum_weights = popularity, k = degree))):
+                yield { "follower": username, "followed": followed }
+
+    def post_records():
+        start = datetime.utcnow() - timedelta(days = 30)
+        step = timedelta(days = 30) / max(posts, 1)
+        for i in range(posts):
+            username = rng.choices(usernames, cum_weights = popularity)[0]
+            yield { "username": username, "body": "Post {} by {}".format(i, username),
+                    "timestamp": start + i * step }
+
+    return { "users": user_records(), "follows": follow_records(), "posts": post_records() }
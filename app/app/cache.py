@@ -0,0 +1,262 @@
+import os
+import pickle
+from collections import OrderedDict
+from hashlib import sha1
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+"""
+Key/value cache backends shared by the caching layers of the app.
+
+All of them store picklable values with a time to live in seconds
+(None means the backend default, 0 means no expiry):
+    * MemoryCache - per-process LRU, lost on restart and not shared by workers
+    * FileSystemCache - one file per key, shared by the workers of a host
+    * UwsgiCache - a cache of uwsgi.ini, in memory shared by the workers of an instance
+    * RedisCache - any server speaking the Redis protocol, shared by all hosts
+    * NullCache - caches nothing
+"""
+
+class NullCache(object):
+    def get(self, key):
+        return None
+
+    def get_many(self, keys):
+        return {}
+
+    def set(self, key, value, ttl = None):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def clear(self):
+        pass
+
+class MemoryCache(object):
+    def __init__(self, max_entries = 1024, default_ttl = 300):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.lock = Lock()
+        # key -> (expires, value), least recently used first
+        self.entries = OrderedDict()
+
+    def _expires(self, ttl):
+        ttl = self.default_ttl if ttl is None else ttl
+        return time() + ttl if ttl else None
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires <= time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key, value, ttl = None):
+        with self.lock:
+            self.entries[key] = (self._expires(ttl), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last = False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class FileSystemCache(object):
+    # Check the size bound every that many writes, listing the directory isn't free
+    PRUNE_EVERY = 64
+
+    def __init__(self, directory, max_entries = 10000, default_ttl = 300):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self.writes = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, sha1(key.encode("utf-8")).hexdigest())
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                expires, value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if expires is not None and expires <= time():
+            self.delete(key)
+            return None
+        return value
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key, value, ttl = None):
+        ttl = self.default_ttl if ttl is None else ttl
+        expires = time() + ttl if ttl else None
+        # Write aside and rename, readers never see a partial file
+        with NamedTemporaryFile(dir = self.directory, prefix = ".tmp", delete = False) as f:
+            pickle.dump((expires, value), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, self._path(key))
+
+        self.writes += 1
+        if self.writes % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self):
+        names = [name for name in os.listdir(self.directory) if not name.startswith(".")]
+        if len(names) <= self.max_entries:
+            return
+        paths = [os.path.join(self.directory, name) for name in names]
+        paths.sort(key = lambda path: os.path.getmtime(path) if os.path.exists(path) else 0)
+        # Make some room so we don't prune again on the next write
+        for path in paths[:len(paths) - int(self.max_entries * 0.8)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+class RedisCache(object):
+    def __init__(self, url, default_ttl = 300, prefix = "cache:"):
+        if redis is None:
+            raise RuntimeError("The redis cache backend requires the redis package")
+        self.client = redis.Redis.from_url(url)
+        self.default_ttl = default_ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def get_many(self, keys):
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = self.client.mget([self.prefix + key for key in keys])
+        return dict((key, pickle.loads(value)) for key, value in zip(keys, values)
+                    if value is not None)
+
+    def set(self, key, value, ttl = None):
+        ttl = self.default_ttl if ttl is None else ttl
+        self.client.set(self.prefix + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                        ex = ttl or None)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+class UwsgiCache(object):
+    """
+    Values larger than the blocks of the cache aren't stored, they're
+    simply missed on the next read.
+    """
+    def __init__(self, name, default_ttl = 300, prefix = ""):
+        if uwsgi is None:
+            raise RuntimeError("The uwsgi cache backend only runs under uWSGI")
+        self.name = name
+        self.default_ttl = default_ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = uwsgi.cache_get(self.prefix + key, self.name)
+        return pickle.loads(value) if value is not None else None
+
+    def get_many(self, keys):
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key, value, ttl = None):
+        ttl = self.default_ttl if ttl is None else ttl
+        # uWSGI expires are in seconds, 0 never expires
+        uwsgi.cache_update(self.prefix + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                           int(ttl), self.name)
+
+    def delete(self, key):
+        uwsgi.cache_del(self.prefix + key, self.name)
+
+    def clear(self):
+        uwsgi.cache_clear(self.name)
+
+def make_cache(app, name, shared = False):
+    """
+    Build the cache backend selected by CACHE_BACKEND, `name` separates the
+    keys (and the directories) of the different caching layers. A `shared`
+    layer relies on its invalidations reaching every worker and refuses the
+    memory backend under uWSGI with more than one process.
+    """
+    backend = app.config["CACHE_BACKEND"]
+    max_entries = app.config["CACHE_MAX_ENTRIES"]
+    default_ttl = app.config["CACHE_DEFAULT_TTL"]
+    if backend == "auto":
+        # Shared by the workers when running under uWSGI, this process otherwise
+        backend = "uwsgi" if uwsgi is not None else "memory"
+    if backend == "null":
+        return NullCache()
+    if backend == "memory":
+        if shared and uwsgi is not None and uwsgi.numproc > 1:
+            raise RuntimeError("The {} cache must be shared by the {} uWSGI workers, "
+                               "set CACHE_BACKEND to uwsgi, redis or filesystem".format(
+                                   name, uwsgi.numproc))
+        return MemoryCache(max_entries, default_ttl)
+    if backend == "filesystem":
+        return FileSystemCache(os.path.join(app.config["CACHE_DIR"], name),
+                               max_entries, default_ttl)
+    if backend == "uwsgi":
+        return UwsgiCache(app.config["CACHE_UWSGI_NAME"], default_ttl, prefix = name + ":")
+    if backend == "redis":
+        return RedisCache(app.config["REDIS_URL"], default_ttl, prefix = name + ":")
+    raise ValueError("Unknown cache backend: {}".format(backend))
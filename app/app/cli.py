@@ -1,6 +1,13 @@
+import json
 import os
 import click
 
+from app import bulk, db, export
+from app.jobs import jobs
+from app.models import User
+from app.passwords import benchmark as password_benchmark
+from app.search import search as post_search
+
 def register(app):
     @app.cli.group()
     def translate():
@@ -32,3 +39,137 @@ def register(app):
         """Compile all languages."""
         if os.system("pybabel compile -d app/translations"):
             raise RuntimeError("compile command failed")
+
+    @app.cli.group()
+    def counters():
+        """Denormalized counter commands."""
+        pass
+
+    @counters.command()
+    def reconcile():
+        """Recompute follower, followed and post counters."""
+        fixed = User.reconcile_counters()
+        db.session.commit()
+        click.echo("Reconciled counters of {} users".format(fixed))
+
+    @app.cli.group()
+    def search():
+        """Full-text search commands."""
+        pass
+
+    @search.command()
+    def reindex():
+        """Rebuild the search index of every post."""
+        post_search.reindex()
+        click.echo("Search index rebuilt")
+
+    @app.cli.group()
+    def passwords():
+        """Password hashing commands."""
+        pass
+
+    @passwords.command()
+    @click.option("--seconds", default=3.0, help="Duration of the measure.")
+    @click.option("--processes", type=int, help="Busy processes, one per core by default.")
+    @click.option("--method", help="Hashing method, PASSWORD_HASH_METHOD by default.")
+    def benchmark(seconds, processes, method):
+        """Measure logins (password verifications) per second per core."""
+        result = password_benchmark(method or app.config["PASSWORD_HASH_METHOD"],
+                                    app.config["PASSWORD_SALT_LENGTH"], seconds, processes)
+        click.echo(json.dumps(result, indent=2))
+
+    @app.cli.command()
+    @click.option("--concurrency", type=int, help="Number of worker threads.")
+    @click.option("--burst", is_flag=True, help="Exit once the queue is empty.")
+    def worker(concurrency, burst):
+        """Run background jobs."""
+        jobs.work(concurrency=concurrency, burst=burst)
+        click.echo("Jobs left: {}".format(jobs.store.counts()))
+
+    @app.cli.group()
+    def data():
+        """Bulk data commands."""
+        pass
+
+    def load(loader, kind, records, progress, resume):
+        for done, skipped, rate in loader.load(kind, records, progress, resume):
+            click.echo("{}: {} records done, {} skipped, {:.0f}/s".format(
+                kind, done, skipped, rate))
+
+    def finish(loader, full_rebuild):
+        # Also after a failure: the deferred indexes must come back and the
+        # batches already committed be counted
+        if full_rebuild:
+            click.echo("Rebuilding indexes, counters, timelines and the search index")
+        else:
+            click.echo("Rebuilding indexes, counters and timelines of the loaded users")
+        bulk.finish(loader, full_rebuild)
+
+    @data.command("import")
+    @click.option("--users", "users_file", type=click.Path(exists=True), help="Users to import.")
+    @click.option("--follows", "follows_file", type=click.Path(exists=True), help="Follows to import.")
+    @click.option("--posts", "posts_file", type=click.Path(exists=True), help="Posts to import.")
+    @click.option("--batch-size", default=1000, help="Records per INSERT and commit.")
+    @click.option("--resume", is_flag=True, help="Skip the records imported by a failed run.")
+    @click.option("--defer-indexes", is_flag=True,
+                  help="Drop the secondary indexes during the import.")
+    @click.option("--hash-processes", type=int,
+                  help="Processes hashing plain passwords, one per core by default.")
+    @click.option("--full-rebuild", is_flag=True,
+                  help="Recompute the counters, timelines and search index of everyone.")
+    def import_(users_file, follows_file, posts_file, batch_size, resume, defer_indexes,
+                hash_processes, full_rebuild):
+        """Import users, follows and posts from JSON lines or CSV files."""
+        files = { "users": users_file, "follows": follows_file, "posts": posts_file }
+        loader = bulk.Loader(batch_size, hash_processes)
+        if defer_indexes:
+            bulk.drop_indexes()
+        try:
+            for kind in bulk.KINDS:
+                if files[kind]:
+                    load(loader, kind, bulk.read_records(files[kind]),
+                         bulk.Progress(files[kind] + ".progress"), resume)
+        finally:
+            loader.close()
+            finish(loader, full_rebuild)
+
+    @data.command()
+    @click.option("--users", default=1000, help="Users to create.")
+    @click.option("--posts", default=10000, help="Posts to create.")
+    @click.option("--follows", default=20, help="Mean number of users each user follows.")
+    @click.option("--password", default="password", help="Password of every user.")
+    @click.option("--seed", type=int, help="Random seed, the same seed makes the same data.")
+    @click.option("--batch-size", default=1000, help="Records per INSERT and commit.")
+    @click.option("--resume", is_flag=True, help="Skip the records created by a failed run.")
+    @click.option("--defer-indexes", is_flag=True,
+                  help="Drop the secondary indexes while seeding.")
+    @click.option("--full-rebuild", is_flag=True,
+                  help="Recompute the counters, timelines and search index of everyone.")
+    def seed(users, posts, follows, password, seed, batch_size, resume, defer_indexes,
+             full_rebuild):
+        """Create fake users with a power-law follower graph and posts."""
+        if resume and seed is None:
+            raise click.UsageError("--resume needs the --seed of the failed run")
+        records = bulk.seed_records(users, posts, follows, password, seed)
+        loader = bulk.Loader(batch_size)
+        if defer_indexes:
+            bulk.drop_indexes()
+        try:
+            for kind in bulk.KINDS:
+                load(loader, kind, records[kind], bulk.Progress("seed-{}.progress".format(kind)),
+                     resume)
+        finally:
+            loader.close()
+            finish(loader, full_rebuild)
+
+    @data.command("export")
+    @click.option("--users", "users_file", type=click.Path(), help="File to write the users to.")
+    @click.option("--follows", "follows_file", type=click.Path(), help="File to write the follows to.")
+    @click.option("--posts", "posts_file", type=click.Path(), help="File to write the posts to.")
+    def export_(users_file, follows_file, posts_file):
+        """Export users, follows and posts as JSON lines, gzipped for .gz files."""
+        files = { "users": users_file, "follows": follows_file, "posts": posts_file }
+        for kind in bulk.KINDS:
+            if files[kind]:
+                count = export.write(kind, files[kind])
+                click.echo("{}: {} records written to {}".format(kind, count, files[kind]))
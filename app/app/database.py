@@ -0,0 +1,82 @@
+import os
+
+from sqlalchemy import event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, Pool
+
+from app import db
+
+try:
+    import uwsgidecorators
+except ImportError:
+    uwsgidecorators = None
+
+"""
+Engine and connection pool settings.
+
+The DATABASE_* settings of Config are turned into SQLALCHEMY_ENGINE_OPTIONS
+for server databases; SQLite keeps the pools Flask-SQLAlchemy picks for it.
+A pool should hold about as many connections as a uWSGI worker has threads.
+
+uWSGI loads the app in the master and forks the workers, a connection
+opened before the fork would be shared by every worker. Each worker drops
+the pools it inherited right after the fork, and as a second line of
+defence a connection is never checked out in another process than the one
+that opened it.
+
+With DATABASE_PGBOUNCER set the app connects through PgBouncer in
+transaction pooling mode: PgBouncer does the pooling, so SQLAlchemy keeps no
+connection, and no startup parameter is sent since PgBouncer refuses them.
+The statement timeout must then be set on the role instead, e.g.
+ALTER ROLE microblog SET statement_timeout = 30000.
+"""
+
+def engine_options(config):
+    """
+    create_engine() arguments for the configured database.
+    """
+    url = make_url(config["SQLALCHEMY_DATABASE_URI"])
+    if url.get_backend_name() == "sqlite":
+        return {}
+
+    if config["DATABASE_PGBOUNCER"]:
+        return { "poolclass": NullPool }
+
+    options = {
+        "pool_size": config["DATABASE_POOL_SIZE"],
+        "max_overflow": config["DATABASE_MAX_OVERFLOW"],
+        "pool_timeout": config["DATABASE_POOL_TIMEOUT"],
+        "pool_recycle": config["DATABASE_POOL_RECYCLE"],
+        "pool_pre_ping": config["DATABASE_POOL_PRE_PING"],
+    }
+    if url.get_backend_name() == "postgresql" and config["DATABASE_STATEMENT_TIMEOUT"]:
+        options["connect_args"] = {
+            "options": "-c statement_timeout={}".format(config["DATABASE_STATEMENT_TIMEOUT"])
+        }
+    return options
+
+def init_app(app):
+    # Explicit SQLALCHEMY_ENGINE_OPTIONS win over the DATABASE_* settings
+    options = engine_options(app.config)
+    options.update(app.config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = options
+
+    if uwsgidecorators is not None:
+        @uwsgidecorators.postfork
+        def dispose_inherited_pools():
+            with app.app_context():
+                # close = False, the connections still belong to the master
+                db.get_engine(app).dispose(close = False)
+
+@event.listens_for(Pool, "connect")
+def record_pid(dbapi_connection, connection_record):
+    connection_record.info["pid"] = os.getpid()
+
+@event.listens_for(Pool, "checkout")
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    if connection_record.info.get("pid", os.getpid()) != os.getpid():
+        # Forget it without closing it, the parent may still be using it
+        connection_record.dbapi_connection = connection_proxy.dbapi_connection = None
+        raise exc.DisconnectionError(
+            "Connection opened in process {} checked out in {}".format(
+                connection_record.info["pid"], os.getpid()))
@@ -0,0 +1,95 @@
+import os
+from tempfile import NamedTemporaryFile
+
+from flask import current_app, send_file
+
+from app.jobs import jobs
+from app.uploads import Image, extension, image_path
+
+"""
+Content-addressed cache of resized images.
+
+A derivative is addressed by the sha256 of the processed upload and the
+requested size: DERIVATIVES_DIR/<digest>/<size>.<ext>, also served at
+/media/d/<digest>/<size>.<ext>. The URL of a given content never changes,
+so responses are immutable. nginx serves existing files straight from the
+directory (see nginx/derivatives.conf) and only misses reach Flask, which
+generates the file and hands it back to nginx with X-Accel-Redirect, or
+streams it with send_file when running without nginx.
+
+The directory is bounded to DERIVATIVES_MAX_BYTES by a periodic job of
+`flask worker`, the least recently accessed files are evicted first.
+"""
+
+def derivative_path(digest, size, ext):
+    return os.path.join(current_app.config["DERIVATIVES_DIR"], digest, "{}.{}".format(size, ext))
+
+def generate(upload, size, path):
+    with Image.open(image_path(upload)) as image:
+        image.thumbnail((size, size))
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok = True)
+        # Write aside and rename, nginx never serves a partial file
+        with NamedTemporaryFile(dir = directory, prefix = ".tmp", suffix = os.path.splitext(path)[1],
+                                delete = False) as f:
+            image.save(f, format = image.format)
+    os.replace(f.name, path)
+
+def prune(directory, max_bytes):
+    """
+    Evict the least recently accessed files until the directory is back
+    under 80% of max_bytes. Returns the number of bytes freed.
+    """
+    files = []
+    total = 0
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+            total += stat.st_size
+    if total <= max_bytes:
+        return 0
+
+    freed = 0
+    files.sort()
+    for _, size, path in files:
+        if total - freed <= max_bytes * 0.8:
+            break
+        try:
+            os.remove(path)
+            freed += size
+        except OSError:
+            pass
+    return freed
+
+@jobs.task("prune_derivatives", every = "DERIVATIVES_PRUNE_INTERVAL")
+def prune_derivatives(payload):
+    # Walks the whole directory, never in a request
+    prune(current_app.config["DERIVATIVES_DIR"], current_app.config["DERIVATIVES_MAX_BYTES"])
+
+def serve(upload, size):
+    """
+    Response for a derivative, generating it on the first request.
+    """
+    config = current_app.config
+    ext = extension(upload.filename)
+    path = derivative_path(upload.digest, size, ext)
+    if not os.path.exists(path):
+        generate(upload, size, path)
+
+    accel_prefix = config["DERIVATIVES_ACCEL_REDIRECT"]
+    if accel_prefix:
+        response = current_app.response_class(mimetype = "image/" + ("jpeg" if ext == "jpg" else ext))
+        response.headers["X-Accel-Redirect"] = "{}/{}/{}.{}".format(
+            accel_prefix.rstrip("/"), upload.digest, size, ext)
+    else:
+        response = send_file(path, conditional = True)
+    # The URL changes with the content, the response never does
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    response.cache_control.immutable = True
+    return response
@@ -1,19 +1,19 @@
-from threading import Thread
-
-from flask import current_app
 from flask_mail import Message
 
 from app import mail
+from app.jobs import jobs
 
-def send_async_email(app, msg):
-    # App context is required so flask_mail can access config vars
-    with app.app_context():
-        mail.send(msg)
+@jobs.task("send_email", setup = mail.connect)
+def deliver_email(payload, connection):
+    # Runs in `flask worker`, every message of a batch reuses the same SMTP connection
+    msg = Message(payload["subject"], sender = payload["sender"],
+                  recipients = payload["recipients"])
+    msg.body = payload["text_body"]
+    msg.html = payload["html_body"]
+    connection.send(msg)
 
 def send_email(subject, sender, recipients, text_body, html_body):
-    msg = Message(subject, sender = sender, recipients = recipients)
-    msg.body = text_body
-    msg.html = html_body
-    # current_app is tied to the current thread.
-    # access the underlying app object when spwaning a new thread
-    Thread(target = send_async_email, args = (current_app._get_current_object(), msg)).start()
+    # Only enqueue, the request doesn't wait for the SMTP server
+    jobs.enqueue("send_email", { "subject": subject, "sender": sender,
+                                 "recipients": recipients, "text_body": text_body,
+                                 "html_body": html_body })
@@ -6,6 +6,13 @@ from app.errors import bp
 def not_found_error(error):
     return render_template('errors/404.html'), 404
 
+@bp.app_errorhandler(429)
+def too_many_requests_error(error):
+    headers = {}
+    if error.retry_after:
+        headers["Retry-After"] = str(error.retry_after)
+    return render_template('errors/429.html'), 429, headers
+
 @bp.app_errorhandler(500)
 def internal_error(error):
     # Ensure db integrity in case of an internal error
@@ -0,0 +1,75 @@
+from time import time
+
+from flask import current_app, Markup, render_template
+from flask_babel import get_locale
+
+from app.cache import make_cache
+
+"""
+Fragment cache for rendered posts.
+
+A post never changes after it's created and its relative time is computed
+client side by moment.js, so the HTML of sub_post.html only depends on the
+post, the locale and the author's profile. Keys carry a per-author version
+which invalidate_author() bumps, e.g. when the username changes, along with
+a site wide one for pages that show posts of any author, e.g. explore.
+"""
+
+class FragmentCache(object):
+    def __init__(self, app = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["fragments"] = make_cache(app, "fragments", shared = True)
+        app.add_template_global(self.render_posts, "render_posts")
+
+    @property
+    def cache(self):
+        return current_app.extensions["fragments"]
+
+    def _version_key(self, user_id):
+        return "author-version:{}".format(user_id)
+
+    def invalidate_author(self, user):
+        """
+        Drop the cached posts of an author, in every locale.
+        """
+        # No expiry, the version must outlive the fragments it guards
+        version = repr(time())
+        self.cache.set(self._version_key(user.id), version, ttl = 0)
+        self.cache.set(self._version_key("*"), version, ttl = 0)
+
+    def authors_version(self):
+        """
+        Time any author was last invalidated, as a float, 0 if never.
+        """
+        return float(self.cache.get(self._version_key("*")) or 0)
+
+    def render_posts(self, posts):
+        """
+        Render sub_post.html for every post, reusing cached fragments.
+        Costs two cache round trips per page, whatever its size.
+        """
+        cache = self.cache
+        locale = str(get_locale())
+        ttl = current_app.config["FRAGMENT_CACHE_TTL"]
+
+        author_ids = set(post.user_id for post in posts)
+        versions = cache.get_many([self._version_key(author_id) for author_id in author_ids])
+        keys = [
+            "post:{}:{}:{}".format(post.id, locale,
+                                   versions.get(self._version_key(post.user_id), "0"))
+            for post in posts]
+        fragments = cache.get_many(keys)
+
+        html = []
+        for post, key in zip(posts, keys):
+            fragment = fragments.get(key)
+            if fragment is None:
+                fragment = render_template("sub_post.html", post = post)
+                cache.set(key, fragment, ttl = ttl)
+            html.append(fragment)
+        return Markup("".join(html))
+
+fragments = FragmentCache()
@@ -0,0 +1,216 @@
+import hmac
+import heapq
+import json
+from bisect import bisect_left
+from threading import Lock
+from time import perf_counter
+
+from flask import before_render_template, current_app, g, has_request_context, request, \
+    request_finished, request_started, signals_available, template_rendered
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+"""
+Per-request instrumentation.
+
+With INSTRUMENTATION_ENABLED set every request records its wall time, the
+number and total time of its SQL statements, the time spent rendering
+templates and its slowest statements. They are sent back in a Server-Timing
+header (shown by the network tab of the browsers), logged as one JSON line
+on the "app.requests" logger, and added to a duration histogram per
+endpoint served as Prometheus text at /metrics.
+
+The cost is a few perf_counter() calls per statement and per template, and
+one lock per request for the histogram. The histogram is kept per process:
+each uWSGI worker exposes its own, Prometheus should scrape them one by one
+(e.g. one stats port per worker) or they only sample the traffic.
+"""
+
+class RequestMetrics(object):
+    __slots__ = ("start", "sql_count", "sql_time", "template_time", "template_depth",
+                 "template_start", "slowest", "keep")
+
+    def __init__(self, keep):
+        self.start = perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.template_start = None
+        # Min-heap of (duration, order, statement), the `keep` slowest
+        self.slowest = []
+        self.keep = keep
+
+    def record_statement(self, statement, duration):
+        self.sql_count += 1
+        self.sql_time += duration
+        if not self.keep:
+            return
+        item = (duration, self.sql_count, statement)
+        if len(self.slowest) < self.keep:
+            heapq.heappush(self.slowest, item)
+        elif duration > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def slowest_statements(self):
+        return [{ "ms": round(duration * 1000, 3), "sql": " ".join(statement.split())[:500] }
+                for duration, _, statement in sorted(self.slowest, reverse = True)]
+
+class EndpointHistograms(object):
+    """
+    Request durations per endpoint, with the totals of their SQL and
+    template times, in the Prometheus histogram layout.
+    """
+    def __init__(self, buckets):
+        self.buckets = sorted(buckets)
+        self.lock = Lock()
+        # endpoint -> [count per bucket (+Inf last), count, sum, queries, sql sum, template sum]
+        self.series = {}
+
+    def observe(self, endpoint, duration, metrics):
+        index = bisect_left(self.buckets, duration)
+        with self.lock:
+            series = self.series.get(endpoint)
+            if series is None:
+                series = self.series[endpoint] = [[0] * (len(self.buckets) + 1), 0, 0.0, 0, 0.0, 0.0]
+            series[0][index] += 1
+            series[1] += 1
+            series[2] += duration
+            series[3] += metrics.sql_count
+            series[4] += metrics.sql_time
+            series[5] += metrics.template_time
+
+    def render(self):
+        with self.lock:
+            series = dict((endpoint, [list(values[0])] + values[1:])
+                          for endpoint, values in self.series.items())
+
+        lines = [
+            "# HELP microblog_request_duration_seconds Wall time of the requests.",
+            "# TYPE microblog_request_duration_seconds histogram",
+        ]
+        bounds = [repr(float(bound)) for bound in self.buckets] + ["+Inf"]
+        for endpoint, (counts, count, total, _, _, _) in sorted(series.items()):
+            label = 'endpoint="{}"'.format(escape_label(endpoint))
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                lines.append('microblog_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                    label, bound, cumulative))
+            lines.append("microblog_request_duration_seconds_sum{{{}}} {!r}".format(label, total))
+            lines.append("microblog_request_duration_seconds_count{{{}}} {}".format(label, count))
+
+        for name, position, kind, help in (
+                ("microblog_request_sql_queries_total", 3, "counter", "SQL statements sent."),
+                ("microblog_request_sql_seconds_total", 4, "counter", "Time spent in SQL statements."),
+                ("microblog_request_template_seconds_total", 5, "counter", "Time spent rendering templates.")):
+            lines.append("# HELP {} {}".format(name, help))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for endpoint, values in sorted(series.items()):
+                lines.append('{}{{endpoint="{}"}} {!r}'.format(
+                    name, escape_label(endpoint), values[position]))
+        return "\n".join(lines) + "\n"
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def current_metrics():
+    return g.get("_metrics") if has_request_context() else None
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    if current_metrics() is not None:
+        conn.info.setdefault("_statement_start", []).append(perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    metrics = current_metrics()
+    starts = conn.info.get("_statement_start")
+    if metrics is not None and starts:
+        metrics.record_statement(statement, perf_counter() - starts.pop())
+
+class Instrumentation(object):
+    def __init__(self, app = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config["INSTRUMENTATION_ENABLED"]:
+            return
+        if not signals_available:
+            raise RuntimeError("Instrumentation requires the blinker package")
+        app.extensions["instrumentation"] = EndpointHistograms(app.config["INSTRUMENTATION_BUCKETS"])
+        request_started.connect(self._request_started, app)
+        request_finished.connect(self._request_finished, app)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._rendered, app)
+
+    @property
+    def enabled(self):
+        return "instrumentation" in current_app.extensions
+
+    @property
+    def histograms(self):
+        return current_app.extensions["instrumentation"]
+
+    def _request_started(self, sender, **extra):
+        g._metrics = RequestMetrics(sender.config["INSTRUMENTATION_SLOWEST"])
+
+    def _before_render(self, sender, template, context, **extra):
+        metrics = current_metrics()
+        if metrics is not None:
+            # Templates rendered by a template are part of its time
+            if metrics.template_depth == 0:
+                metrics.template_start = perf_counter()
+            metrics.template_depth += 1
+
+    def _rendered(self, sender, template, context, **extra):
+        metrics = current_metrics()
+        if metrics is not None and metrics.template_depth:
+            metrics.template_depth -= 1
+            if metrics.template_depth == 0:
+                metrics.template_time += perf_counter() - metrics.template_start
+
+    def _request_finished(self, sender, response, **extra):
+        metrics = g.pop("_metrics", None)
+        if metrics is None:
+            return
+        duration = perf_counter() - metrics.start
+        endpoint = request.endpoint or "unmatched"
+        self.histograms.observe(endpoint, duration, metrics)
+
+        if sender.config["INSTRUMENTATION_SERVER_TIMING"]:
+            response.headers.add("Server-Timing", ", ".join([
+                "app;dur={:.3f}".format(duration * 1000),
+                'db;dur={:.3f};desc="{} queries"'.format(metrics.sql_time * 1000, metrics.sql_count),
+                "tpl;dur={:.3f}".format(metrics.template_time * 1000),
+            ]))
+
+        if sender.config["INSTRUMENTATION_LOG"]:
+            sender.logger.getChild("requests").info(json.dumps({
+                "method": request.method,
+                "path": request.path,
+                "endpoint": endpoint,
+                "status": response.status_code,
+                "ms": round(duration * 1000, 3),
+                "sql_count": metrics.sql_count,
+                "sql_ms": round(metrics.sql_time * 1000, 3),
+                "template_ms": round(metrics.template_time * 1000, 3),
+                "slowest": metrics.slowest_statements(),
+            }))
+
+    def can_read_metrics(self):
+        """
+        True for a scraper with the METRICS_TOKEN bearer token and for
+        administrators, the users whose email is in ADMINS.
+        """
+        token = current_app.config["METRICS_TOKEN"]
+        authorization = request.headers.get("Authorization", "")
+        if token and hmac.compare_digest(authorization.encode("utf-8"),
+                                         "Bearer {}".format(token).encode("utf-8")):
+            return True
+        return current_user.is_authenticated and \
+            current_user.email in current_app.config["ADMINS"]
+
+instrumentation = Instrumentation()
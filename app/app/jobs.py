@@ -0,0 +1,274 @@
+import json
+import os
+import random
+import sqlite3
+from threading import Event, Lock, Thread
+from time import time
+
+from flask import current_app
+
+from app import db
+from app.replicas import primary
+
+"""
+Persistent background job queue.
+
+Web workers only enqueue: a job is a row in a local SQLite database, so it
+survives crashes and restarts. `flask worker` runs a bounded pool of threads
+that claim due jobs in batches of the same task, run them and delete them.
+A claimed job is leased for JOBS_LEASE seconds, if the worker dies the
+lease runs out and another worker picks the job up again. Failed jobs are
+retried with exponential backoff and kept as "failed" after
+JOBS_MAX_ATTEMPTS attempts.
+
+Tasks are registered with the `task` decorator. A task may declare a
+`setup` callable returning a context manager (e.g. an SMTP connection)
+that is entered once per batch and passed to every job of the batch.
+
+A task registered with `every`, the name of a config setting in seconds,
+is periodic: the worker keeps one job of it queued, due that many seconds
+after the previous one is done, whichever worker process ran it.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    task TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_at REAL NOT NULL,
+    locked_until REAL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_status_run_at ON jobs (status, run_at);
+"""
+
+class JobStore(object):
+    """
+    The queue of one app. A single connection per process, SQLite serializes
+    writers anyway and this keeps ":memory:" usable in tests.
+    """
+    def __init__(self, path, lease):
+        self.path = path
+        self.lease = lease
+        self.start_lock = Lock()
+        self.lock = None
+        self.connection = None
+        self.pid = None
+
+    def connect(self):
+        # Opened on first use: a connection (or a lock) inherited from the
+        # master by forked uWSGI workers must not be shared between them
+        if self.pid == os.getpid():
+            return self.connection
+        with self.start_lock:
+            if self.pid != os.getpid():
+                self.lock = Lock()
+                self.connection = sqlite3.connect(self.path, timeout = 30,
+                                                  check_same_thread = False,
+                                                  isolation_level = None)
+                if self.path != ":memory:":
+                    # Readers don't block the writer, web and worker processes share the file
+                    self.connection.execute("PRAGMA journal_mode=WAL")
+                self.connection.executescript(SCHEMA)
+                self.pid = os.getpid()
+        return self.connection
+
+    def enqueue(self, task, payload, delay = 0):
+        connection = self.connect()
+        with self.lock:
+            cursor = connection.execute(
+                "INSERT INTO jobs (task, payload, run_at) VALUES (?, ?, ?)",
+                (task, json.dumps(payload), time() + delay))
+            return cursor.lastrowid
+
+    def enqueue_unique(self, task, payload, delay = 0):
+        """
+        Enqueue unless a job of `task` is already queued (or running).
+        """
+        connection = self.connect()
+        with self.lock:
+            # One statement, atomic across the processes sharing the file
+            cursor = connection.execute(
+                "INSERT INTO jobs (task, payload, run_at) SELECT ?, ?, ? WHERE NOT EXISTS "
+                "(SELECT 1 FROM jobs WHERE task = ? AND status = 'queued')",
+                (task, json.dumps(payload), time() + delay, task))
+            return cursor.lastrowid if cursor.rowcount else None
+
+    def claim(self, limit):
+        """
+        Lease up to `limit` due jobs of the same task, oldest first.
+        Returns the task name and a list of (id, payload, attempts).
+        """
+        now = time()
+        connection = self.connect()
+        with self.lock:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                due = "status = 'queued' AND run_at <= ? AND (locked_until IS NULL OR locked_until <= ?)"
+                row = connection.execute(
+                    "SELECT task FROM jobs WHERE " + due + " ORDER BY id LIMIT 1",
+                    (now, now)).fetchone()
+                if row is None:
+                    connection.execute("COMMIT")
+                    return None, []
+                task = row[0]
+                jobs = connection.execute(
+                    "SELECT id, payload, attempts FROM jobs WHERE task = ? AND " + due +
+                    " ORDER BY id LIMIT ?", (task, now, now, limit)).fetchall()
+                connection.executemany(
+                    "UPDATE jobs SET locked_until = ? WHERE id = ?",
+                    [(now + self.lease, id) for id, _, _ in jobs])
+                connection.execute("COMMIT")
+            except Exception:
+                connection.execute("ROLLBACK")
+                raise
+        return task, [(id, json.loads(payload), attempts) for id, payload, attempts in jobs]
+
+    def complete(self, id):
+        connection = self.connect()
+        with self.lock:
+            connection.execute("DELETE FROM jobs WHERE id = ?", (id,))
+
+    def fail(self, id, attempts, error, retry_in):
+        connection = self.connect()
+        with self.lock:
+            if retry_in is None:
+                connection.execute(
+                    "UPDATE jobs SET status = 'failed', attempts = ?, last_error = ?, "
+                    "locked_until = NULL WHERE id = ?", (attempts, error, id))
+            else:
+                connection.execute(
+                    "UPDATE jobs SET attempts = ?, last_error = ?, run_at = ?, "
+                    "locked_until = NULL WHERE id = ?", (attempts, error, time() + retry_in, id))
+
+    def counts(self):
+        connection = self.connect()
+        with self.lock:
+            return dict(connection.execute(
+                "SELECT status, count(*) FROM jobs GROUP BY status").fetchall())
+
+class JobQueue(object):
+    def __init__(self, app = None):
+        self.tasks = {}
+        # Periodic task -> config setting of its interval
+        self.periodic = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["jobs"] = JobStore(app.config["JOBS_DATABASE"], app.config["JOBS_LEASE"])
+
+    @property
+    def store(self):
+        return current_app.extensions["jobs"]
+
+    def task(self, name, setup = None, every = None):
+        def decorator(f):
+            self.tasks[name] = (f, setup)
+            if every is not None:
+                self.periodic[name] = every
+            return f
+        return decorator
+
+    def enqueue(self, name, payload, delay = 0):
+        if name not in self.tasks:
+            raise ValueError("Unknown task: {}".format(name))
+        return self.store.enqueue(name, payload, delay)
+
+    def schedule(self):
+        """
+        Queue the next run of the periodic tasks that have none queued.
+        """
+        for name, setting in self.periodic.items():
+            self.store.enqueue_unique(name, {}, current_app.config[setting])
+
+    def backoff(self, attempts):
+        """
+        Seconds before the next attempt, None once the job should give up.
+        """
+        config = current_app.config
+        if attempts >= config["JOBS_MAX_ATTEMPTS"]:
+            return None
+        delay = min(config["JOBS_RETRY_BASE"] * 2 ** (attempts - 1), config["JOBS_RETRY_MAX"])
+        # Jitter, so a batch that failed together doesn't retry together
+        return delay * random.uniform(1, 1.1)
+
+    def run_batch(self):
+        """
+        Claim and run one batch, returns the number of jobs it held.
+        Must be called inside an app context.
+        """
+        store = self.store
+        name, batch = store.claim(current_app.config["JOBS_BATCH_SIZE"])
+        if not batch:
+            return 0
+
+        f, setup = self.tasks[name]
+        done = set()
+        try:
+            # Jobs act on rows a request just committed, a lagging replica
+            # may not have them yet
+            with primary(db.session):
+                if setup is None:
+                    self._run(store, f, batch, done)
+                else:
+                    with setup() as context:
+                        self._run(store, f, batch, done, context)
+        except Exception as e:
+            # The setup itself failed (e.g. SMTP server down), retry the jobs left
+            current_app.logger.exception("Job batch %s failed", name)
+            for id, _, attempts in batch:
+                if id not in done:
+                    store.fail(id, attempts + 1, repr(e), self.backoff(attempts + 1))
+        return len(batch)
+
+    def _run(self, store, f, batch, done, *context):
+        for id, payload, attempts in batch:
+            try:
+                f(payload, *context)
+            except Exception as e:
+                current_app.logger.exception("Job %s failed", id)
+                store.fail(id, attempts + 1, repr(e), self.backoff(attempts + 1))
+            else:
+                store.complete(id)
+            done.add(id)
+
+    def work(self, concurrency = None, burst = False):
+        """
+        Run jobs with a bounded pool of threads until interrupted, or until
+        the queue is empty when `burst` is set.
+        """
+        app = current_app._get_current_object()
+        concurrency = concurrency or app.config["JOBS_CONCURRENCY"]
+        stopped = Event()
+        if not burst:
+            self.schedule()
+
+        def loop():
+            while not stopped.is_set():
+                with app.app_context():
+                    ran = self.run_batch()
+                if not ran:
+                    if burst:
+                        return
+                    with app.app_context():
+                        self.schedule()
+                    stopped.wait(app.config["JOBS_POLL_INTERVAL"])
+
+        threads = [Thread(target = loop, name = "job-worker-{}".format(i), daemon = True)
+                   for i in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(0.5)
+        except KeyboardInterrupt:
+            # Let the running batches finish, unclaimed jobs stay queued
+            stopped.set()
+            for thread in threads:
+                thread.join()
+
+jobs = JobQueue()
@@ -0,0 +1,120 @@
+import atexit
+import os
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+
+from flask import current_app
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app import db
+from app.models import User
+
+"""
+Batched `last_seen` tracking.
+
+Requests only record activity in memory, at most once per
+LAST_SEEN_RESOLUTION seconds per user. A background thread in every worker
+writes the pending timestamps every LAST_SEEN_FLUSH_INTERVAL seconds with a
+single UPDATE ... CASE statement, instead of one commit per page view.
+"""
+
+class LastSeenTracker(object):
+    def __init__(self, app):
+        self.app = app
+        self.resolution = timedelta(seconds = app.config["LAST_SEEN_RESOLUTION"])
+        self.interval = app.config["LAST_SEEN_FLUSH_INTERVAL"]
+        self.lock = Lock()
+        # user id -> last_seen waiting to be written
+        self.pending = {}
+        # user id -> last time activity was recorded by this worker
+        self.recorded = {}
+        self.stopped = Event()
+        self.thread = None
+        self.pid = None
+
+    def touch(self, user_id, now = None):
+        now = now or datetime.utcnow()
+        with self.lock:
+            recorded = self.recorded.get(user_id)
+            if recorded is not None and now - recorded < self.resolution:
+                return
+            self.recorded[user_id] = now
+            self.pending[user_id] = now
+        self.ensure_flusher()
+
+    def get(self, user_id):
+        with self.lock:
+            return self.pending.get(user_id)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            # Forget users that went idle, they will be recorded on their next request
+            horizon = datetime.utcnow() - self.resolution
+            self.recorded = dict((user_id, seen) for user_id, seen in self.recorded.items()
+                                 if seen >= horizon)
+        if not pending:
+            return 0
+
+        table = User.__table__
+        statement = table.update().where(table.c.id.in_(list(pending)))\
+                         .values(last_seen = db.case(pending, value = table.c.id))
+        with db.get_engine(self.app).begin() as connection:
+            connection.execute(statement)
+        return len(pending)
+
+    def ensure_flusher(self):
+        # Threads don't survive uWSGI forking workers, start one per process
+        if self.interval <= 0 or (self.thread is not None and self.pid == os.getpid()):
+            return
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = Thread(target = self.run, name = "last-seen-flusher", daemon = True)
+            self.thread.start()
+        atexit.register(self.stop)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.safe_flush()
+
+    def safe_flush(self):
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("Failed to flush last seen timestamps")
+
+    def stop(self):
+        self.stopped.set()
+        self.safe_flush()
+
+class LastSeen(object):
+    def __init__(self, app = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["last_seen"] = LastSeenTracker(app)
+
+    @property
+    def tracker(self):
+        return current_app.extensions["last_seen"]
+
+    def touch(self, user):
+        self.tracker.touch(user.id)
+
+    def flush(self):
+        return self.tracker.flush()
+
+    def apply(self, user):
+        """
+        Show the not yet written last_seen of a user, without marking it dirty.
+        """
+        seen = self.tracker.get(user.id)
+        if seen is not None and (user.last_seen is None or seen > user.last_seen):
+            set_committed_value(user, "last_seen", seen)
+        return user
+
+last_seen = LastSeen()
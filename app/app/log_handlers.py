@@ -0,0 +1,157 @@
+import logging
+import os
+from logging.handlers import QueueHandler, QueueListener, SMTPHandler
+from queue import Full, Queue
+from threading import Lock, Timer
+from time import time
+
+"""
+Log handlers that never block a request.
+
+The file and mail handlers of the app run in a thread of their own behind
+AsyncHandler: a request only puts its records in a bounded queue, and they
+are dropped (and counted) when the queue is full rather than waiting for a
+slow disk or SMTP server. The queue is flushed when the process exits.
+
+DigestSMTPHandler mails the first error right away. The errors that follow
+within LOG_MAIL_DIGEST_INTERVAL seconds are held back and mailed together in
+one digest when the interval is over, at most LOG_MAIL_DIGEST_MAX_RECORDS of
+them, the others are only counted. An outage sends a mail every few minutes
+instead of one per failed request.
+"""
+
+class DigestSMTPHandler(SMTPHandler):
+    def __init__(self, *args, interval = 300, max_records = 50, **kwargs):
+        SMTPHandler.__init__(self, *args, **kwargs)
+        self.interval = interval
+        self.max_records = max_records
+        self.last_sent = None
+        # Records of the next digest, and how many more were left out of it
+        self.pending = []
+        self.dropped = 0
+        self.timer = None
+
+    def send(self, record):
+        SMTPHandler.emit(self, record)
+
+    def getSubject(self, record):
+        count = getattr(record, "digest_count", None)
+        if count is None:
+            return self.subject
+        return "{} ({} errors)".format(self.subject, count)
+
+    def emit(self, record):
+        # Called with the lock of the handler held
+        now = time()
+        if not self.pending and (self.last_sent is None or now - self.last_sent >= self.interval):
+            self.last_sent = now
+            self.send(record)
+            return
+
+        if len(self.pending) < self.max_records:
+            # Formatted now, the exception is gone once the record is handled
+            self.pending.append(self.format(record))
+        else:
+            self.dropped += 1
+        if self.timer is None:
+            self.timer = Timer(max(self.last_sent + self.interval - now, 0), self.send_digest)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def send_digest(self):
+        self.acquire()
+        try:
+            self.timer = None
+            if not self.pending:
+                return
+            messages, self.pending = self.pending, []
+            dropped, self.dropped = self.dropped, 0
+            self.last_sent = time()
+
+            count = len(messages) + dropped
+            header = "{} errors since the previous mail".format(count)
+            if dropped:
+                header += ", {} of them left out".format(dropped)
+            text = "\n\n".join([header] + messages)
+            self.send(logging.makeLogRecord({
+                "name": "digest", "levelno": logging.ERROR, "levelname": "ERROR",
+                # %-style arguments are already applied
+                "msg": text.replace("%", "%%"), "digest_count": count,
+            }))
+        finally:
+            self.release()
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+        self.send_digest()
+
+    def close(self):
+        self.flush()
+        SMTPHandler.close(self)
+
+class FlushingQueueListener(QueueListener):
+    def enqueue_sentinel(self):
+        # Waits for room in a full queue instead of failing, the thread is draining it
+        self.queue.put(self._sentinel)
+
+class AsyncHandler(QueueHandler):
+    """
+    Hands the records to `handlers` in a background thread, through a queue
+    of at most `max_size` records.
+    """
+    def __init__(self, handlers, max_size = 1000):
+        QueueHandler.__init__(self, None)
+        self.handlers = handlers
+        self.max_size = max_size
+        self.dropped = 0
+        self.start_lock = Lock()
+        self.listener = None
+        self.pid = None
+
+    def start(self):
+        # Threads (and the locks of the queue) don't survive uWSGI forking
+        # workers, every process gets its own queue and thread
+        if self.pid == os.getpid():
+            return
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = Queue(self.max_size)
+            self.listener = FlushingQueueListener(self.queue, *self.handlers,
+                                                  respect_handler_level = True)
+            self.listener.start()
+            self.pid = os.getpid()
+
+    def enqueue(self, record):
+        self.start()
+        try:
+            if self.dropped:
+                self.queue.put_nowait(logging.makeLogRecord({
+                    "name": record.name, "levelno": logging.WARNING, "levelname": "WARNING",
+                    "msg": "{} log records dropped, the log queue was full".format(self.dropped),
+                }))
+                self.dropped = 0
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+    def flush(self):
+        """
+        Wait until every queued record went through the handlers.
+        """
+        if self.pid == os.getpid():
+            self.listener.stop()
+            self.listener.start()
+        for handler in self.handlers:
+            handler.flush()
+
+    def close(self):
+        # Called by logging.shutdown() at exit, before the handlers it feeds
+        # are closed since it was created after them
+        if self.pid == os.getpid():
+            self.listener.stop()
+            self.pid = None
+        for handler in self.handlers:
+            handler.close()
+        QueueHandler.close(self)
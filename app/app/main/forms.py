@@ -41,6 +41,6 @@ class PostForm(FlaskForm):
     submit = SubmitField(_LT("Submit"))
 
 class UploadImagesForm(FlaskForm):
-    file = FileField(_LT("File"), validators = [FileRequired(), FileAllowed(["png"])])
+    file = FileField(_LT("File"), validators = [FileRequired(), FileAllowed(["png", "jpg", "jpeg"])])
     submit = SubmitField(_LT("Submit"))
 
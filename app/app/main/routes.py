@@ -1,15 +1,29 @@
 from datetime import datetime
 
 from app import db
+from app.avatars import avatars
+from app.derivatives import serve as serve_derivative
+from app.export import gzipped, user_data
+from app.fragments import fragments
+from app.instrumentation import instrumentation
+from app.last_seen import last_seen
+from app.page_cache import page_cache
 from app.main import bp
 from app.main.forms import EditProfileForm, EmptyFollowForm, PostForm, UploadImagesForm
-from app.models import User, Post
+from app.models import User, Post, Upload, avatar_digest
+from app.pagination import paginate_keyset
+from app.ratelimit import limiter
+from app.search import search as post_search
+from app.timeline import timeline
+from app.uploads import UploadError, extension, receive_chunk
+from app.user_cache import user_cache
 
-from flask import render_template, redirect, flash, url_for, request, g, current_app
+from flask import render_template, redirect, flash, url_for, request, g, current_app, \
+    make_response, Markup, jsonify, abort, Response, stream_with_context
 from flask_babel import get_locale
 from flask_babel import gettext as _T
 from flask_login import current_user, login_required
-from werkzeug.utils import secure_filename
+from sqlalchemy.exc import IntegrityError
 
 @bp.route("/", methods = ["GET", "POST"])
 @bp.route("/index", methods = ["GET", "POST"])
@@ -19,6 +33,9 @@ def index():
     if form.validate_on_submit():
         post = Post(body = form.post.data, author = current_user)
         db.session.add(post)
+        # Flush to get the post id before pushing it to the timelines
+        db.session.flush()
+        timeline.fan_out(post)
         db.session.commit()
         flash(_T("Your post has been saved"))
 
@@ -26,17 +43,15 @@ def index():
         # https://en.wikipedia.org/wiki/Post/Redirect/Get
         return redirect(url_for("main.index"))
 
-    # Paginate posts
-    # A page can be passed as a request argument
-    # Ex. /index?page=3
-    page = request.args.get(key = 'page', default = 1, type = int)
-    ret_404_on_empty_range = False
-    posts = current_user.followed_posts()\
-                        .paginate(page, current_app.config['POSTS_PER_PAGE'], ret_404_on_empty_range)
+    # Paginate posts by cursor
+    # The cursor of the last/first post shown is passed as a request argument
+    # Ex. /index?before=<cursor>
+    posts = timeline.page(current_user, current_app.config['POSTS_PER_PAGE'],
+            before = request.args.get('before'), after = request.args.get('after'))
 
-    next_url = url_for("main.index", page = posts.next_num)\
+    next_url = url_for("main.index", before = posts.next_cursor)\
             if posts.has_next else None
-    prev_url = url_for("main.index", page = posts.prev_num)\
+    prev_url = url_for("main.index", after = posts.prev_cursor)\
             if posts.has_prev else None
 
     return render_template("index.html", title = "Home", form = form,
@@ -47,19 +62,17 @@ def index():
 @login_required
 def user(username):
     form = EmptyFollowForm()
-    user = User.query.filter_by(username = username).first_or_404()
+    user = last_seen.apply(User.query.filter_by(username = username).first_or_404())
 
-    # Paginate posts
-    # A page can be passed as a request argument
-    # Ex. /index?page=3
-    page = request.args.get(key = 'page', default = 1, type = int)
-    ret_404_on_empty_range = False
-    posts = user.posts.order_by(Post.timestamp.desc())\
-                .paginate(page, current_app.config['POSTS_PER_PAGE'], ret_404_on_empty_range)
+    # Paginate posts by cursor
+    # Ex. /user/<username>?before=<cursor>
+    posts = paginate_keyset(user.posts.options(db.joinedload(Post.author)), Post,
+            current_app.config['POSTS_PER_PAGE'],
+            before = request.args.get('before'), after = request.args.get('after'))
 
-    next_url = url_for("main.user", username = username, page = posts.next_num)\
+    next_url = url_for("main.user", username = username, before = posts.next_cursor)\
             if posts.has_next else None
-    prev_url = url_for("main.user", username = username, page = posts.prev_num)\
+    prev_url = url_for("main.user", username = username, after = posts.prev_cursor)\
             if posts.has_prev else None
 
     return render_template("user.html", user = user, form = form,
@@ -71,9 +84,14 @@ def edit_profile():
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
         # A POST request is sent when the form is submitted
+        username_changed = current_user.username != form.username.data
         current_user.username = form.username.data
         current_user.about_me = form.about_me.data
         db.session.commit()
+        user_cache.invalidate(current_user)
+        if username_changed:
+            # Cached posts show the author's username
+            fragments.invalidate_author(current_user)
         flash(_T("Your changes have been saved."))
         return redirect(url_for("main.edit_profile"))
     elif request.method == "GET":
@@ -82,12 +100,25 @@ def edit_profile():
         form.about_me.data = current_user.about_me
     return render_template("edit_profile.html", title = "Edit Profile", form = form)
 
+@bp.route("/export")
+@login_required
+@limiter.limit("export", key = lambda: str(current_user.id), methods = ("GET",))
+def export():
+    # Streamed as it's read, the request context must outlive the view
+    lines = user_data(current_user._get_current_object())
+    response = Response(stream_with_context(gzipped(lines)), mimetype = "application/gzip")
+    response.headers.set("Content-Disposition", "attachment",
+                         filename = "microblog-{}.jsonl.gz".format(current_user.username))
+    response.cache_control.private = True
+    response.cache_control.no_store = True
+    return response
+
 # Log user last access time before any request
+# The write is batched, see app.last_seen
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        last_seen.touch(current_user)
 
     g.locale = str(get_locale())
 
@@ -104,7 +135,12 @@ def follow(username):
             flash(_T("You cannot follow yourself!"))
             return redirect(url_for("main.user", username = username))
         current_user.follow(user)
-        db.session.commit()
+        timeline.on_follow(current_user, user)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # A concurrent request followed the same user first
+            db.session.rollback()
         flash(_T("You are following %(username)s!", username = username))
         return redirect(url_for("main.user", username = username))
     else:
@@ -124,6 +160,7 @@ def unfollow(username):
             flash(_T("You cannot unfollow yourself!"))
             return redirect(url_for("main.user", username = username))
         current_user.unfollow(user)
+        timeline.on_unfollow(current_user, user)
         db.session.commit()
         flash(_T("You are not following %(username)s.", username = username))
         return redirect(url_for("main.user", username = username))
@@ -133,39 +170,105 @@ def unfollow(username):
 @bp.route("/explore")
 @login_required
 def explore():
-    # Paginate posts
-    # A page can be passed as a request argument
-    # Ex. /index?page=3
-    page = request.args.get(key = 'page', default = 1, type = int)
-    ret_404_on_empty_range = False
-    posts = Post.query.order_by(Post.timestamp.desc())\
-            .paginate(page, current_app.config['POSTS_PER_PAGE'], ret_404_on_empty_range)
-
-    next_url = url_for("main.explore", page = posts.next_num)\
+    before = request.args.get('before')
+    after = request.args.get('after')
+
+    # The newest post versions every explore page, a single index lookup
+    newest = db.session.query(Post.id, Post.timestamp)\
+                       .order_by(Post.id.desc()).first() or (0, None)
+    # and so does renaming any author, whose name every post shows
+    authors_version = fragments.authors_version()
+    last_modified = newest[1]
+    if last_modified is not None and authors_version:
+        last_modified = max(last_modified, datetime.utcfromtimestamp(authors_version))
+    etag = page_cache.make_etag("explore", newest[0], authors_version, before, after,
+                                g.locale, current_user.id, current_user.username)
+    if page_cache.is_fresh(etag, last_modified):
+        return page_cache.add_validators(
+                current_app.response_class(status = 304), etag, last_modified)
+
+    def render_posts():
+        # Paginate posts by cursor
+        # Ex. /explore?before=<cursor>
+        # Authors are joined in, sub_post.html reads post.author for every post
+        posts = paginate_keyset(Post.query.options(db.joinedload(Post.author)), Post,
+                current_app.config['POSTS_PER_PAGE'], before = before, after = after)
+
+        next_url = url_for("main.explore", before = posts.next_cursor)\
+                if posts.has_next else None
+        prev_url = url_for("main.explore", after = posts.prev_cursor)\
+                if posts.has_prev else None
+
+        return render_template("paginated_posts.html", posts = posts.items,
+                next_url = next_url, prev_url = prev_url)
+
+    # The post list is the same for everyone, only the navbar is per user
+    key = "explore:{}:{!r}:{}:{}:{}".format(newest[0], authors_version, before, after, g.locale)
+    posts_html = page_cache.get_or_render(key, render_posts,
+            ttl = current_app.config['EXPLORE_CACHE_TTL'])
+
+    response = make_response(render_template("index.html", title = "Explore",
+            posts_html = Markup(posts_html)))
+    return page_cache.add_validators(response, etag, last_modified)
+
+@bp.route("/search")
+@login_required
+def search():
+    q = request.args.get("q", "").strip()
+    posts = post_search.page(q, current_app.config["POSTS_PER_PAGE"],
+            before = request.args.get("before"), after = request.args.get("after"))
+
+    next_url = url_for("main.search", q = q, before = posts.next_cursor)\
             if posts.has_next else None
-    prev_url = url_for("main.explore", page = posts.prev_num)\
+    prev_url = url_for("main.search", q = q, after = posts.prev_cursor)\
             if posts.has_prev else None
 
-    return render_template("index.html", title = "Explore", posts = posts.items,
-            next_url = next_url, prev_url = prev_url)
+    return render_template("search.html", title = _T("Search"), q = q,
+            posts = posts.items, next_url = next_url, prev_url = prev_url)
 
 @bp.route("/upload", methods = ["GET", "POST"])
 @login_required
 def upload():
     form = UploadImagesForm()
     if request.method == "POST":
-        uploaded_file = request.files['file']
-        for uploaded_file in request.files.getlist('file'):
-            if uploaded_file.filename != '':
-                #uploaded_file.save(uploaded_file.filename)
-                print(secure_filename(uploaded_file.filename))
+        # Dropzone sends each chunk with XHR, answer with JSON
+        if not form.validate_on_submit():
+            return jsonify(error = " ".join(sum(form.errors.values(), []))), 400
+        try:
+            upload = receive_chunk(current_user, form.file.data, request.form)
+        except UploadError as e:
+            return jsonify(error = str(e)), e.status
 
-        flash(_T("Your images have been submitted for processing"))
+        if upload.status == "processing":
+            flash(_T("Your images have been submitted for processing"))
+        return jsonify(id = upload.id, status = upload.status)
 
-        # Post/Redirect/Get pattern
-        # https://en.wikipedia.org/wiki/Post/Redirect/Get
-        return redirect(url_for("main.index"))
+    return render_template("upload.html", title = "Upload Images", form = form,
+            chunk_size = current_app.config["UPLOAD_CHUNK_SIZE"],
+            max_size = current_app.config["UPLOAD_MAX_SIZE"])
 
-    return render_template("upload.html", title = "Upload Images", form = form)
+@bp.route("/media/d/<digest>/<int:size>.<ext>")
+def derivative(digest, size, ext):
+    # Only reached on a miss, nginx serves the files already generated
+    if size not in current_app.config["DERIVATIVES_SIZES"]:
+        abort(404)
+    upload = Upload.query.filter_by(digest = digest, status = "ready").first_or_404()
+    if extension(upload.filename) != ext:
+        abort(404)
+    return serve_derivative(upload, size)
 
+@bp.route("/avatar/<int:user_id>/<digest>/<int:size>")
+def avatar(user_id, digest, size):
+    # Made up digests never reach the fetcher, only the current one of a user
+    user = User.query.get(user_id)
+    if user is None or avatar_digest(user.id, user.email) != digest:
+        abort(404)
+    return avatars.serve(digest, size)
 
+@bp.route("/metrics")
+def metrics():
+    # Not found, rather than forbidden, for everyone else
+    if not instrumentation.enabled or not instrumentation.can_read_metrics():
+        abort(404)
+    return Response(instrumentation.histograms.render(),
+                    mimetype = "text/plain; version=0.0.4")
@@ -1,28 +1,39 @@
 from datetime import datetime
+from functools import lru_cache
 from time import time
 from app import db, login
+from app.passwords import passwords
+from app.user_cache import user_cache
 
-from flask import current_app
+from flask import current_app, g, url_for
 from flask_login import UserMixin
 
-from werkzeug.security import generate_password_hash, check_password_hash
-
 from hashlib import md5
 import jwt
 
+@lru_cache(maxsize=4096)
+def avatar_digest(user_id, email):
+    """
+    Gravatar digest, memoized per process. Changing the email changes the
+    key, so a stale digest is never served and the old entry is evicted.
+    """
+    return md5(email.lower().encode("utf-8")).hexdigest()
+
 """
 Association table used by many-to-many relationship between Users
 """
 followers = db.Table("followers",
-    db.Column("follower_id", db.Integer, db.ForeignKey("user.id")),
-    db.Column("followed_id", db.Integer, db.ForeignKey("user.id"))
+    db.Column("follower_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("followed_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    # The primary key serves "who do I follow", this one "who follows me"
+    db.Index("ix_followers_followed_id_follower_id", "followed_id", "follower_id")
 )
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
-    password_hash = db.Column(db.String(128))
+    password_hash = db.Column(db.String(256))
 
     """
     user.posts will retrieve all the Posts made by this User
@@ -33,6 +44,15 @@ class User(UserMixin, db.Model):
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default = datetime.utcnow)
 
+    """
+    Denormalized counters, so profiles don't COUNT(*) the followers table.
+    They are only ever changed with atomic UPDATE ... SET x = x + 1 statements,
+    `flask counters reconcile` fixes any drift.
+    """
+    followers_count = db.Column(db.Integer, nullable = False, default = 0, server_default = "0")
+    followed_count = db.Column(db.Integer, nullable = False, default = 0, server_default = "0")
+    posts_count = db.Column(db.Integer, nullable = False, default = 0, server_default = "0")
+
     """
     Define many-to-many relationship between User instances.
     user1 = user2 has the meaning of: user1 is following user2
@@ -47,10 +67,13 @@ class User(UserMixin, db.Model):
         backref=db.backref("followers", lazy = "dynamic"), lazy = "dynamic")
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return passwords.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return passwords.needs_rehash(self.password_hash)
 
     def get_reset_password_token(self, expires_in=1800):
         # Token expires in 30 mins
@@ -68,38 +91,99 @@ class User(UserMixin, db.Model):
         return User.query.get(id)
 
     def avatar(self, size):
-        # Get Gravatar
-        digest = md5(self.email.lower().encode("utf-8")).hexdigest()
-        return "https://www.gravatar.com/avatar/{}?d=identicon&s={}".format(digest, size)
+        # Gravatar, through the local cache in app.avatars
+        digest = avatar_digest(self.id, self.email)
+        return url_for("main.avatar", user_id=self.id, digest=digest, size=size)
 
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            self._increment("followed_count", 1)
+            user._increment("followers_count", 1)
+            self._following_cache()[user.id] = True
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self._increment("followed_count", -1)
+            user._increment("followers_count", -1)
+            self._following_cache()[user.id] = False
+
+    def _increment(self, counter, delta):
+        # Update in the database and reload on next access, so concurrent
+        # requests never overwrite each other's increments
+        if self.id is None:
+            db.session.flush()
+        column = getattr(User, counter)
+        db.session.execute(User.__table__.update().where(User.id == self.id)
+                                                  .values({ counter: column + delta }))
+        db.session.expire(self, [counter])
+
+    @staticmethod
+    def reconcile_counters(user_ids=None):
+        """
+        Recompute every counter in one bulk UPDATE, or those of `user_ids`,
+        returns the number of fixed users.
+        """
+        if user_ids is not None:
+            user_ids = sorted(user_ids)
+            # Bounded IN lists
+            return sum(User._reconcile_counters(User.id.in_(user_ids[i:i + 500]))
+                       for i in range(0, len(user_ids), 500))
+        return User._reconcile_counters(db.true())
+
+    @staticmethod
+    def _reconcile_counters(users):
+        followers_count = db.select([db.func.count()]).select_from(followers)\
+                            .where(followers.c.followed_id == User.id).scalar_subquery()
+        followed_count = db.select([db.func.count()]).select_from(followers)\
+                           .where(followers.c.follower_id == User.id).scalar_subquery()
+        posts_count = db.select([db.func.count(Post.id)])\
+                        .where(Post.user_id == User.id).scalar_subquery()
+        result = db.session.execute(User.__table__.update()
+            .where(users)
+            .where(db.or_(User.followers_count != followers_count,
+                          User.followed_count != followed_count,
+                          User.posts_count != posts_count))
+            .values(followers_count = followers_count,
+                    followed_count = followed_count,
+                    posts_count = posts_count))
+        return result.rowcount
+
+    def _following_cache(self):
+        # followed user id -> bool, lives as long as the request
+        return g.setdefault("following", {}).setdefault(self.id, {})
 
     def is_following(self, user):
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        if self.id is None or user.id is None:
+            db.session.flush()
+        cache = self._following_cache()
+        if user.id not in cache:
+            cache[user.id] = db.session.query(db.exists().where(db.and_(
+                followers.c.follower_id == self.id,
+                followers.c.followed_id == user.id))).scalar()
+        return cache[user.id]
 
     def followed_posts(self):
         # Get posts from followed users
-        posts_followed = Post.query.join(followers, (followers.c.followed_id == Post.user_id))\
-                                   .filter(followers.c.follower_id == self.id)
-
-        # A user expects to find his own posts in his timeline
-        posts_owned = Post.query.filter_by(user_id = self.id)
+        followed_ids = db.select([followers.c.followed_id])\
+                         .where(followers.c.follower_id == self.id)
 
-        # Create a union of the posts, ordered by the most recent one
-        return posts_followed.union(posts_owned).order_by(Post.timestamp.desc())
+        # A user expects to find his own posts in his timeline.
+        # A single filtered query (instead of a UNION) can walk the
+        # (timestamp, id) index when paginated by cursor.
+        return Post.query.options(db.joinedload(Post.author))\
+                         .filter(db.or_(Post.user_id.in_(followed_ids),
+                                        Post.user_id == self.id))\
+                         .order_by(Post.timestamp.desc(), Post.id.desc())
 
     def __repr__(self):
         return "<User {}>".format(self.username)
 
 @login.user_loader
 def load_user(id):
-    return User.query.get(int(id))
+    # Usually without a query, see app.user_cache
+    return user_cache.load(User, int(id))
 
 class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -107,5 +191,61 @@ class Post(db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
 
+    # Back the (timestamp, id) keyset pagination of the timelines
+    __table_args__ = (
+        db.Index("ix_post_timestamp_id", "timestamp", "id"),
+        db.Index("ix_post_user_id_timestamp_id", "user_id", "timestamp", "id"),
+    )
+
     def __repr__(self):
         return "<Post {}>".format(self.body)
+
+@db.event.listens_for(Post, "after_insert")
+def increment_posts_count(mapper, connection, post):
+    # Runs inside the flush, in the same transaction as the INSERT
+    connection.execute(User.__table__.update().where(User.id == post.user_id)
+                                              .values(posts_count = User.posts_count + 1))
+
+@db.event.listens_for(Post, "after_delete")
+def decrement_posts_count(mapper, connection, post):
+    connection.execute(User.__table__.update().where(User.id == post.user_id)
+                                              .values(posts_count = User.posts_count - 1))
+
+class Upload(db.Model):
+    """
+    An uploaded image. The files live in UPLOAD_FOLDER, see app.uploads.
+        * receiving - chunks are still arriving
+        * processing - complete, waiting for the worker
+        * ready - validated, stripped and thumbnailed
+        * rejected - not an acceptable image
+        * failed - an image the worker refused to decode, e.g. a decompression bomb
+        * expired - abandoned while receiving, its chunks are gone
+    """
+    id = db.Column(db.String(36), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
+    filename = db.Column(db.String(255))
+    size = db.Column(db.Integer)
+    status = db.Column(db.String(16), default="receiving")
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # sha256 of the processed image, set once it's ready
+    digest = db.Column(db.String(64), index=True)
+
+    def __repr__(self):
+        return "<Upload {} {}>".format(self.id, self.status)
+
+class TimelineEntry(db.Model):
+    """
+    Materialized home timeline: one row per (reader, post) pushed on write.
+    The post timestamp is duplicated so a timeline page is a single index
+    range scan on (user_id, timestamp, post_id).
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey("post.id"), primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_timeline_entry_user_id_timestamp_post_id", "user_id", "timestamp", "post_id"),
+    )
+
+    def __repr__(self):
+        return "<TimelineEntry {} {}>".format(self.user_id, self.post_id)
@@ -0,0 +1,65 @@
+from hashlib import md5
+
+from flask import current_app, request, session
+
+from app.cache import make_cache
+
+"""
+Shared page cache and conditional GET helpers.
+
+Pages that are the same for every user (apart from the navbar) keep their
+rendered body in a short lived shared cache. Their ETag/Last-Modified are
+computed from cheap lookups before anything is rendered, so a client with a
+fresh copy gets a 304 without a query for the page content or a template render.
+"""
+
+class PageCache(object):
+    def __init__(self, app = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["pages"] = make_cache(app, "pages")
+
+    @property
+    def cache(self):
+        return current_app.extensions["pages"]
+
+    def get_or_render(self, key, render, ttl = None):
+        html = self.cache.get(key)
+        if html is None:
+            html = render()
+            self.cache.set(key, html, ttl = ttl)
+        return html
+
+    @staticmethod
+    def make_etag(*parts):
+        return md5(":".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def is_fresh(etag, last_modified):
+        """
+        True if the client's copy can be reused, i.e. a 304 can be sent.
+        """
+        # Pending flashed messages must still be rendered
+        if session.get("_flashes"):
+            return False
+        # A client that sent an ETag is only judged by it
+        if "If-None-Match" in request.headers:
+            return request.if_none_match.contains(etag)
+        if request.if_modified_since and last_modified is not None:
+            since = request.if_modified_since.replace(tzinfo = None)
+            return last_modified.replace(microsecond = 0) <= since
+        return False
+
+    @staticmethod
+    def add_validators(response, etag, last_modified):
+        response.set_etag(etag)
+        if last_modified is not None:
+            response.last_modified = last_modified
+        # The navbar is per user, browsers may keep it but must revalidate
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+page_cache = PageCache()
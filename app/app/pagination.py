@@ -0,0 +1,123 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+"""
+Keyset (cursor) pagination for post timelines.
+
+Instead of OFFSET/LIMIT + COUNT(*), a page is selected relative to the
+(timestamp, id) key of the last post seen, so every page costs the same
+no matter how deep the user scrolls. The key is handed to the client as
+an opaque, url-safe cursor:
+    * ?before=<cursor> - older posts (next page)
+    * ?after=<cursor>  - newer posts (previous page)
+"""
+
+TIMESTAMP_FORMAT = "%Y%m%d%H%M%S%f"
+
+def encode_cursor(timestamp, id):
+    raw = "{}.{}".format(timestamp.strftime(TIMESTAMP_FORMAT), id)
+    return urlsafe_b64encode(raw.encode("ascii")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    # A missing or tampered cursor simply means "start from the top"
+    if not cursor:
+        return None
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        raw = urlsafe_b64decode((cursor + padding).encode("ascii")).decode("ascii")
+        timestamp, id = raw.split(".")
+        return datetime.strptime(timestamp, TIMESTAMP_FORMAT), int(id)
+    except (ValueError, UnicodeError):
+        return None
+
+def encode_score_cursor(score, id):
+    raw = "{!r}:{}".format(float(score), id)
+    return urlsafe_b64encode(raw.encode("ascii")).decode("ascii").rstrip("=")
+
+def decode_score_cursor(cursor):
+    """
+    Cursor of ranked results, e.g. search, keyed by (score, id).
+    """
+    if not cursor:
+        return None
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        raw = urlsafe_b64decode((cursor + padding).encode("ascii")).decode("ascii")
+        score, id = raw.split(":")
+        return float(score), int(id)
+    except (ValueError, UnicodeError):
+        return None
+
+def keyset_criterion(timestamp_col, id_col, key, newer):
+    """
+    Build (timestamp, id) > key when newer is set, (timestamp, id) < key otherwise.
+    Written out with OR/AND instead of a row value so it works on every backend.
+    """
+    timestamp, id = key
+    if newer:
+        return or_(timestamp_col > timestamp,
+                   and_(timestamp_col == timestamp, id_col > id))
+    return or_(timestamp_col < timestamp,
+               and_(timestamp_col == timestamp, id_col < id))
+
+class KeysetPage(object):
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+
+    def cursor(self, item):
+        return encode_cursor(item.timestamp, item.id)
+
+    @property
+    def next_cursor(self):
+        if not self.has_next or not self.items:
+            return None
+        return self.cursor(self.items[-1])
+
+    @property
+    def prev_cursor(self):
+        if not self.has_prev or not self.items:
+            return None
+        return self.cursor(self.items[0])
+
+def page_from_keys(rows, per_page, before, after):
+    """
+    Turn up to per_page + 1 rows fetched in walking order (newest first for
+    `before`/no cursor, oldest first for `after`) into a KeysetPage.
+    The extra row only tells us whether there is another page.
+    """
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if after is not None:
+        rows.reverse()
+        return KeysetPage(rows, has_next = True, has_prev = has_more)
+    return KeysetPage(rows, has_next = has_more, has_prev = before is not None)
+
+def order_keyset(query, timestamp_col, id_col, before = None, after = None):
+    """
+    Restrict and order a query to walk away from an already decoded cursor:
+    oldest first after `after`, newest first otherwise.
+    """
+    if after is not None:
+        return query.filter(keyset_criterion(timestamp_col, id_col, after, newer = True))\
+                    .order_by(timestamp_col.asc(), id_col.asc())
+    if before is not None:
+        query = query.filter(keyset_criterion(timestamp_col, id_col, before, newer = False))
+    return query.order_by(timestamp_col.desc(), id_col.desc())
+
+def paginate_keyset(query, model, per_page, before = None, after = None):
+    """
+    Paginate a query over `model` (anything with `timestamp` and `id`
+    columns) by cursor. No total count is ever computed.
+    """
+    before = decode_cursor(before)
+    after = decode_cursor(after) if before is None else None
+
+    # Drop any ordering the caller applied, the key order is the only one we can use
+    query = order_keyset(query.order_by(None), model.timestamp, model.id, before, after)
+
+    rows = query.limit(per_page + 1).all()
+    return page_from_keys(rows, per_page, before, after)
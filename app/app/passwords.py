@@ -0,0 +1,126 @@
+import atexit
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from threading import Lock
+from time import perf_counter
+
+from flask import current_app
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, check_password_hash, \
+    generate_password_hash
+
+"""
+Password hashing with tunable cost.
+
+The method (e.g. "pbkdf2:sha256:260000") and salt length come from Config.
+A hash made with other parameters still verifies, and is replaced by one
+with the current parameters the next time its owner logs in.
+
+PBKDF2 keeps a CPU busy for as long as it's configured to. With
+PASSWORD_HASH_WORKERS set, hashing and verification run in a pool of that
+many processes, created lazily in each uWSGI worker, so a burst of logins
+queues there instead of holding the GIL of the worker's other threads.
+"""
+
+def normalize_method(method):
+    # werkzeug always stores the iterations, so must the comparison
+    parts = method.split(":")
+    if parts[0] == "pbkdf2" and len(parts) == 2:
+        parts.append(str(DEFAULT_PBKDF2_ITERATIONS))
+    return ":".join(parts)
+
+class Passwords(object):
+    def __init__(self, app = None):
+        self.lock = Lock()
+        self.pool = None
+        self.pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config["PASSWORD_HASH_METHOD"] = normalize_method(app.config["PASSWORD_HASH_METHOD"])
+
+    def _executor(self, workers):
+        # A pool inherited through fork() has no live processes, start one per process
+        with self.lock:
+            if self.pool is None or self.pid != os.getpid():
+                if self.pid is None:
+                    atexit.register(self._shutdown)
+                self.pool = ProcessPoolExecutor(max_workers = workers)
+                self.pid = os.getpid()
+            return self.pool
+
+    def _shutdown(self):
+        if self.pool is not None and self.pid == os.getpid():
+            self.pool.shutdown(wait = False)
+
+    def _run(self, f, *args):
+        workers = current_app.config["PASSWORD_HASH_WORKERS"]
+        if not workers:
+            return f(*args)
+        return self._executor(workers).submit(f, *args)\
+                   .result(timeout = current_app.config["PASSWORD_HASH_TIMEOUT"])
+
+    def hash(self, password):
+        config = current_app.config
+        return self._run(generate_password_hash, password,
+                         config["PASSWORD_HASH_METHOD"], config["PASSWORD_SALT_LENGTH"])
+
+    def hash_many(self, passwords, pool = None):
+        """
+        Hashes of many passwords, e.g. for a bulk import, spread over the
+        processes of `pool` if given.
+        """
+        config = current_app.config
+        method, salt_length = config["PASSWORD_HASH_METHOD"], config["PASSWORD_SALT_LENGTH"]
+        if pool is None:
+            return [generate_password_hash(password, method, salt_length) for password in passwords]
+        return list(pool.map(generate_password_hash, passwords, repeat(method), repeat(salt_length),
+                             chunksize = 16))
+
+    def verify(self, pwhash, password):
+        if not pwhash:
+            return False
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """
+        True if the hash wasn't made with the current method and salt length.
+        """
+        if not pwhash or pwhash.count("$") != 2:
+            return True
+        method, salt, _ = pwhash.split("$")
+        config = current_app.config
+        return method != config["PASSWORD_HASH_METHOD"] or \
+            len(salt) != config["PASSWORD_SALT_LENGTH"]
+
+passwords = Passwords()
+
+def _verify_for(pwhash, password, seconds):
+    count = 0
+    end = perf_counter() + seconds
+    while perf_counter() < end:
+        check_password_hash(pwhash, password)
+        count += 1
+    return count
+
+def benchmark(method, salt_length, seconds = 3.0, processes = None):
+    """
+    Verifications per second with the given parameters, i.e. the logins
+    a core can serve, measured with one busy process per core.
+    """
+    processes = processes or os.cpu_count() or 1
+    pwhash = generate_password_hash("correct horse battery staple",
+                                    normalize_method(method), salt_length)
+    with ProcessPoolExecutor(max_workers = processes) as pool:
+        counts = list(pool.map(_verify_for, [pwhash] * processes,
+                               ["correct horse battery staple"] * processes,
+                               [seconds] * processes))
+    total = sum(counts) / seconds
+    return {
+        "method": normalize_method(method),
+        "processes": processes,
+        "logins_per_second": round(total, 1),
+        "logins_per_second_per_core": round(total / processes, 1),
+        "ms_per_login": round(1000.0 / (total / processes), 2),
+    }
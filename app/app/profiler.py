@@ -0,0 +1,108 @@
+import hmac
+import os
+import random
+import sys
+import threading
+from collections import Counter
+from tempfile import NamedTemporaryFile
+from time import time
+
+from flask import g, request
+
+"""
+Sampling CPU profiler.
+
+A profiled request is sampled by a thread that records the stack of the
+request thread every PROFILER_INTERVAL_MS milliseconds. When the request
+ends, the stacks are written to PROFILER_DIR in the collapsed format read by
+flamegraph.pl and speedscope, one line per distinct stack:
+
+    wsgi_app (flask/app.py:2447);...;index (app/main/routes.py:26) 12
+
+Requests are profiled when they carry an "X-Profile: <PROFILER_TOKEN>"
+header, and at random with probability PROFILER_SAMPLE_RATE. Both are off
+by default. Only the PROFILER_MAX_FILES newest files are kept.
+"""
+
+HEADER = "X-Profile"
+
+def frame_name(frame):
+    code = frame.f_code
+    # Semicolons separate the frames of a collapsed stack
+    path = os.path.join(os.path.basename(os.path.dirname(code.co_filename)),
+                        os.path.basename(code.co_filename))
+    return "{} ({}:{})".format(code.co_name, path, code.co_firstlineno).replace(";", ":")
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class Sampler(threading.Thread):
+    def __init__(self, thread_id, interval):
+        threading.Thread.__init__(self, name = "profiler", daemon = True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        return self.stacks
+
+def write_profile(directory, name, stacks, max_files):
+    """
+    Write the collapsed stacks, then drop the oldest profiles over max_files.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with NamedTemporaryFile("w", dir = directory, suffix = ".tmp", delete = False) as f:
+        for stack, count in sorted(stacks.items()):
+            f.write("{} {}\n".format(stack, count))
+    path = os.path.join(directory, name)
+    os.replace(f.name, path)
+
+    profiles = sorted((entry for entry in os.scandir(directory) if entry.name.endswith(".folded")),
+                      key = lambda entry: entry.stat().st_mtime)
+    for entry in profiles[:max(len(profiles) - max_files, 0)]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+    return path
+
+def should_profile(config):
+    token = config["PROFILER_TOKEN"]
+    if token and hmac.compare_digest(request.headers.get(HEADER, "").encode("utf-8"),
+                                     token.encode("utf-8")):
+        return True
+    return random.random() < config["PROFILER_SAMPLE_RATE"]
+
+def init_app(app):
+    if not app.config["PROFILER_TOKEN"] and not app.config["PROFILER_SAMPLE_RATE"]:
+        return
+
+    @app.before_request
+    def start_profiler():
+        if should_profile(app.config):
+            g.profiler = Sampler(threading.get_ident(), app.config["PROFILER_INTERVAL_MS"] / 1000.0)
+            g.profiler.start()
+
+    @app.teardown_request
+    def stop_profiler(exc):
+        sampler = g.pop("profiler", None)
+        if sampler is None:
+            return
+        stacks = sampler.stop()
+        if stacks:
+            name = "{:.6f}-{}-{}.folded".format(time(), request.endpoint or "unmatched", os.getpid())
+            write_profile(app.config["PROFILER_DIR"], name, stacks, app.config["PROFILER_MAX_FILES"])
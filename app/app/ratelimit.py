@@ -0,0 +1,204 @@
+import struct
+from collections import OrderedDict
+from functools import wraps
+from hashlib import sha1
+from math import ceil
+from threading import Lock
+from time import time
+
+from flask import abort, current_app, request
+
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+"""
+Token bucket rate limiting.
+
+A limit such as "5/minute" is a bucket of 5 tokens refilled at 5 per minute,
+every request takes a token and is refused with a 429 once the bucket is
+empty. Limits are named in RATELIMITS and applied to views with
+`limiter.limit(name, key)`, the key function picks what is limited: the
+client address, an account named in the form, ...
+
+Buckets live in a store shared by the workers of a host (the uWSGI cache
+declared in uwsgi.ini) or by every host (Redis), and in the process itself
+when neither is available. A refused request never reaches the view, so it
+costs no password hash and no email.
+"""
+
+PERIODS = {
+    "second": 1,
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400,
+}
+
+def parse_limit(limit):
+    """
+    "5/minute" -> (rate in tokens per second, burst)
+    """
+    count, period = limit.split("/")
+    count = int(count)
+    return count / float(PERIODS[period.strip()]), count
+
+def refill(tokens, last, now, rate, burst, cost):
+    """
+    Take `cost` tokens from a bucket last updated at `last`.
+    Returns (allowed, tokens left, seconds before enough tokens are back).
+    """
+    tokens = min(burst, tokens + (now - last) * rate)
+    if tokens >= cost:
+        return True, tokens - cost, 0
+    return False, tokens, (cost - tokens) / rate
+
+class MemoryStore(object):
+    """
+    Buckets of this process only, each uWSGI worker counts on its own.
+    """
+    def __init__(self, max_entries = 10000):
+        self.max_entries = max_entries
+        self.lock = Lock()
+        # key -> (tokens, last update), least recently used first
+        self.buckets = OrderedDict()
+
+    def consume(self, key, rate, burst, cost = 1):
+        now = time()
+        with self.lock:
+            tokens, last = self.buckets.get(key, (burst, now))
+            allowed, tokens, retry_after = refill(tokens, last, now, rate, burst, cost)
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.max_entries:
+                self.buckets.popitem(last = False)
+        return allowed, retry_after
+
+class UwsgiStore(object):
+    """
+    Buckets in a uWSGI cache, i.e. shared memory of every worker of the
+    instance. Declared in uwsgi.ini with cache2 = name=<name>,...
+    """
+    STATE = struct.Struct("dd")
+
+    def __init__(self, name):
+        if uwsgi is None:
+            raise RuntimeError("The uwsgi rate limit store only runs under uWSGI")
+        self.name = name
+
+    def consume(self, key, rate, burst, cost = 1):
+        now = time()
+        # A global lock of the instance, held for a read and a write
+        uwsgi.lock()
+        try:
+            state = uwsgi.cache_get(key, self.name)
+            tokens, last = self.STATE.unpack(state) if state else (burst, now)
+            allowed, tokens, retry_after = refill(tokens, last, now, rate, burst, cost)
+            # Dropped once the bucket would be full again anyway
+            uwsgi.cache_update(key, self.STATE.pack(tokens, now),
+                               int(ceil(burst / rate)), self.name)
+        finally:
+            uwsgi.unlock()
+        return allowed, retry_after
+
+class RedisStore(object):
+    # Same as refill(), run atomically by the server
+    SCRIPT = """
+local rate, burst, now, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local state = redis.call("HMGET", KEYS[1], "tokens", "last")
+local tokens = tonumber(state[1]) or burst
+local last = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + (now - last) * rate)
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call("HMSET", KEYS[1], "tokens", tostring(tokens), "last", tostring(now))
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate))
+return {allowed, tostring(tokens)}
+"""
+
+    def __init__(self, url, prefix = "ratelimit:"):
+        if redis is None:
+            raise RuntimeError("The redis rate limit store requires the redis package")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def consume(self, key, rate, burst, cost = 1):
+        allowed, tokens = self.script(keys = [self.prefix + key], args = [rate, burst, time(), cost])
+        if allowed:
+            return True, 0
+        return False, (cost - float(tokens)) / rate
+
+def make_store(app):
+    backend = app.config["RATELIMIT_BACKEND"]
+    if backend == "auto":
+        # The uWSGI cache when running under uWSGI, this process otherwise
+        backend = "uwsgi" if uwsgi is not None else "memory"
+    if backend == "memory":
+        return MemoryStore(app.config["RATELIMIT_MAX_ENTRIES"])
+    if backend == "uwsgi":
+        return UwsgiStore(app.config["RATELIMIT_UWSGI_CACHE"])
+    if backend == "redis":
+        return RedisStore(app.config["REDIS_URL"])
+    raise ValueError("Unknown rate limit backend: {}".format(backend))
+
+def remote_addr():
+    return request.remote_addr or ""
+
+def form_field(name):
+    """
+    Key function limiting an account, named by a field of the posted form.
+    """
+    def key():
+        return (request.form.get(name) or "").strip().lower()
+    return key
+
+class RateLimiter(object):
+    def __init__(self, app = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["ratelimit"] = make_store(app)
+
+    @property
+    def store(self):
+        return current_app.extensions["ratelimit"]
+
+    def hit(self, name, key):
+        """
+        Take a token from the bucket of `key` under the limit `name`.
+        Returns (allowed, seconds to wait when it isn't).
+        """
+        rate, burst = parse_limit(current_app.config["RATELIMITS"][name])
+        # Fixed length keys, whatever was typed in the form
+        bucket = sha1("{}:{}".format(name, key).encode("utf-8")).hexdigest()
+        return self.store.consume(bucket, rate, burst)
+
+    def limit(self, name, key = remote_addr, methods = ("POST",)):
+        """
+        Refuse requests to the view with a 429 once the bucket of key()
+        under the limit `name` is empty. Only `methods` are counted.
+        """
+        def decorator(f):
+            @wraps(f)
+            def wrapped(*args, **kwargs):
+                if current_app.config["RATELIMIT_ENABLED"] and request.method in methods:
+                    value = key()
+                    if value:
+                        allowed, retry_after = self.hit(name, value)
+                        if not allowed:
+                            abort(429, retry_after = int(ceil(retry_after)))
+                return f(*args, **kwargs)
+            return wrapped
+        return decorator
+
+limiter = RateLimiter()
@@ -0,0 +1,102 @@
+import random
+from contextlib import contextmanager
+from time import time
+
+from flask import g, has_request_context, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.sql.expression import CompoundSelect, Select
+
+"""
+Read replica routing.
+
+With DATABASE_REPLICA_URLS set, the session sends SELECTs to one of the
+replicas (the same one for the whole session) and everything else to the
+primary. Once a session wrote, the rest of its transaction reads from the
+primary too, it must see its own changes.
+
+Replicas lag behind the primary. A request that committed a write marks the
+user's session cookie, and for DATABASE_REPLICA_STICKY_SECONDS every read
+of that user goes to the primary, whichever worker serves it. Other users
+may see the change a little later. Reads that must not lag, such as the
+ones filling a cache, go to the primary inside `with primary(session)`.
+"""
+
+REPLICA_BIND = "replica{}"
+
+SESSION_KEY = "_primary_until"
+
+def replica_binds(app):
+    return dict((REPLICA_BIND.format(i), url)
+                for i, url in enumerate(app.config["DATABASE_REPLICA_URLS"]))
+
+class RoutingSession(SignallingSession):
+    def _reads_from_primary(self, clause):
+        if self.info.get("wrote"):
+            return True
+        if not isinstance(clause, (Select, CompoundSelect)):
+            return True
+        # SELECT ... FOR UPDATE takes locks, on the primary
+        if getattr(clause, "_for_update_arg", None) is not None:
+            return True
+        if self.info.get("read_primary"):
+            return True
+        return has_request_context() and g.get("read_primary", False)
+
+    def get_bind(self, mapper = None, clause = None, **kw):
+        replicas = self.app.config["DATABASE_REPLICA_URLS"]
+        if not replicas or (mapper is not None and
+                            mapper.persist_selectable.info.get("bind_key") is not None):
+            return SignallingSession.get_bind(self, mapper, clause)
+
+        if self._flushing or self._reads_from_primary(clause):
+            if self._flushing or not isinstance(clause, (Select, CompoundSelect)):
+                self.info["wrote"] = True
+            return SignallingSession.get_bind(self, mapper, clause)
+
+        if "replica" not in self.info:
+            self.info["replica"] = REPLICA_BIND.format(random.randrange(len(replicas)))
+        return get_state(self.app).db.get_engine(self.app, bind = self.info["replica"])
+
+@event.listens_for(RoutingSession, "after_commit")
+def remember_write(db_session):
+    if db_session.info.pop("wrote", False) and has_request_context():
+        # The rest of the request reads its own writes too
+        g.database_wrote = g.read_primary = True
+
+@event.listens_for(RoutingSession, "after_rollback")
+def forget_write(db_session):
+    db_session.info.pop("wrote", None)
+
+@contextmanager
+def primary(db_session):
+    """
+    Send the reads of the block to the primary.
+    """
+    previous = db_session.info.get("read_primary", False)
+    db_session.info["read_primary"] = True
+    try:
+        yield db_session
+    finally:
+        db_session.info["read_primary"] = previous
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_ = RoutingSession, db = self, **options)
+
+def init_app(app):
+    binds = dict(app.config.get("SQLALCHEMY_BINDS") or {})
+    binds.update(replica_binds(app))
+    app.config["SQLALCHEMY_BINDS"] = binds
+    if not app.config["DATABASE_REPLICA_URLS"]:
+        return
+
+    @app.before_request
+    def read_own_writes():
+        g.read_primary = session.get(SESSION_KEY, 0) > time()
+
+    @app.after_request
+    def stick_to_primary(response):
+        if g.pop("database_wrote", False):
+            session[SESSION_KEY] = time() + app.config["DATABASE_REPLICA_STICKY_SECONDS"]
+        return response
@@ -0,0 +1,170 @@
+import re
+
+from sqlalchemy import DDL, column, func, literal_column, table, text
+
+from app import db
+from app.models import Post
+from app.pagination import KeysetPage, decode_score_cursor, encode_score_cursor, \
+    order_keyset, page_from_keys
+
+"""
+Full-text search over posts.
+
+The index lives in the database itself, so it is transactional with the
+posts and needs no extra service:
+    * SQLite - an FTS5 table over post.body, ranked by bm25
+    * PostgreSQL - a GIN index on to_tsvector(post.body), ranked by ts_rank
+
+Posts are indexed as they're inserted, by the mapper events below, and
+`flask search reindex` rebuilds the whole index. Results are ordered by
+score and paginated by a (score, id) cursor, like the timelines are by
+(timestamp, id).
+"""
+
+# Text search configuration of the PostgreSQL index, must match the migration.
+# "simple" doesn't stem, the posts are written in several languages.
+TS_CONFIG = "simple"
+
+# Words of a query that are searched for, the rest are ignored
+MAX_TERMS = 16
+
+class SqliteSearch(object):
+    # External content table, the text is read from post.body and not stored twice
+    create = DDL("CREATE VIRTUAL TABLE IF NOT EXISTS post_fts USING fts5("
+                 "body, content='post', content_rowid='id', "
+                 "tokenize='unicode61 remove_diacritics 2')")
+    drop = DDL("DROP TABLE IF EXISTS post_fts")
+
+    fts = table("post_fts", column("rowid"))
+
+    def add(self, connection, post):
+        connection.execute(text("INSERT INTO post_fts (rowid, body) VALUES (:id, :body)"),
+                           { "id": post.id, "body": post.body })
+
+    def remove(self, connection, post):
+        # An external content table must be told the text that goes away
+        connection.execute(text("INSERT INTO post_fts (post_fts, rowid, body) "
+                                "VALUES ('delete', :id, :body)"),
+                           { "id": post.id, "body": post.body })
+
+    def add_after(self, connection, post_id):
+        connection.execute(text("INSERT INTO post_fts (rowid, body) "
+                                "SELECT id, body FROM post WHERE id > :id"), { "id": post_id })
+
+    def reindex(self, connection):
+        connection.execute(text("INSERT INTO post_fts (post_fts) VALUES ('rebuild')"))
+
+    def match(self, words):
+        """
+        Returns a query of (post id, score) matching every word, along with
+        its id and score expressions. The higher the score the better.
+        """
+        # Quoted, so words are never read as FTS5 operators
+        terms = " ".join('"{}"'.format(word) for word in words)
+        fts_table = literal_column("post_fts")
+        score = -func.bm25(fts_table)
+        query = db.session.query(self.fts.c.rowid, score.label("score")).select_from(self.fts)\
+                          .filter(fts_table.op("MATCH")(terms))
+        return query, self.fts.c.rowid, score
+
+class PostgresSearch(object):
+    create = DDL("CREATE INDEX IF NOT EXISTS ix_post_body_fts ON post "
+                 "USING gin (to_tsvector('{}', body))".format(TS_CONFIG))
+    drop = DDL("DROP INDEX IF EXISTS ix_post_body_fts")
+
+    # The GIN index is maintained by PostgreSQL along with the table
+    def add(self, connection, post):
+        pass
+
+    def remove(self, connection, post):
+        pass
+
+    def add_after(self, connection, post_id):
+        pass
+
+    def reindex(self, connection):
+        connection.execute(text("REINDEX INDEX ix_post_body_fts"))
+
+    def match(self, words):
+        # Spelled out like the index expression, or the index isn't used
+        config = literal_column("'{}'".format(TS_CONFIG))
+        vector = func.to_tsvector(config, Post.body)
+        tsquery = func.plainto_tsquery(config, " ".join(words))
+        # ts_rank is a real, which the double precision cursor never equals
+        score = db.cast(func.ts_rank(vector, tsquery), db.Float(precision = 53))
+        query = db.session.query(Post.id, score.label("score")).filter(vector.op("@@")(tsquery))
+        return query, Post.id, score
+
+BACKENDS = {
+    "sqlite": SqliteSearch(),
+    "postgresql": PostgresSearch(),
+}
+
+# db.create_all() and drop_all() handle the index too, e.g. in the tests
+for dialect, backend in BACKENDS.items():
+    db.event.listen(Post.__table__, "after_create", backend.create.execute_if(dialect = dialect))
+    db.event.listen(Post.__table__, "before_drop", backend.drop.execute_if(dialect = dialect))
+
+@db.event.listens_for(Post, "after_insert")
+def index_post(mapper, connection, post):
+    # Runs inside the flush, in the same transaction as the INSERT
+    backend = BACKENDS.get(connection.dialect.name)
+    if backend is not None:
+        backend.add(connection, post)
+
+@db.event.listens_for(Post, "after_delete")
+def unindex_post(mapper, connection, post):
+    backend = BACKENDS.get(connection.dialect.name)
+    if backend is not None:
+        backend.remove(connection, post)
+
+class SearchPage(KeysetPage):
+    def __init__(self, items, has_next, has_prev, scores):
+        super(SearchPage, self).__init__(items, has_next, has_prev)
+        self.scores = scores
+
+    def cursor(self, item):
+        return encode_score_cursor(self.scores[item.id], item.id)
+
+class Search(object):
+    @property
+    def backend(self):
+        backend = BACKENDS.get(db.engine.dialect.name)
+        if backend is None:
+            raise RuntimeError("Search needs SQLite or PostgreSQL, not {}".format(
+                db.engine.dialect.name))
+        return backend
+
+    def page(self, terms, per_page, before = None, after = None):
+        """
+        One page of the posts matching every word of `terms`, best first.
+        """
+        words = re.findall(r"\w+", terms or "")[:MAX_TERMS]
+        if not words:
+            return SearchPage([], False, False, {})
+
+        before = decode_score_cursor(before)
+        after = decode_score_cursor(after) if before is None else None
+        query, id_col, score = self.backend.match(words)
+        rows = order_keyset(query, score, id_col, before, after).limit(per_page + 1).all()
+        keys = page_from_keys(rows, per_page, before, after)
+
+        scores = dict((id, score) for id, score in keys.items)
+        posts = Post.query.options(db.joinedload(Post.author))\
+                          .filter(Post.id.in_(list(scores))).all() if scores else []
+        by_id = dict((post.id, post) for post in posts)
+        return SearchPage([by_id[id] for id, _ in keys.items if id in by_id],
+                          keys.has_next, keys.has_prev, scores)
+
+    def add_after(self, connection, post_id):
+        """
+        Index the posts with an id above `post_id`, for posts inserted
+        without the ORM (and its events).
+        """
+        self.backend.add_after(connection, post_id)
+
+    def reindex(self):
+        with db.engine.begin() as connection:
+            self.backend.reindex(connection)
+
+search = Search()
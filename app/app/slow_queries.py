@@ -0,0 +1,170 @@
+import json
+import logging
+import os
+from collections import OrderedDict
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from queue import Full, Queue
+from threading import Lock, Thread
+from time import perf_counter, time
+
+from flask import current_app, has_app_context, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+"""
+Slow query log.
+
+With SLOW_QUERY_THRESHOLD_MS set, every statement that takes longer is
+written to SLOW_QUERY_LOG as a JSON line: its duration, the endpoint that
+sent it, the SQL, its parameters and its plan, EXPLAIN (EXPLAIN QUERY PLAN
+on SQLite) of the same statement. Plans are fetched by a background thread
+of each worker on a connection of its own, the request never waits for
+them. The queue of that thread is bounded, records are dropped rather than
+queued when the database is too slow to keep up, and a statement is
+explained at most once per SLOW_QUERY_EXPLAIN_INTERVAL seconds.
+
+The log rotates at SLOW_QUERY_LOG_MAX_BYTES, one old file is kept. Parameters
+are logged as sent and may contain personal data, keep the file private.
+"""
+
+# Plans are only asked for statements that can't write
+EXPLAINABLE = ("select", "with")
+
+# Longest parameter value logged, in characters
+MAX_PARAMETER_LENGTH = 200
+
+def explain(connection, statement, parameters):
+    if connection.dialect.name == "sqlite":
+        sql = "EXPLAIN QUERY PLAN " + statement
+    else:
+        sql = "EXPLAIN " + statement
+    return [" ".join(str(column) for column in row)
+            for row in connection.exec_driver_sql(sql, parameters)]
+
+def loggable(parameters):
+    def shorten(value):
+        value = repr(value)
+        if len(value) > MAX_PARAMETER_LENGTH:
+            return value[:MAX_PARAMETER_LENGTH] + "..."
+        return value
+    if isinstance(parameters, dict):
+        return dict((key, shorten(value)) for key, value in parameters.items())
+    return [shorten(value) for value in parameters or ()]
+
+class SlowQueryLog(object):
+    def __init__(self, app):
+        self.threshold = app.config["SLOW_QUERY_THRESHOLD_MS"] / 1000.0
+        self.explain_interval = app.config["SLOW_QUERY_EXPLAIN_INTERVAL"]
+        directory = os.path.dirname(app.config["SLOW_QUERY_LOG"])
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.handler = RotatingFileHandler(app.config["SLOW_QUERY_LOG"], delay = True,
+                                           maxBytes = app.config["SLOW_QUERY_LOG_MAX_BYTES"],
+                                           backupCount = 1)
+        self.queue = Queue(app.config["SLOW_QUERY_QUEUE_SIZE"])
+        self.lock = Lock()
+        # statement -> last time it was explained, oldest first
+        self.explained = OrderedDict()
+        self.dropped = 0
+        self.thread = None
+        self.pid = None
+
+    def record(self, engine, statement, parameters, duration, executemany):
+        entry = {
+            "time": datetime.utcnow().isoformat(),
+            "ms": round(duration * 1000, 3),
+            "endpoint": request.endpoint if has_request_context() else None,
+            "sql": statement,
+            "params": [loggable(batch) for batch in parameters] if executemany
+                      else loggable(parameters),
+        }
+        self.ensure_worker()
+        try:
+            self.queue.put_nowait((engine, entry, parameters, executemany))
+        except Full:
+            self.dropped += 1
+
+    def ensure_worker(self):
+        # Threads don't survive uWSGI forking workers, start one per process
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is not None and self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.thread = Thread(target = self.run, name = "slow-query-log", daemon = True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            engine, entry, parameters, executemany = self.queue.get()
+            try:
+                if not executemany and self._should_explain(entry["sql"]):
+                    with engine.connect() as connection:
+                        entry["plan"] = explain(connection, entry["sql"], parameters)
+            except Exception as e:
+                entry["plan_error"] = str(e)
+            try:
+                self.handler.emit(logging.makeLogRecord({ "msg": json.dumps(entry) }))
+            finally:
+                self.queue.task_done()
+
+    def _should_explain(self, statement):
+        if not statement.lstrip().lower().startswith(EXPLAINABLE):
+            return False
+        now = time()
+        last = self.explained.get(statement)
+        if last is not None and now - last < self.explain_interval:
+            return False
+        self.explained[statement] = now
+        self.explained.move_to_end(statement)
+        while len(self.explained) > 1000:
+            self.explained.popitem(last = False)
+        return True
+
+    def flush(self):
+        """
+        Wait until every queued statement is written.
+        """
+        if self.thread is not None and self.pid == os.getpid():
+            self.queue.join()
+
+class SlowQueries(object):
+    def __init__(self, app = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if app.config["SLOW_QUERY_THRESHOLD_MS"] > 0:
+            app.extensions["slow_queries"] = SlowQueryLog(app)
+
+    @property
+    def log(self):
+        return current_app.extensions["slow_queries"]
+
+    def flush(self):
+        self.log.flush()
+
+def current_log():
+    # Statements sent outside of the app, such as the EXPLAINs, aren't timed
+    if not has_app_context():
+        return None
+    return current_app.extensions.get("slow_queries")
+
+@event.listens_for(Engine, "before_cursor_execute")
+def start_statement(conn, cursor, statement, parameters, context, executemany):
+    if current_log() is not None:
+        conn.info.setdefault("_slow_query_start", []).append(perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def end_statement(conn, cursor, statement, parameters, context, executemany):
+    log = current_log()
+    starts = conn.info.get("_slow_query_start")
+    if log is None or not starts:
+        return
+    duration = perf_counter() - starts.pop()
+    if duration >= log.threshold:
+        log.record(conn.engine, statement, parameters, duration, executemany)
+
+slow_queries = SlowQueries()
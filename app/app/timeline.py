@@ -0,0 +1,436 @@
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from threading import Lock
+
+from flask import current_app
+
+from app import db
+from app.jobs import jobs
+from app.models import Post, TimelineEntry, User, followers
+from app.pagination import decode_cursor, order_keyset, page_from_keys, paginate_keyset
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+"""
+Fan-out-on-write home timelines.
+
+When a post is created its (timestamp, id) key is pushed to the timeline of
+the author and of every follower, so reading a home page is a range scan
+over a single user's entries instead of a join over `followers`.
+
+Authors with more than TIMELINE_FANOUT_THRESHOLD followers are not fanned
+out (one post would mean that many writes); their posts are merged in at
+read time instead. Timelines are capped at TIMELINE_MAX_ENTRIES, walking
+past the end of a capped timeline falls back to User.followed_posts().
+
+Keys are (timestamp, post_id) tuples, the same ordering used by the cursor
+pagination in app.pagination.
+"""
+
+def author_keys(author_id, limit = None):
+    query = db.session.query(Post.timestamp, Post.id).filter(Post.user_id == author_id)\
+                      .order_by(Post.timestamp.desc(), Post.id.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    return [tuple(row) for row in query]
+
+class DatabaseBackend(object):
+    """
+    Entries live in the timeline_entry table and are written in the same
+    transaction as the post or follow that produced them. Existing timelines
+    are backfilled by the migration, so every user counts as built.
+    A fan-out only inserts, a timeline may go over the cap until the
+    periodic trim_timelines job, ranking the entries of 10000 followers
+    would take seconds in the request.
+    """
+    table = TimelineEntry.__table__
+
+    # Same statement as the migration that created the table
+    REBUILD = """
+        INSERT INTO timeline_entry (user_id, post_id, timestamp)
+        SELECT reader_id, post_id, timestamp FROM (
+            SELECT readers.reader_id, post.id AS post_id, post.timestamp,
+                   row_number() OVER (PARTITION BY readers.reader_id
+                                      ORDER BY post.timestamp DESC, post.id DESC) AS rank
+            FROM (
+                SELECT id AS reader_id, id AS author_id FROM "user" {users}
+                UNION
+                SELECT follower_id, followed_id FROM followers {follows}
+            ) AS readers
+            JOIN post ON post.user_id = readers.author_id
+        ) AS ranked
+        WHERE rank <= :max_entries
+    """
+
+    def built(self, user_ids):
+        return set(user_ids)
+
+    def reset(self, user_id, keys):
+        db.session.execute(self.table.delete().where(self.table.c.user_id == user_id))
+        self.add_many(user_id, keys)
+
+    def add(self, user_ids, key):
+        timestamp, post_id = key
+        if user_ids:
+            db.session.execute(self.table.insert(), [
+                { "user_id": user_id, "post_id": post_id, "timestamp": timestamp }
+                for user_id in user_ids])
+
+    def add_many(self, user_id, keys):
+        if not keys:
+            return
+        # Re-following someone may bring back posts that are still there
+        db.session.execute(self.table.delete().where(db.and_(
+            self.table.c.user_id == user_id,
+            self.table.c.post_id.in_([post_id for _, post_id in keys]))))
+        db.session.execute(self.table.insert(), [
+            { "user_id": user_id, "post_id": post_id, "timestamp": timestamp }
+            for timestamp, post_id in keys])
+        self._trim([user_id])
+
+    def trim(self, max_entries, chunk_size = 500):
+        table = self.table
+        over = [user_id for (user_id,) in db.session.query(table.c.user_id)
+                .group_by(table.c.user_id).having(db.func.count() > max_entries)]
+        self._trim(over, max_entries, chunk_size)
+        return len(over)
+
+    def _trim(self, user_ids, max_entries = None, chunk_size = 500):
+        # Delete all but the newest max_entries entries of each user
+        if max_entries is None:
+            max_entries = current_app.config["TIMELINE_MAX_ENTRIES"]
+        table = self.table
+        rank = db.func.row_number().over(partition_by = table.c.user_id,
+                                         order_by = (table.c.timestamp.desc(),
+                                                     table.c.post_id.desc()))
+        for i in range(0, len(user_ids), chunk_size):
+            ranked = db.select([table.c.user_id, table.c.post_id, rank.label("rank")])\
+                       .where(table.c.user_id.in_(user_ids[i:i + chunk_size])).subquery()
+            stale = db.select([ranked.c.user_id, ranked.c.post_id])\
+                      .where(ranked.c.rank > max_entries)
+            db.session.execute(table.delete().where(
+                db.tuple_(table.c.user_id, table.c.post_id).in_(stale)))
+
+    def rebuild_all(self, max_entries, user_ids = None, chunk_size = 500):
+        if user_ids is None:
+            db.session.execute(self.table.delete())
+            db.session.execute(db.text(self.REBUILD.format(users = "", follows = "")),
+                               { "max_entries": max_entries })
+            return
+        statement = db.text(self.REBUILD.format(users = "WHERE id IN :ids",
+                                                follows = "WHERE follower_id IN :ids"))\
+                      .bindparams(db.bindparam("ids", expanding = True))
+        user_ids = sorted(user_ids)
+        for i in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[i:i + chunk_size]
+            db.session.execute(self.table.delete().where(self.table.c.user_id.in_(chunk)))
+            db.session.execute(statement, { "max_entries": max_entries, "ids": chunk })
+
+    def remove_author(self, user_id, author_id):
+        authored = db.select([Post.id]).where(Post.user_id == author_id)
+        db.session.execute(self.table.delete().where(db.and_(
+            self.table.c.user_id == user_id, self.table.c.post_id.in_(authored))))
+
+    def range(self, user_id, before, after, limit):
+        query = db.session.query(self.table.c.timestamp, self.table.c.post_id)\
+                          .filter(self.table.c.user_id == user_id)
+        query = order_keyset(query, self.table.c.timestamp, self.table.c.post_id, before, after)
+        return [tuple(row) for row in query.limit(limit)]
+
+    def count(self, user_id, limit):
+        # Bounded count, we only ever need to know if the cap was reached
+        capped = db.select([self.table.c.post_id]).where(self.table.c.user_id == user_id)\
+                   .limit(limit).subquery()
+        return db.session.execute(db.select([db.func.count()]).select_from(capped)).scalar()
+
+class MemoryBackend(object):
+    """
+    Per-process sorted lists, for development and single worker setups.
+    Timelines are built lazily, the first time their owner reads them.
+    """
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = Lock()
+        self.timelines = {}
+
+    def built(self, user_ids):
+        return set(user_id for user_id in user_ids if user_id in self.timelines)
+
+    def reset(self, user_id, keys):
+        with self.lock:
+            self.timelines[user_id] = sorted(set(keys))[-self.max_entries:]
+
+    def _insert(self, entries, key):
+        i = bisect_left(entries, key)
+        if i == len(entries) or entries[i] != key:
+            entries.insert(i, key)
+        if len(entries) > self.max_entries:
+            del entries[:len(entries) - self.max_entries]
+
+    def add(self, user_ids, key):
+        with self.lock:
+            for user_id in user_ids:
+                # Timelines that were never built will be built from scratch on read
+                if user_id in self.timelines:
+                    self._insert(self.timelines[user_id], key)
+
+    def add_many(self, user_id, keys):
+        with self.lock:
+            entries = self.timelines.get(user_id)
+            if entries is not None:
+                for key in keys:
+                    self._insert(entries, key)
+
+    def rebuild_all(self, max_entries, user_ids = None):
+        with self.lock:
+            if user_ids is None:
+                self.timelines.clear()
+            for user_id in user_ids or ():
+                self.timelines.pop(user_id, None)
+
+    def remove_author(self, user_id, author_id):
+        keys = set(author_keys(author_id))
+        with self.lock:
+            entries = self.timelines.get(user_id)
+            if entries is not None:
+                entries[:] = [key for key in entries if key not in keys]
+
+    def range(self, user_id, before, after, limit):
+        with self.lock:
+            entries = self.timelines.get(user_id, [])
+            if after is not None:
+                start = bisect_right(entries, after)
+                return entries[start:start + limit]
+            end = bisect_left(entries, before) if before is not None else len(entries)
+            return entries[max(0, end - limit):end][::-1]
+
+    def count(self, user_id, limit):
+        return min(len(self.timelines.get(user_id, [])), limit)
+
+    def trim(self, max_entries):
+        # Capped by every write
+        return 0
+
+class RedisBackend(object):
+    """
+    One sorted set per user, shared by every worker. All members have the
+    same score and are fixed width "<timestamp>:<post id>" strings, so the
+    lexicographic order of the set is the (timestamp, id) order.
+    A built timeline always holds the empty string as a marker member.
+    """
+    MARKER = ""
+    TIMESTAMP_FORMAT = "%Y%m%d%H%M%S%f"
+
+    def __init__(self, url, max_entries):
+        if redis is None:
+            raise RuntimeError("The redis timeline backend requires the redis package")
+        self.client = redis.Redis.from_url(url)
+        self.max_entries = max_entries
+
+    def _name(self, user_id):
+        return "timeline:{}".format(user_id)
+
+    def _member(self, key):
+        timestamp, post_id = key
+        return "{}:{:020d}".format(timestamp.strftime(self.TIMESTAMP_FORMAT), post_id)
+
+    def _key(self, member):
+        timestamp, post_id = member.decode("ascii").split(":")
+        return datetime.strptime(timestamp, self.TIMESTAMP_FORMAT), int(post_id)
+
+    def _trim(self, pipe, user_id, max_entries):
+        # Rank 0 is the marker, keep it and the newest max_entries members
+        pipe.zremrangebyrank(self._name(user_id), 1, -(max_entries + 1))
+
+    def built(self, user_ids):
+        user_ids = list(user_ids)
+        pipe = self.client.pipeline(transaction = False)
+        for user_id in user_ids:
+            pipe.exists(self._name(user_id))
+        return set(user_id for user_id, exists in zip(user_ids, pipe.execute()) if exists)
+
+    def reset(self, user_id, keys):
+        mapping = dict((self._member(key), 0) for key in keys)
+        mapping[self.MARKER] = 0
+        pipe = self.client.pipeline()
+        pipe.delete(self._name(user_id))
+        pipe.zadd(self._name(user_id), mapping)
+        self._trim(pipe, user_id, self.max_entries)
+        pipe.execute()
+
+    def add(self, user_ids, key):
+        member = self._member(key)
+        pipe = self.client.pipeline(transaction = False)
+        for user_id in self.built(user_ids):
+            pipe.zadd(self._name(user_id), { member: 0 })
+            self._trim(pipe, user_id, self.max_entries)
+        pipe.execute()
+
+    def add_many(self, user_id, keys):
+        if not keys or not self.built([user_id]):
+            return
+        pipe = self.client.pipeline(transaction = False)
+        pipe.zadd(self._name(user_id), dict((self._member(key), 0) for key in keys))
+        self._trim(pipe, user_id, self.max_entries)
+        pipe.execute()
+
+    def rebuild_all(self, max_entries, user_ids = None):
+        # Rebuilt lazily, like after a flush of the server
+        if user_ids is None:
+            names = list(self.client.scan_iter(match = self._name("*"), count = 1000))
+        else:
+            names = [self._name(user_id) for user_id in user_ids]
+        for i in range(0, len(names), 1000):
+            self.client.delete(*names[i:i + 1000])
+
+    def remove_author(self, user_id, author_id):
+        members = [self._member(key) for key in author_keys(author_id)]
+        if members:
+            self.client.zrem(self._name(user_id), *members)
+
+    def range(self, user_id, before, after, limit):
+        name = self._name(user_id)
+        if after is not None:
+            members = self.client.zrangebylex(name, "(" + self._member(after), "+",
+                                              start = 0, num = limit)
+        else:
+            upper = "(" + self._member(before) if before is not None else "+"
+            # "(" excludes the empty marker member
+            members = self.client.zrevrangebylex(name, upper, "(", start = 0, num = limit)
+        return [self._key(member) for member in members]
+
+    def count(self, user_id, limit):
+        return min(max(self.client.zcard(self._name(user_id)) - 1, 0), limit)
+
+    def trim(self, max_entries):
+        # Capped by every write
+        return 0
+
+class Timeline(object):
+    def __init__(self, app = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        name = app.config["TIMELINE_BACKEND"]
+        max_entries = app.config["TIMELINE_MAX_ENTRIES"]
+        if name == "database":
+            backend = DatabaseBackend()
+        elif name == "memory":
+            backend = MemoryBackend(max_entries)
+        elif name == "redis":
+            backend = RedisBackend(app.config["REDIS_URL"], max_entries)
+        else:
+            raise ValueError("Unknown timeline backend: {}".format(name))
+        app.extensions["timeline"] = backend
+
+    @property
+    def backend(self):
+        return current_app.extensions["timeline"]
+
+    def is_hybrid(self, user):
+        """
+        True if the user has too many followers to fan their posts out on write.
+        """
+        threshold = current_app.config["TIMELINE_FANOUT_THRESHOLD"]
+        return bool(threshold) and user.followers_count > threshold
+
+    def hybrid_followed_ids(self, user):
+        # Followed authors whose posts are merged in at read time
+        threshold = current_app.config["TIMELINE_FANOUT_THRESHOLD"]
+        if not threshold:
+            return []
+        rows = db.session.query(followers.c.followed_id)\
+                         .join(User, User.id == followers.c.followed_id)\
+                         .filter(followers.c.follower_id == user.id)\
+                         .filter(User.followers_count > threshold)
+        return [followed_id for (followed_id,) in rows]
+
+    def rebuild(self, user):
+        """
+        Materialize a timeline from scratch using fan-out-on-read.
+        """
+        keys = user.followed_posts().with_entities(Post.timestamp, Post.id)\
+                   .limit(current_app.config["TIMELINE_MAX_ENTRIES"]).all()
+        self.backend.reset(user.id, [tuple(key) for key in keys])
+
+    def rebuild_all(self, user_ids = None):
+        """
+        Rebuild every timeline, or those of `user_ids`, e.g. after posts or
+        follows were loaded in bulk without going through fan_out() and
+        on_follow().
+        """
+        self.backend.rebuild_all(current_app.config["TIMELINE_MAX_ENTRIES"], user_ids)
+
+    def trim(self):
+        """
+        Bring every timeline back to TIMELINE_MAX_ENTRIES entries, returns
+        the number of timelines trimmed.
+        """
+        return self.backend.trim(current_app.config["TIMELINE_MAX_ENTRIES"])
+
+    def fan_out(self, post):
+        """
+        Push a new post to its author's timeline and, unless the author is
+        too popular, to every follower's. The post must have been flushed.
+        """
+        recipients = [post.user_id]
+        if not self.is_hybrid(post.author):
+            rows = db.session.query(followers.c.follower_id)\
+                             .filter(followers.c.followed_id == post.user_id)
+            recipients.extend(follower_id for (follower_id,) in rows)
+        self.backend.add(recipients, (post.timestamp, post.id))
+
+    def on_follow(self, user, followed):
+        if not self.is_hybrid(followed):
+            keys = author_keys(followed.id, limit = current_app.config["TIMELINE_MAX_ENTRIES"])
+            self.backend.add_many(user.id, keys)
+
+    def on_unfollow(self, user, followed):
+        self.backend.remove_author(user.id, followed.id)
+
+    def page(self, user, per_page, before = None, after = None):
+        """
+        Cursor paginated home timeline, see app.pagination.paginate_keyset.
+        """
+        backend = self.backend
+        max_entries = current_app.config["TIMELINE_MAX_ENTRIES"]
+
+        if not backend.built([user.id]):
+            self.rebuild(user)
+        # Capped by the writes, never trimmed here: a GET doesn't commit
+        count = backend.count(user.id, max_entries)
+
+        before_key = decode_cursor(before)
+        after_key = decode_cursor(after) if before_key is None else None
+
+        keys = backend.range(user.id, before_key, after_key, per_page + 1)
+        if len(keys) <= per_page and after_key is None and count >= max_entries:
+            # Walked past the end of a capped timeline, older posts are only
+            # reachable by fan-out-on-read
+            return paginate_keyset(user.followed_posts(), Post, per_page,
+                                   before = before, after = after)
+
+        hybrid_ids = self.hybrid_followed_ids(user)
+        if hybrid_ids:
+            query = db.session.query(Post.timestamp, Post.id).filter(Post.user_id.in_(hybrid_ids))
+            query = order_keyset(query, Post.timestamp, Post.id, before_key, after_key)
+            keys = set(keys)
+            keys.update(tuple(row) for row in query.limit(per_page + 1))
+            keys = sorted(keys, reverse = after_key is None)[:per_page + 1]
+
+        posts = dict((post.id, post) for post in
+                     Post.query.options(db.joinedload(Post.author))
+                               .filter(Post.id.in_([post_id for _, post_id in keys])))
+        items = [posts[post_id] for _, post_id in keys if post_id in posts]
+        return page_from_keys(items, per_page, before_key, after_key)
+
+timeline = Timeline()
+
+@jobs.task("trim_timelines", every = "TIMELINE_TRIM_INTERVAL")
+def trim_timelines(payload):
+    timeline.trim()
+    db.session.commit()
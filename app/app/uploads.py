@@ -0,0 +1,270 @@
+import os
+import shutil
+from datetime import datetime, timedelta
+from hashlib import sha256
+from tempfile import TemporaryFile
+from time import time
+from uuid import UUID, uuid4
+
+from flask import current_app, Request
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import secure_filename
+
+from app import db
+from app.jobs import jobs
+from app.models import Upload
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+"""
+Chunked image uploads.
+
+upload.html makes Dropzone send files in UPLOAD_CHUNK_SIZE chunks, so a
+request body is never bigger than a chunk and MAX_CONTENT_LENGTH rejects
+anything else before it's read. Werkzeug spools the chunk to an unnamed
+file in UPLOAD_FOLDER instead of memory, and the chunk is then copied at
+its offset into `<upload id>.part`. Chunks can be retried in any order,
+and concurrently: the request that moves the upload from "receiving" to
+"processing" hands the file to the job queue, the others only answer.
+Validation, EXIF stripping and thumbnails happen in `flask worker`, never in
+the request. Uploads whose chunks stopped arriving for UPLOAD_EXPIRY seconds
+are expired, and their files removed, by a periodic job.
+
+Layout of UPLOAD_FOLDER:
+    tmp/ - request bodies being parsed
+    incoming/ - uploads being received, or waiting to be processed
+    images/ - processed images and their thumbnails
+"""
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename = None,
+                         content_length = None):
+        # Spool uploaded files to disk, never to memory
+        return TemporaryFile(dir = upload_dir("tmp"))
+
+class UploadError(Exception):
+    def __init__(self, message, status = 400):
+        super(UploadError, self).__init__(message)
+        self.status = status
+
+def upload_dir(name):
+    directory = os.path.join(current_app.config["UPLOAD_FOLDER"], name)
+    os.makedirs(directory, exist_ok = True)
+    return directory
+
+def extension(filename):
+    return filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+
+def receive_chunk(user, file, form):
+    """
+    Store one Dropzone chunk, a file sent without chunking counts as a single
+    chunk. Returns the Upload, whose status moves to "processing" once the
+    last chunk is in.
+    """
+    config = current_app.config
+    filename = secure_filename(file.filename or "")
+    if extension(filename) not in config["UPLOAD_EXTENSIONS"]:
+        raise UploadError("File type not allowed")
+
+    try:
+        upload_id = str(UUID(form.get("dzuuid") or ""))
+    except ValueError:
+        if form.get("dzuuid"):
+            raise UploadError("Invalid upload id")
+        upload_id = None
+    index = form.get("dzchunkindex", 0, type = int)
+    total_chunks = form.get("dztotalchunkcount", 1, type = int)
+    offset = form.get("dzchunkbyteoffset", 0, type = int)
+    total_size = form.get("dztotalfilesize", type = int)
+
+    # The size is declared with the first chunk, refuse before writing anything
+    if total_size is not None and total_size > config["UPLOAD_MAX_SIZE"]:
+        raise UploadError("File too large", 413)
+    if index < 0 or index >= total_chunks or offset < 0:
+        raise UploadError("Invalid chunk")
+
+    if upload_id is None:
+        upload_id = str(uuid4())
+    upload = Upload.query.get(upload_id)
+    if upload is None:
+        upload = Upload(id = upload_id, user_id = user.id, filename = filename,
+                        size = total_size, status = "receiving")
+        db.session.add(upload)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # Another chunk of the same upload created it first
+            db.session.rollback()
+            upload = Upload.query.get(upload_id)
+    if upload.user_id != user.id or upload.status != "receiving":
+        raise UploadError("Upload already exists", 409)
+
+    incoming = upload_dir("incoming")
+    part = os.path.join(incoming, upload_id + ".part")
+    file.stream.seek(0, os.SEEK_END)
+    length = file.stream.tell()
+    file.stream.seek(0)
+    if offset + length > config["UPLOAD_MAX_SIZE"]:
+        raise UploadError("File too large", 413)
+
+    # Created if missing but never truncated, keeps the chunks already
+    # written whatever order (or how many at once) they arrive in
+    with os.fdopen(os.open(part, os.O_RDWR | os.O_CREAT, 0o644), "r+b") as f:
+        f.seek(offset)
+        shutil.copyfileobj(file.stream, f, config["UPLOAD_COPY_BUFFER"])
+
+    # One line per received chunk, O_APPEND writes of a line don't interleave
+    received_path = os.path.join(incoming, upload_id + ".chunks")
+    with open(received_path, "a") as f:
+        f.write("{}\n".format(index))
+    with open(received_path) as f:
+        received = set(int(line) for line in f if line.strip())
+
+    if len(received) >= total_chunks:
+        finish_upload(upload, part, received_path)
+    return upload
+
+def finish_upload(upload, part, received_path):
+    # The last chunks may arrive together, only the request whose UPDATE
+    # matches moves the files, the row stays locked until it commits
+    claimed = Upload.query.filter_by(id = upload.id, status = "receiving")\
+                    .update({ "status": "processing" }, synchronize_session = False)
+    if not claimed:
+        db.session.rollback()
+        db.session.refresh(upload)
+        return
+    path = incoming_path(upload)
+    os.replace(part, path)
+    os.remove(received_path)
+    upload.size = os.path.getsize(path)
+    upload.status = "processing"
+    db.session.commit()
+    jobs.enqueue("process_upload", { "id": upload.id })
+
+def incoming_path(upload):
+    return os.path.join(upload_dir("incoming"),
+                        "{}.{}".format(upload.id, extension(upload.filename)))
+
+def file_digest(path):
+    digest = sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(64 * 2 ** 10), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def image_path(upload, size = None):
+    name = upload.id if size is None else "{}_{}".format(upload.id, size)
+    return os.path.join(upload_dir("images"), "{}.{}".format(name, extension(upload.filename)))
+
+@jobs.task("process_upload")
+def process_upload(payload):
+    # Runs in `flask worker`
+    if Image is None:
+        raise RuntimeError("Processing uploads requires the Pillow package")
+
+    upload = Upload.query.get(payload["id"])
+    if upload is None or upload.status != "processing":
+        return
+    source = incoming_path(upload)
+
+    try:
+        with Image.open(source) as image:
+            image.verify()
+        with Image.open(source) as image:
+            if image.format.lower() not in current_app.config["UPLOAD_FORMATS"]:
+                raise ValueError("Unexpected image format {}".format(image.format))
+            image = ImageOps.exif_transpose(image)
+            # Copying the pixels alone drops EXIF and every other metadata
+            clean = Image.frombytes(image.mode, image.size, image.tobytes())
+            if image.mode == "P":
+                clean.putpalette(image.getpalette())
+    except (OSError, ValueError, SyntaxError) as e:
+        current_app.logger.info("Rejected upload %s: %s", upload.id, e)
+        upload.status = "rejected"
+        db.session.commit()
+        os.remove(source)
+        return
+    except Image.DecompressionBombError as e:
+        # Retrying wouldn't shrink it
+        current_app.logger.warning("Upload %s failed: %s", upload.id, e)
+        upload.status = "failed"
+        db.session.commit()
+        os.remove(source)
+        return
+
+    # The stored files are served with the type their extension names, which
+    # needn't be the format that was uploaded
+    image_format = Image.registered_extensions()["." + extension(upload.filename)]
+    if image_format == "JPEG" and clean.mode not in ("L", "RGB", "CMYK"):
+        clean = clean.convert("RGB")
+    elif image_format == "PNG" and clean.mode == "CMYK":
+        clean = clean.convert("RGB")
+    sizes = current_app.config["UPLOAD_THUMBNAIL_SIZES"]
+    try:
+        clean.save(image_path(upload), format = image_format)
+        for size in sizes:
+            thumbnail = clean.copy()
+            thumbnail.thumbnail((size, size))
+            thumbnail.save(image_path(upload, size), format = image_format)
+    except (OSError, ValueError) as e:
+        current_app.logger.warning("Upload %s failed: %s", upload.id, e)
+        for path in [image_path(upload)] + [image_path(upload, size) for size in sizes]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        upload.status = "failed"
+        db.session.commit()
+        os.remove(source)
+        return
+
+    # Addresses the derivatives, see app.derivatives
+    upload.digest = file_digest(image_path(upload))
+    upload.status = "ready"
+    db.session.commit()
+    os.remove(source)
+
+@jobs.task("expire_uploads", every = "UPLOAD_SWEEP_INTERVAL")
+def expire_uploads(payload):
+    """
+    Expire the uploads that received no chunk for UPLOAD_EXPIRY seconds and
+    remove the chunk files no receiving upload owns.
+    """
+    expiry = current_app.config["UPLOAD_EXPIRY"]
+    cutoff = time() - expiry
+    incoming = upload_dir("incoming")
+
+    def idle(upload_id):
+        # The part file is written by every chunk
+        try:
+            return os.path.getmtime(os.path.join(incoming, upload_id + ".part")) < cutoff
+        except FileNotFoundError:
+            return True
+
+    started = Upload.query.filter(Upload.status == "receiving",
+                                  Upload.timestamp < datetime.utcnow() - timedelta(seconds = expiry))
+    stale = [upload.id for upload in started if idle(upload.id)]
+    if stale:
+        Upload.query.filter(Upload.id.in_(stale), Upload.status == "receiving")\
+              .update({ "status": "expired" }, synchronize_session = False)
+        db.session.commit()
+
+    chunk_files = {}
+    for entry in os.scandir(incoming):
+        upload_id, ext = os.path.splitext(entry.name)
+        if ext in (".part", ".chunks") and entry.stat().st_mtime < cutoff:
+            chunk_files.setdefault(upload_id, []).append(entry.path)
+    if not chunk_files:
+        return
+    receiving = set(upload_id for upload_id, in db.session.query(Upload.id).filter(
+        Upload.id.in_(list(chunk_files)), Upload.status == "receiving"))
+    for upload_id, paths in chunk_files.items():
+        if upload_id not in receiving:
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
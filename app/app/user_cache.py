@@ -0,0 +1,99 @@
+from time import time
+
+from flask import current_app, has_request_context, session
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+
+from app import db
+from app.cache import make_cache
+from app.replicas import primary
+
+"""
+Cache of the session user.
+
+Flask-Login loads current_user on every authenticated request. The profile
+columns of the user are kept in the cache for USER_CACHE_TTL seconds and
+merged into the SQLAlchemy session without a query. The other columns
+(password hash, counters, last_seen) are left unloaded, the first access
+to one of them loads them as usual.
+
+Every entry carries a version stamp, invalidate() raises the required one
+when the profile changes. The required version is kept both in the cache
+and in the session cookie of the user who made the change, so that user
+never sees a stale profile, whichever uWSGI worker serves the next request
+and whatever the backend. Other sessions see the change once the version
+reaches their worker, immediately since the backend must be shared (uwsgi,
+redis, filesystem) when there is more than one worker.
+"""
+
+# Columns of the user that are cached
+FIELDS = ("id", "username", "email", "about_me")
+
+SESSION_KEY = "_user_version"
+
+class UserCache(object):
+    def __init__(self, app = None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions["users"] = make_cache(app, "users", shared = True)
+
+    @property
+    def cache(self):
+        return current_app.extensions["users"]
+
+    def _keys(self, id):
+        return "user:{}".format(id), "user-version:{}".format(id)
+
+    def _required_version(self, versions):
+        # The highest stamp known, a stamp is the time of the change
+        known = [version for version in versions if version is not None]
+        return max(known) if known else 0.0
+
+    def load(self, model, id):
+        """
+        The instance of `model` with primary key `id`, attached to the
+        session, from the cache when it has a recent enough entry.
+        """
+        entry_key, version_key = self._keys(id)
+        found = self.cache.get_many([entry_key, version_key])
+        session_version = session.get(SESSION_KEY, {}).get(str(id)) \
+            if has_request_context() else None
+        required = self._required_version([found.get(version_key), session_version])
+
+        entry = found.get(entry_key)
+        if entry is not None and entry[0] >= required:
+            return self._attach(model, entry[1])
+
+        # From the primary: a lagging replica would be cached under the new version
+        with primary(db.session):
+            user = model.query.populate_existing().get(id)
+        if user is not None:
+            data = dict((field, getattr(user, field)) for field in FIELDS)
+            self.cache.set(entry_key, (required, data), ttl = current_app.config["USER_CACHE_TTL"])
+        return user
+
+    def _attach(self, model, data):
+        user = model()
+        for field, value in data.items():
+            set_committed_value(user, field, value)
+        make_transient_to_detached(user)
+        # load = False trusts the values, no SELECT is emitted
+        return db.session.merge(user, load = False)
+
+    def invalidate(self, user):
+        """
+        Require a new version of the cached user, e.g. after a profile edit.
+        Call it after the change is committed.
+        """
+        version = time()
+        _, version_key = self._keys(user.id)
+        # No expiry, the version must outlive the entries it guards
+        self.cache.set(version_key, version, ttl = 0)
+        if has_request_context():
+            versions = session.get(SESSION_KEY, {})
+            versions[str(user.id)] = version
+            session[SESSION_KEY] = versions
+
+user_cache = UserCache()
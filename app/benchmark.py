@@ -0,0 +1,340 @@
+import argparse
+import http.client
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from itertools import accumulate
+from urllib.parse import urlencode
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import create_app, db
+from app.models import User, Post
+from app.passwords import passwords
+from app.timeline import timeline
+from config import Config
+
+"""
+Load test of the hot paths of the microblog.
+
+Seeds a throwaway database through the models (users, a power-law follower
+graph, posts fanned out to the timelines), then times the index, explore,
+user, login and follow pages through the Flask test client and, with
+--uwsgi, through a local uWSGI instance serving main.py. Prints a JSON
+report, per page: p50/p99 latency, requests per second and, in process,
+SQL queries per request. Compare the reports of two commits to catch a
+regression:
+
+    python benchmark.py --users 1000 --posts 20000 --output before.json
+
+The database is a temporary SQLite file unless --database-url is given,
+which must then point to an empty database.
+"""
+
+PASSWORD = "benchmark"
+
+# Zipf exponent of the popularity of users, as followees and as authors
+POPULARITY_EXPONENT = 1.1
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+def benchmark_config(database_url, workdir):
+    class BenchmarkConfig(Config):
+        SQLALCHEMY_DATABASE_URI = database_url
+        JOBS_DATABASE = os.path.join(workdir, "jobs.db")
+        WTF_CSRF_ENABLED = False
+        # Every request of the benchmark comes from the same address
+        RATELIMIT_ENABLED = False
+        AVATAR_FETCHER = "identicon"
+        # No flusher thread writing behind the timed requests
+        LAST_SEEN_FLUSH_INTERVAL = 0
+    return BenchmarkConfig
+
+def seed(users, posts, follows, rng):
+    """
+    `users` users following on average about `follows` others, picked by
+    popularity so a few have most followers, and `posts` posts mostly by the
+    popular users, spread over the last 30 days.
+    """
+    # One hash for everyone, hashing thousands of passwords would take minutes
+    pwhash = passwords.hash(PASSWORD)
+    people = [User(username = "user{}".format(i), email = "user{}@example.com".format(i),
+                   password_hash = pwhash) for i in range(users)]
+    db.session.add_all(people)
+    db.session.commit()
+
+    popularity = list(accumulate(1.0 / (rank + 1) ** POPULARITY_EXPONENT
+                                 for rank in range(users)))
+    # Pareto out-degree, mean of 3 times its scale with alpha = 1.5
+    for user in people:
+        degree = min(users - 1, int(rng.paretovariate(1.5) * follows / 3.0))
+        # Sorted, a set of instances iterates in memory order, not the same every run
+        picked = set(rng.choices(people, cum_weights = popularity, k = degree))
+        for followed in sorted(picked, key = lambda followed: followed.id):
+            if followed is not user:
+                user.follow(followed)
+        db.session.commit()
+
+    start = datetime.utcnow() - timedelta(days = 30)
+    step = timedelta(days = 30) / max(posts, 1)
+    authors = rng.choices(people, cum_weights = popularity, k = posts)
+    for i, author in enumerate(authors):
+        post = Post(body = "Post {} by {}".format(i, author.username), author = author,
+                    timestamp = start + i * step)
+        db.session.add(post)
+        db.session.flush()
+        timeline.fan_out(post)
+        if i % 500 == 499:
+            db.session.commit()
+    db.session.commit()
+    return [user.username for user in people]
+
+class QueryCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(Engine, "before_cursor_execute", self.record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(Engine, "before_cursor_execute", self.record)
+
+class TestClientDriver(object):
+    """
+    Requests served in this process, by the test client.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def session(self, username):
+        client = self.app.test_client()
+        if username is not None:
+            client.post("/login", data = { "username": username, "password": PASSWORD })
+        return TestClientSession(client)
+
+class TestClientSession(object):
+    def __init__(self, client):
+        self.client = client
+
+    def request(self, method, path, data = None):
+        with QueryCounter() as counter:
+            start = time.perf_counter()
+            response = self.client.open(path, method = method, data = data)
+            elapsed = time.perf_counter() - start
+        if response.status_code >= 400:
+            raise RuntimeError("{} {} returned {}".format(method, path, response.status_code))
+        return elapsed, counter.count
+
+class UwsgiDriver(object):
+    """
+    Requests served by a uWSGI instance started for the benchmark, over HTTP.
+    """
+
+    def __init__(self, env, processes, threads):
+        if shutil.which("uwsgi") is None:
+            raise RuntimeError("uwsgi isn't installed, pip install uwsgi")
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.process = subprocess.Popen(
+            ["uwsgi", "--ini", "uwsgi.ini", "--http", "127.0.0.1:{}".format(self.port),
+             "--processes", str(processes), "--threads", str(threads),
+             "--disable-logging", "--die-on-term"],
+            cwd = os.path.dirname(os.path.abspath(__file__)),
+            env = dict(os.environ, **env),
+            stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+        self._wait()
+
+    def _wait(self, timeout = 30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError("uwsgi exited with status {}".format(self.process.returncode))
+            try:
+                connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout = 5)
+                connection.request("GET", "/login")
+                connection.getresponse().read()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError("uwsgi didn't answer within {} seconds".format(timeout))
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+    def session(self, username):
+        session = HttpSession(self.port)
+        # The form token is valid for the whole session
+        session.csrf_token = CSRF_TOKEN.search(session.fetch("GET", "/login")[1]).group(1)
+        if username is not None:
+            session.request("POST", "/login", { "username": username, "password": PASSWORD })
+        return session
+
+class HttpSession(object):
+    def __init__(self, port):
+        self.connection = http.client.HTTPConnection("127.0.0.1", port)
+        self.cookies = {}
+        self.csrf_token = None
+
+    def fetch(self, method, path, data = None):
+        headers = {}
+        body = None
+        if self.cookies:
+            headers["Cookie"] = "; ".join("{}={}".format(*item) for item in self.cookies.items())
+        if data is not None:
+            body = urlencode(dict(data, csrf_token = self.csrf_token))
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        self.connection.request(method, path, body, headers)
+        response = self.connection.getresponse()
+        content = response.read().decode("utf-8", "replace")
+        for header in response.headers.get_all("Set-Cookie") or []:
+            name, _, value = header.split(";")[0].partition("=")
+            self.cookies[name.strip()] = value
+        if response.status >= 400:
+            raise RuntimeError("{} {} returned {}".format(method, path, response.status))
+        return response.status, content
+
+    def request(self, method, path, data = None):
+        start = time.perf_counter()
+        self.fetch(method, path, data)
+        # Queries are only counted in process
+        return time.perf_counter() - start, None
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def summarize(timings):
+    latencies = [elapsed for elapsed, _ in timings]
+    queries = [count for _, count in timings if count is not None]
+    return {
+        "requests": len(timings),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "requests_per_second": round(len(latencies) / sum(latencies), 1),
+        "queries_per_request": round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+def heaviest_reader():
+    """
+    The user who follows the most others, whose home timeline merges the most authors.
+    """
+    return User.query.order_by(User.followed_count.desc(), User.id).first().username
+
+def strangers(reader):
+    """
+    The users `reader` may follow and unfollow again, leaving the graph as it was.
+    """
+    user = User.query.filter_by(username = reader).one()
+    query = db.session.query(User.username).filter(User.id != user.id)\
+                      .filter(~User.id.in_(user.followed.with_entities(User.id)))
+    return [username for username, in query.order_by(User.id)]
+
+def run(driver, usernames, reader, strangers, requests, rng):
+    """
+    `requests` requests to each page, as `reader` except for the user
+    pages and logins. Follows are timed on `strangers`.
+    """
+    session = driver.session(reader)
+    scenarios = {
+        "index": lambda: session.request("GET", "/index"),
+        "explore": lambda: session.request("GET", "/explore"),
+        "user": lambda: session.request("GET", "/user/{}".format(rng.choice(usernames))),
+        # A fresh session each time, a logged in user is just redirected
+        "login": lambda: driver.session(None).request(
+            "POST", "/login", { "username": rng.choice(usernames), "password": PASSWORD }),
+    }
+    results = {}
+    for name, scenario in scenarios.items():
+        # Warm the caches and the connection pool first
+        scenario()
+        results[name] = summarize([scenario() for _ in range(requests)])
+
+    # Follow then unfollow, so the graph is left as it was
+    timings = []
+    for _ in range(requests):
+        username = rng.choice(strangers)
+        timings.append(session.request("POST", "/follow/{}".format(username), {}))
+        session.request("POST", "/unfollow/{}".format(username), {})
+    results["follow"] = summarize(timings)
+    return results
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the microblog hot paths.")
+    parser.add_argument("--users", type = int, default = 500)
+    parser.add_argument("--posts", type = int, default = 5000)
+    parser.add_argument("--follows", type = int, default = 20,
+                        help = "Mean number of users each user follows.")
+    parser.add_argument("--requests", type = int, default = 200,
+                        help = "Requests timed per page.")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--database-url", help = "An empty database, a temporary SQLite file by default.")
+    parser.add_argument("--uwsgi", action = "store_true", help = "Also benchmark a local uWSGI instance.")
+    parser.add_argument("--processes", type = int, default = 2)
+    parser.add_argument("--threads", type = int, default = 4)
+    parser.add_argument("--output", help = "Write the report to a file instead of stdout.")
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix = "microblog-benchmark-")
+    database_url = args.database_url or "sqlite:///" + os.path.join(workdir, "benchmark.db")
+    app = create_app(benchmark_config(database_url, workdir))
+    rng = random.Random(args.seed)
+    report = {
+        "settings": dict(vars(args), database_url = database_url.split("@")[-1]),
+        "results": {},
+    }
+    try:
+        with app.app_context():
+            db.create_all()
+            start = time.perf_counter()
+            usernames = seed(args.users, args.posts, args.follows, rng)
+            report["seed_seconds"] = round(time.perf_counter() - start, 2)
+            reader = heaviest_reader()
+            report["reader"] = reader
+            others = strangers(reader)
+            db.session.remove()
+
+        # Outside of the app context, each request gets its own like in production
+        report["results"]["testclient"] = run(TestClientDriver(app), usernames, reader,
+                                              others, args.requests, rng)
+
+        if args.uwsgi:
+            driver = UwsgiDriver({
+                "DATABASE_URL": database_url,
+                "JOBS_DATABASE": os.path.join(workdir, "jobs.db"),
+                "RATELIMIT_ENABLED": "0",
+                "AVATAR_FETCHER": "identicon",
+            }, args.processes, args.threads)
+            try:
+                report["results"]["uwsgi"] = run(driver, usernames, reader, others,
+                                                 args.requests, rng)
+            finally:
+                driver.close()
+    finally:
+        shutil.rmtree(workdir, ignore_errors = True)
+
+    output = json.dumps(report, indent = 2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,6 +9,47 @@ class Config(object):
         "sqlite:///" + os.path.join(basedir, "app.db")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Connection pool of each worker process, see app.database
+    DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE") or 5)
+    DATABASE_MAX_OVERFLOW = int(os.environ.get("DATABASE_MAX_OVERFLOW") or 5)
+    DATABASE_POOL_TIMEOUT = int(os.environ.get("DATABASE_POOL_TIMEOUT") or 10)
+    # Seconds, connections older than this are replaced before the server drops them
+    DATABASE_POOL_RECYCLE = int(os.environ.get("DATABASE_POOL_RECYCLE") or 1800)
+    DATABASE_POOL_PRE_PING = os.environ.get("DATABASE_POOL_PRE_PING", "1") == "1"
+    # PostgreSQL only, in milliseconds, 0 disables it
+    DATABASE_STATEMENT_TIMEOUT = int(os.environ.get("DATABASE_STATEMENT_TIMEOUT") or 30000)
+    # Connect through PgBouncer in transaction pooling mode
+    DATABASE_PGBOUNCER = os.environ.get("DATABASE_PGBOUNCER") is not None
+    # Read replicas, see app.replicas. Space separated URLs, none reads from the primary
+    DATABASE_REPLICA_URLS = (os.environ.get("DATABASE_REPLICA_URLS") or "").split()
+    # Seconds a user reads from the primary after writing, must cover the replication lag
+    DATABASE_REPLICA_STICKY_SECONDS = int(os.environ.get("DATABASE_REPLICA_STICKY_SECONDS") or 5)
+
+    # Password hashing, see app.passwords
+    # Hashes made with other parameters are upgraded when their owner logs in
+    PASSWORD_HASH_METHOD = os.environ.get("PASSWORD_HASH_METHOD") or "pbkdf2:sha256:260000"
+    PASSWORD_SALT_LENGTH = int(os.environ.get("PASSWORD_SALT_LENGTH") or 16)
+    # Processes hashing off the request thread, 0 hashes in the request thread
+    PASSWORD_HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS") or 0)
+    PASSWORD_HASH_TIMEOUT = float(os.environ.get("PASSWORD_HASH_TIMEOUT") or 10)
+
+    # Rate limiting, see app.ratelimit
+    RATELIMIT_ENABLED = os.environ.get("RATELIMIT_ENABLED", "1") == "1"
+    # Backend is one of "auto", "uwsgi" (the cache2 of uwsgi.ini), "redis" or "memory".
+    # "auto" uses the uWSGI cache when running under uWSGI, the process otherwise.
+    RATELIMIT_BACKEND = os.environ.get("RATELIMIT_BACKEND") or "auto"
+    RATELIMIT_UWSGI_CACHE = "ratelimit"
+    RATELIMIT_MAX_ENTRIES = int(os.environ.get("RATELIMIT_MAX_ENTRIES") or 10000)
+    # Token buckets: "5/minute" allows bursts of 5, refilled at 5 per minute
+    RATELIMITS = {
+        "login-ip": "30/minute",
+        "login-account": "10/minute",
+        "register-ip": "10/hour",
+        "reset-password-ip": "10/hour",
+        "reset-password-account": "3/hour",
+        "export": "5/hour",
+    }
+
     # Mail server config
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
@@ -17,8 +58,127 @@ class Config(object):
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     ADMINS = ['your-email@example.com']
 
+    # Logging, see app.log_handlers
+    # Records waiting for the file and mail handlers, more are dropped
+    LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE") or 1000)
+    # Errors following a mail within this many seconds are sent in one digest
+    LOG_MAIL_DIGEST_INTERVAL = int(os.environ.get("LOG_MAIL_DIGEST_INTERVAL") or 300)
+    LOG_MAIL_DIGEST_MAX_RECORDS = int(os.environ.get("LOG_MAIL_DIGEST_MAX_RECORDS") or 50)
+
+    # Background jobs config, see app.jobs
+    JOBS_DATABASE = os.environ.get("JOBS_DATABASE") or os.path.join(basedir, "jobs.db")
+    JOBS_CONCURRENCY = int(os.environ.get("JOBS_CONCURRENCY") or 4)
+    JOBS_BATCH_SIZE = int(os.environ.get("JOBS_BATCH_SIZE") or 20)
+    JOBS_POLL_INTERVAL = float(os.environ.get("JOBS_POLL_INTERVAL") or 1)
+    JOBS_LEASE = int(os.environ.get("JOBS_LEASE") or 300)
+    JOBS_MAX_ATTEMPTS = int(os.environ.get("JOBS_MAX_ATTEMPTS") or 5)
+    JOBS_RETRY_BASE = int(os.environ.get("JOBS_RETRY_BASE") or 10)
+    JOBS_RETRY_MAX = int(os.environ.get("JOBS_RETRY_MAX") or 3600)
+
+    # Uploads config, see app.uploads
+    UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER") or os.path.join(basedir, "uploads")
+    UPLOAD_EXTENSIONS = ["png", "jpg", "jpeg"]
+    # Formats, as detected by Pillow, that are accepted after processing
+    UPLOAD_FORMATS = ["png", "jpeg"]
+    UPLOAD_MAX_SIZE = int(os.environ.get("UPLOAD_MAX_SIZE") or 16 * 2 ** 20)
+    UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE") or 2 ** 20)
+    UPLOAD_COPY_BUFFER = 64 * 2 ** 10
+    UPLOAD_THUMBNAIL_SIZES = [64, 256]
+    # Uploads receiving no chunk for this many seconds are expired, checked
+    # every UPLOAD_SWEEP_INTERVAL seconds by `flask worker`
+    UPLOAD_EXPIRY = int(os.environ.get("UPLOAD_EXPIRY") or 24 * 3600)
+    UPLOAD_SWEEP_INTERVAL = int(os.environ.get("UPLOAD_SWEEP_INTERVAL") or 3600)
+    # Resized images served at /media/d/, see app.derivatives
+    DERIVATIVES_DIR = os.environ.get("DERIVATIVES_DIR") or os.path.join(basedir, "media", "d")
+    DERIVATIVES_SIZES = [64, 128, 256, 512, 1024]
+    # Bound of DERIVATIVES_DIR, enforced every DERIVATIVES_PRUNE_INTERVAL seconds by `flask worker`
+    DERIVATIVES_MAX_BYTES = int(os.environ.get("DERIVATIVES_MAX_BYTES") or 2 ** 30)
+    DERIVATIVES_PRUNE_INTERVAL = int(os.environ.get("DERIVATIVES_PRUNE_INTERVAL") or 600)
+    # Internal nginx location of DERIVATIVES_DIR, e.g. "/_media/d", unset streams with send_file
+    DERIVATIVES_ACCEL_REDIRECT = os.environ.get("DERIVATIVES_ACCEL_REDIRECT")
+    # No request body may be larger than an upload chunk and its form fields
+    MAX_CONTENT_LENGTH = UPLOAD_CHUNK_SIZE + 64 * 2 ** 10
+
+    # Avatars, see app.avatars
+    # Fetcher is "gravatar" or "identicon", which never leaves the server
+    AVATAR_FETCHER = os.environ.get("AVATAR_FETCHER") or "gravatar"
+    AVATAR_DIR = os.environ.get("AVATAR_DIR") or os.path.join(basedir, "media", "avatars")
+    # The sizes the templates use, any other is a 404
+    AVATAR_SIZES = [24, 64, 256]
+    AVATAR_FETCH_TIMEOUT = float(os.environ.get("AVATAR_FETCH_TIMEOUT") or 2)
+    AVATAR_MAX_AGE = int(os.environ.get("AVATAR_MAX_AGE") or 7 * 24 * 3600)
+    # Identicons served because the fetch failed are retried after this many seconds
+    AVATAR_RETRY = int(os.environ.get("AVATAR_RETRY") or 3600)
+    # Bound of AVATAR_DIR, enforced every AVATAR_PRUNE_INTERVAL seconds by `flask worker`
+    AVATAR_MAX_BYTES = int(os.environ.get("AVATAR_MAX_BYTES") or 256 * 2 ** 20)
+    AVATAR_PRUNE_INTERVAL = int(os.environ.get("AVATAR_PRUNE_INTERVAL") or 600)
+
     # Pagination config
     POSTS_PER_PAGE = 10
 
+    # Batched last_seen updates, in seconds
+    LAST_SEEN_RESOLUTION = int(os.environ.get("LAST_SEEN_RESOLUTION") or 60)
+    # 0 disables the background flusher, last_seen.flush() must then be called explicitly
+    LAST_SEEN_FLUSH_INTERVAL = int(os.environ.get("LAST_SEEN_FLUSH_INTERVAL") or 60)
+
+    # Shared Redis server, used by the backends that can live outside the process
+    REDIS_URL = os.environ.get("REDIS_URL") or "redis://localhost:6379/0"
+
+    # Cache config
+    # Backend is one of "auto", "memory", "filesystem", "uwsgi", "redis" or "null".
+    # "auto" uses the uWSGI cache when running under uWSGI, the process otherwise:
+    # the memory backend isn't shared by uWSGI workers, so invalidations
+    # would only reach the worker that made them. The user and fragment
+    # caches refuse to start with it when there is more than one worker.
+    CACHE_BACKEND = os.environ.get("CACHE_BACKEND") or "auto"
+    # The cache2 of uwsgi.ini used by the "uwsgi" backend
+    CACHE_UWSGI_NAME = "app"
+    CACHE_DIR = os.environ.get("CACHE_DIR") or os.path.join(basedir, "cache")
+    CACHE_MAX_ENTRIES = int(os.environ.get("CACHE_MAX_ENTRIES") or 10000)
+    CACHE_DEFAULT_TTL = int(os.environ.get("CACHE_DEFAULT_TTL") or 300)
+    FRAGMENT_CACHE_TTL = int(os.environ.get("FRAGMENT_CACHE_TTL") or 24 * 3600)
+    EXPLORE_CACHE_TTL = int(os.environ.get("EXPLORE_CACHE_TTL") or 30)
+    # The session user, see app.user_cache
+    USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL") or 60)
+
+    # Per-request instrumentation, see app.instrumentation
+    INSTRUMENTATION_ENABLED = os.environ.get("INSTRUMENTATION_ENABLED") is not None
+    INSTRUMENTATION_SERVER_TIMING = os.environ.get("INSTRUMENTATION_SERVER_TIMING", "1") == "1"
+    INSTRUMENTATION_LOG = os.environ.get("INSTRUMENTATION_LOG", "1") == "1"
+    # Slowest statements of a request written in its log line
+    INSTRUMENTATION_SLOWEST = int(os.environ.get("INSTRUMENTATION_SLOWEST") or 3)
+    # Upper bounds, in seconds, of the request duration histogram buckets
+    INSTRUMENTATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+    # Lets a scraper read /metrics with "Authorization: Bearer <token>", admins always can
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+    # Slow query log with plans, see app.slow_queries. 0 disables it
+    SLOW_QUERY_THRESHOLD_MS = float(os.environ.get("SLOW_QUERY_THRESHOLD_MS") or 0)
+    SLOW_QUERY_LOG = os.environ.get("SLOW_QUERY_LOG") or \
+        os.path.join(basedir, "logs", "slow_queries.log")
+    SLOW_QUERY_LOG_MAX_BYTES = int(os.environ.get("SLOW_QUERY_LOG_MAX_BYTES") or 10 * 2 ** 20)
+    # Statements waiting for their plan, more are dropped
+    SLOW_QUERY_QUEUE_SIZE = int(os.environ.get("SLOW_QUERY_QUEUE_SIZE") or 100)
+    # Seconds before the plan of a statement is fetched again
+    SLOW_QUERY_EXPLAIN_INTERVAL = int(os.environ.get("SLOW_QUERY_EXPLAIN_INTERVAL") or 3600)
+
+    # Sampling CPU profiler, see app.profiler. Off unless one of the two is set
+    # Requests with "X-Profile: <token>" are profiled
+    PROFILER_TOKEN = os.environ.get("PROFILER_TOKEN")
+    # Fraction of the requests profiled at random
+    PROFILER_SAMPLE_RATE = float(os.environ.get("PROFILER_SAMPLE_RATE") or 0)
+    PROFILER_INTERVAL_MS = float(os.environ.get("PROFILER_INTERVAL_MS") or 5)
+    PROFILER_DIR = os.environ.get("PROFILER_DIR") or os.path.join(basedir, "logs", "profiles")
+    PROFILER_MAX_FILES = int(os.environ.get("PROFILER_MAX_FILES") or 100)
+
+    # Home timeline (fan-out-on-write) config
+    # Backend is one of "database", "memory" or "redis"
+    TIMELINE_BACKEND = os.environ.get("TIMELINE_BACKEND") or "database"
+    TIMELINE_MAX_ENTRIES = int(os.environ.get("TIMELINE_MAX_ENTRIES") or 800)
+    # The database backend trims the timelines over the cap every that many seconds, in `flask worker`
+    TIMELINE_TRIM_INTERVAL = int(os.environ.get("TIMELINE_TRIM_INTERVAL") or 300)
+    # Posts of authors with more followers are merged in on read, 0 disables it
+    TIMELINE_FANOUT_THRESHOLD = int(os.environ.get("TIMELINE_FANOUT_THRESHOLD") or 10000)
+
     # i18n
     LANGUAGES = ["en", "ro"]
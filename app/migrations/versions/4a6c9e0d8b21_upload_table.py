@@ -0,0 +1,35 @@
+"""Upload table
+
+Revision ID: 4a6c9e0d8b21
+Revises: 8f0b6d2c4e17
+Create Date: 2026-10-18 21:14:37.207561
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4a6c9e0d8b21'
+down_revision = '8f0b6d2c4e17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('upload',
+    sa.Column('id', sa.String(length=36), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('filename', sa.String(length=255), nullable=True),
+    sa.Column('size', sa.Integer(), nullable=True),
+    sa.Column('status', sa.String(length=16), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_upload_user_id'), 'upload', ['user_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_upload_user_id'), table_name='upload')
+    op.drop_table('upload')
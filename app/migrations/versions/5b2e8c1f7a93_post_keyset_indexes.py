@@ -0,0 +1,26 @@
+"""Post keyset pagination indexes
+
+Revision ID: 5b2e8c1f7a93
+Revises: 9e263af0382f
+Create Date: 2026-10-18 18:40:12.114032
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b2e8c1f7a93'
+down_revision = '9e263af0382f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_post_timestamp_id', 'post', ['timestamp', 'id'], unique=False)
+    op.create_index('ix_post_user_id_timestamp_id', 'post', ['user_id', 'timestamp', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_post_user_id_timestamp_id', table_name='post')
+    op.drop_index('ix_post_timestamp_id', table_name='post')
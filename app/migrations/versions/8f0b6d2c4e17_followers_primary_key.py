@@ -0,0 +1,49 @@
+"""Followers primary key and reverse index
+
+Revision ID: 8f0b6d2c4e17
+Revises: e3a90f6d51c8
+Create Date: 2026-10-18 20:02:51.660398
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8f0b6d2c4e17'
+down_revision = 'e3a90f6d51c8'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Drop the rows the primary key would reject: NULLs and duplicate follows
+    op.execute("DELETE FROM followers WHERE follower_id IS NULL OR followed_id IS NULL")
+    op.execute("CREATE TABLE followers_distinct AS "
+               "SELECT DISTINCT follower_id, followed_id FROM followers")
+    op.execute("DELETE FROM followers")
+    op.execute("INSERT INTO followers (follower_id, followed_id) "
+               "SELECT follower_id, followed_id FROM followers_distinct")
+    op.drop_table('followers_distinct')
+
+    with op.batch_alter_table('followers', recreate='auto') as batch_op:
+        batch_op.alter_column('follower_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.alter_column('followed_id', existing_type=sa.Integer(), nullable=False)
+        batch_op.create_primary_key('pk_followers', ['follower_id', 'followed_id'])
+    op.create_index('ix_followers_followed_id_follower_id', 'followers',
+                    ['followed_id', 'follower_id'], unique=False)
+
+    # Duplicates were counted by the counters backfill
+    op.execute("""
+        UPDATE "user" SET
+            followers_count = (SELECT count(*) FROM followers WHERE followers.followed_id = "user".id),
+            followed_count = (SELECT count(*) FROM followers WHERE followers.follower_id = "user".id)
+    """)
+
+
+def downgrade():
+    op.drop_index('ix_followers_followed_id_follower_id', table_name='followers')
+    with op.batch_alter_table('followers', recreate='auto') as batch_op:
+        batch_op.drop_constraint('pk_followers', type_='primary')
+        batch_op.alter_column('followed_id', existing_type=sa.Integer(), nullable=True)
+        batch_op.alter_column('follower_id', existing_type=sa.Integer(), nullable=True)
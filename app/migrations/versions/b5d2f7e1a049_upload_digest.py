@@ -0,0 +1,28 @@
+"""Upload digest
+
+Revision ID: b5d2f7e1a049
+Revises: 4a6c9e0d8b21
+Create Date: 2026-10-18 22:03:51.480113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5d2f7e1a049'
+down_revision = '4a6c9e0d8b21'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('upload', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('digest', sa.String(length=64), nullable=True))
+        batch_op.create_index(batch_op.f('ix_upload_digest'), ['digest'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('upload', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_upload_digest'))
+        batch_op.drop_column('digest')
@@ -0,0 +1,54 @@
+"""Timeline entry table
+
+Revision ID: c7d41a9e2b60
+Revises: 5b2e8c1f7a93
+Create Date: 2026-10-18 19:05:47.351208
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7d41a9e2b60'
+down_revision = '5b2e8c1f7a93'
+branch_labels = None
+depends_on = None
+
+# Keep in sync with Config.TIMELINE_MAX_ENTRIES
+MAX_ENTRIES = 800
+
+
+def upgrade():
+    op.create_table('timeline_entry',
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('post_id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['post_id'], ['post.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('user_id', 'post_id')
+    )
+    op.create_index('ix_timeline_entry_user_id_timestamp_post_id', 'timeline_entry',
+                    ['user_id', 'timestamp', 'post_id'], unique=False)
+
+    # Materialize the newest posts of every existing home timeline
+    op.execute("""
+        INSERT INTO timeline_entry (user_id, post_id, timestamp)
+        SELECT reader_id, post_id, timestamp FROM (
+            SELECT readers.reader_id, post.id AS post_id, post.timestamp,
+                   row_number() OVER (PARTITION BY readers.reader_id
+                                      ORDER BY post.timestamp DESC, post.id DESC) AS rank
+            FROM (
+                SELECT id AS reader_id, id AS author_id FROM "user"
+                UNION
+                SELECT follower_id, followed_id FROM followers
+            ) AS readers
+            JOIN post ON post.user_id = readers.author_id
+        ) AS ranked
+        WHERE rank <= {}
+    """.format(MAX_ENTRIES))
+
+
+def downgrade():
+    op.drop_index('ix_timeline_entry_user_id_timestamp_post_id', table_name='timeline_entry')
+    op.drop_table('timeline_entry')
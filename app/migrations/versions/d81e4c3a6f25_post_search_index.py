@@ -0,0 +1,37 @@
+"""Post search index
+
+Revision ID: d81e4c3a6f25
+Revises: b5d2f7e1a049
+Create Date: 2026-10-18 22:41:09.733205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd81e4c3a6f25'
+down_revision = 'b5d2f7e1a049'
+branch_labels = None
+depends_on = None
+
+
+# See app/search.py, the statements must stay in sync
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("CREATE VIRTUAL TABLE post_fts USING fts5("
+                   "body, content='post', content_rowid='id', "
+                   "tokenize='unicode61 remove_diacritics 2')")
+        # Index the existing posts
+        op.execute("INSERT INTO post_fts (post_fts) VALUES ('rebuild')")
+    elif dialect == 'postgresql':
+        op.execute("CREATE INDEX ix_post_body_fts ON post USING gin (to_tsvector('simple', body))")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'sqlite':
+        op.execute("DROP TABLE post_fts")
+    elif dialect == 'postgresql':
+        op.execute("DROP INDEX ix_post_body_fts")
@@ -0,0 +1,37 @@
+"""Denormalized user counters
+
+Revision ID: e3a90f6d51c8
+Revises: c7d41a9e2b60
+Create Date: 2026-10-18 19:32:04.902117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3a90f6d51c8'
+down_revision = 'c7d41a9e2b60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('followers_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('user', sa.Column('followed_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('user', sa.Column('posts_count', sa.Integer(), server_default='0', nullable=False))
+
+    # Backfill from the current rows
+    op.execute("""
+        UPDATE "user" SET
+            followers_count = (SELECT count(*) FROM followers WHERE followers.followed_id = "user".id),
+            followed_count = (SELECT count(*) FROM followers WHERE followers.follower_id = "user".id),
+            posts_count = (SELECT count(*) FROM post WHERE post.user_id = "user".id)
+    """)
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('posts_count')
+        batch_op.drop_column('followed_count')
+        batch_op.drop_column('followers_count')
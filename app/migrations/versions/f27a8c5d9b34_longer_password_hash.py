@@ -0,0 +1,29 @@
+"""Longer password hash
+
+Revision ID: f27a8c5d9b34
+Revises: d81e4c3a6f25
+Create Date: 2026-10-18 23:12:40.118592
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f27a8c5d9b34'
+down_revision = 'd81e4c3a6f25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Room for sha512 and longer salts, see PASSWORD_HASH_METHOD
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.alter_column('password_hash', existing_type=sa.String(length=128),
+                              type_=sa.String(length=256))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.alter_column('password_hash', existing_type=sa.String(length=256),
+                              type_=sa.String(length=128))
@@ -1,14 +1,72 @@
 from datetime import datetime, timedelta
+import gzip
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+import uuid
+from unittest import mock
 
-from app import create_app, db
-from app.models import User, Post
+from flask import g
+from sqlalchemy import create_engine, event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import NullPool, QueuePool
+
+from app import bulk, cli, create_app, db, export, mail
+from app.models import User, Post, TimelineEntry, Upload, avatar_digest, followers
+from app.uploads import Image, file_digest, finish_upload, image_path, incoming_path
+from app.cache import FileSystemCache, MemoryCache, UwsgiCache, make_cache
+from app.database import engine_options
+from app.jobs import JobStore, jobs
+from app.last_seen import last_seen
+from app.log_handlers import AsyncHandler, DigestSMTPHandler
+from app.pagination import decode_cursor, paginate_keyset
+from app.ratelimit import MemoryStore, parse_limit, refill
+from app.search import search
+from app.slow_queries import slow_queries
+from app.timeline import timeline
+from app.user_cache import user_cache
 from config import Config
 
 class TestConfig(Config):
     TESTING = True
     # Make unittests use a temporary, in-memory, db
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    JOBS_DATABASE = ':memory:'
+    # Tests flush the batched last_seen updates themselves
+    LAST_SEEN_FLUSH_INTERVAL = 0
+    # Never reach gravatar.com from the tests
+    AVATAR_FETCHER = 'identicon'
+    # Cheap hashes, the tests create many users
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+
+class QueryCounter(object):
+    """
+    Count the SQL statements sent to the database inside a with block
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self.record)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self.record)
+
+    @property
+    def count(self):
+        return len(self.statements)
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
@@ -31,11 +89,30 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password("dog"))
         self.assertTrue(u.check_password("cat"))
 
+    def test_password_hashing_pool(self):
+        self.app.config["PASSWORD_HASH_WORKERS"] = 2
+        u = User(username="susan")
+        u.set_password("cat")
+        self.assertTrue(u.password_hash.startswith("pbkdf2:sha256:1000$"))
+        self.assertFalse(u.check_password("dog"))
+        self.assertTrue(u.check_password("cat"))
+        self.assertFalse(u.password_needs_rehash())
+
     def test_avatar(self):
-        u = User(username="john", email="john@example.com")
-        self.assertEqual(u.avatar(128), ("https://www.gravatar.com/avatar/"
-            "d4c74594d841139328695756648b6bd6"
-            "?d=identicon&s=128"))
+        u = User(id=1, username="john", email="john@example.com")
+        with self.app.test_request_context():
+            self.assertEqual(u.avatar(64), "/avatar/1/d4c74594d841139328695756648b6bd6/64")
+
+    def test_avatar_digest_cache(self):
+        avatar_digest.cache_clear()
+        u = User(id=1, username="john", email="john@example.com")
+        with self.app.test_request_context():
+            u.avatar(64)
+            u.avatar(256)
+            self.assertEqual(avatar_digest.cache_info().hits, 1)
+
+            u.email = "John.Smith@example.com"
+            self.assertIn("1bc5edb4799fd8eec67c66122f47eb73", u.avatar(64))
 
     def test_follow(self):
         u1 = User(username="john", email="john@example.com")
@@ -60,6 +137,30 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
+    def test_following_cache(self):
+        users = [User(username="user{}".format(i), email="user{}@example.com".format(i))
+                for i in range(4)]
+        db.session.add_all(users)
+        db.session.commit()
+        u0, u1, u2, u3 = users
+        u0.follow(u1)
+        u0.follow(u3)
+        db.session.commit()
+
+        # a fresh request knows nothing yet
+        g.pop("following", None)
+        self.assertTrue(u0.is_following(u1))
+        self.assertFalse(u0.is_following(u2))
+        self.assertTrue(u0.is_following(u3))
+
+        u0.unfollow(u1)
+        self.assertFalse(u0.is_following(u1))
+
+        # the primary key rejects a duplicate follow
+        with self.assertRaises(IntegrityError):
+            db.session.execute(followers.insert().values(follower_id=u0.id, followed_id=u3.id))
+        db.session.rollback()
+
     def test_follow_posts(self):
         # create four users
         u1 = User(username="john", email="john@example.com")
@@ -98,5 +199,1287 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_counters(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        u1.follow(u2)
+        u1.follow(u2)
+        db.session.add(Post(body="post from susan", author=u2))
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u1.followers_count), (1, 0))
+        self.assertEqual((u2.followed_count, u2.followers_count), (0, 1))
+        db.session.expire_all()
+        self.assertEqual((u1.posts_count, u2.posts_count), (0, 1))
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u2.followers_count), (0, 0))
+
+        # drifted counters are fixed in bulk
+        u1.followed_count = 5
+        u2.posts_count = 0
+        db.session.commit()
+        self.assertEqual(User.reconcile_counters(), 2)
+        db.session.commit()
+        self.assertEqual((u1.followed_count, u2.posts_count), (0, 1))
+        self.assertEqual(User.reconcile_counters(), 0)
+
+    def test_keyset_pagination(self):
+        u = User(username="john", email="john@example.com")
+        db.session.add(u)
+
+        # posts 0 and 1 share a timestamp, so the id must break the tie
+        now = datetime.utcnow()
+        posts = [Post(body="post {}".format(i), author=u,
+                timestamp=now + timedelta(seconds=max(i, 1))) for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        newest_first = sorted(posts, key=lambda p: (p.timestamp, p.id), reverse=True)
+
+        page1 = paginate_keyset(Post.query, Post, 2)
+        self.assertEqual(page1.items, newest_first[:2])
+        self.assertTrue(page1.has_next)
+        self.assertFalse(page1.has_prev)
+
+        page2 = paginate_keyset(Post.query, Post, 2, before=page1.next_cursor)
+        self.assertEqual(page2.items, newest_first[2:4])
+        self.assertTrue(page2.has_prev)
+
+        page3 = paginate_keyset(Post.query, Post, 2, before=page2.next_cursor)
+        self.assertEqual(page3.items, newest_first[4:])
+        self.assertFalse(page3.has_next)
+
+        # walking back with the previous cursor returns the same page
+        back = paginate_keyset(Post.query, Post, 2, after=page3.prev_cursor)
+        self.assertEqual(back.items, page2.items)
+        self.assertIsNone(decode_cursor("not-a-cursor"))
+
+    def test_last_seen_batching(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        tracker = self.app.extensions["last_seen"]
+        now = datetime.utcnow() + timedelta(minutes=1)
+        tracker.touch(u1.id, now)
+        tracker.touch(u2.id, now)
+        # within the resolution, nothing new is recorded
+        tracker.touch(u1.id, now + timedelta(seconds=30))
+        self.assertEqual(tracker.get(u1.id), now)
+
+        # pending values are shown without dirtying the session
+        last_seen.apply(u1)
+        self.assertEqual(u1.last_seen, now)
+        self.assertFalse(db.session.is_modified(u1))
+
+        self.assertEqual(last_seen.flush(), 2)
+        self.assertEqual(last_seen.flush(), 0)
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, now)
+        self.assertEqual(u2.last_seen, now)
+
+        tracker.touch(u1.id, now + timedelta(seconds=61))
+        last_seen.flush()
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, now + timedelta(seconds=61))
+
+class TimelineCase(unittest.TestCase):
+    config_class = TestConfig
+
+    def setUp(self):
+        self.app = create_app(self.config_class)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def post(self, author, body, seconds):
+        post = Post(body=body, author=author,
+                timestamp=datetime(2021, 1, 1) + timedelta(seconds=seconds))
+        db.session.add(post)
+        db.session.flush()
+        timeline.fan_out(post)
+        db.session.commit()
+        return post
+
+    def home(self, user, per_page=10, **cursor):
+        return timeline.page(user, per_page, **cursor).items
+
+    def test_fan_out_on_write(self):
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        p1 = self.post(u1, "post from john", 1)
+        p2 = self.post(u2, "post from susan", 2)
+        self.assertEqual(self.home(u1), [p1])
+
+        u1.follow(u2)
+        timeline.on_follow(u1, u2)
+        db.session.commit()
+        self.assertEqual(self.home(u1), [p2, p1])
+
+        p3 = self.post(u2, "another post from susan", 3)
+        self.assertEqual(self.home(u1), [p3, p2, p1])
+        self.assertEqual(self.home(u1), u1.followed_posts().all())
+
+        u1.unfollow(u2)
+        timeline.on_unfollow(u1, u2)
+        db.session.commit()
+        self.assertEqual(self.home(u1), [p1])
+
+    def test_cap_falls_back_to_read(self):
+        self.app.config["TIMELINE_MAX_ENTRIES"] = 3
+        u1 = User(username="john", email="john@example.com")
+        db.session.add(u1)
+        db.session.commit()
+        posts = [self.post(u1, "post {}".format(i), i) for i in range(6)]
+        posts.reverse()
+
+        page = timeline.page(u1, 2)
+        self.assertEqual(page.items, posts[:2])
+        page = timeline.page(u1, 2, before=page.next_cursor)
+        self.assertEqual(page.items, posts[2:4])
+        page = timeline.page(u1, 2, before=page.next_cursor)
+        self.assertEqual(page.items, posts[4:])
+        self.assertFalse(page.has_next)
+
+    def test_cap_enforced_by_job(self):
+        if self.app.config["TIMELINE_BACKEND"] != "database":
+            self.skipTest("counts the rows of the database backend")
+        self.app.config["TIMELINE_MAX_ENTRIES"] = 3
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        db.session.add_all([u1, u2])
+        u2.follow(u1)
+        db.session.commit()
+        for i in range(6):
+            self.post(u1, "post {}".format(i), i)
+        ids = u1.id, u2.id
+        # the fan-out only inserts
+        self.assertEqual(TimelineEntry.query.count(), 12)
+
+        jobs.enqueue("trim_timelines", {})
+        self.assertEqual(jobs.run_batch(), 1)
+        # committed by the job, nothing read the timelines
+        db.session.remove()
+        for user_id in ids:
+            entries = TimelineEntry.query.filter_by(user_id=user_id) \
+                .order_by(TimelineEntry.timestamp.desc()).all()
+            self.assertEqual([e.timestamp for e in entries],
+                             [datetime(2021, 1, 1) + timedelta(seconds=i)
+                              for i in (5, 4, 3)])
+
+    def test_hybrid_fan_out(self):
+        self.app.config["TIMELINE_FANOUT_THRESHOLD"] = 1
+        u1 = User(username="john", email="john@example.com")
+        u2 = User(username="susan", email="susan@example.com")
+        u3 = User(username="mary", email="mary@example.com")
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u3)
+        u2.follow(u3)
+        db.session.commit()
+        timeline.rebuild(u1)
+
+        # mary has two followers, her posts are only merged in on read
+        p1 = self.post(u3, "post from mary", 1)
+        p2 = self.post(u1, "post from john", 2)
+        self.assertEqual(timeline.backend.range(u1.id, None, None, 10),
+                [(p2.timestamp, p2.id)])
+        self.assertEqual(self.home(u1), [p2, p1])
+
+class RoutesConfig(TestConfig):
+    WTF_CSRF_ENABLED = False
+
+class RoutesCase(unittest.TestCase):
+    # Queries a page render may issue, no matter how many posts it shows
+    QUERY_BUDGET = 5
+
+    def setUp(self):
+        self.app = create_app(RoutesConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+        # one post from each of many authors, followed by the first one
+        per_page = self.app.config["POSTS_PER_PAGE"]
+        self.users = [User(username="user{}".format(i), email="user{}@example.com".format(i))
+                for i in range(per_page + 2)]
+        for user in self.users:
+            user.set_password("cat")
+        db.session.add_all(self.users)
+        db.session.commit()
+        for user in self.users[1:]:
+            self.users[0].follow(user)
+        db.session.commit()
+        for i, user in enumerate(self.users):
+            post = Post(body="post from {}".format(user.username), author=user,
+                    timestamp=datetime(2021, 1, 1) + timedelta(seconds=i))
+            db.session.add(post)
+            db.session.flush()
+            timeline.fan_out(post)
+        db.session.commit()
+
+        self.client = self.app.test_client()
+        self.client.post("/login", data={"username": "user0", "password": "cat"})
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def assertQueryBudget(self, url, budget=None):
+        budget = budget or self.QUERY_BUDGET
+        db.session.expunge_all()
+        with QueryCounter(db.engine) as counter:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertLessEqual(counter.count, budget, "{} ran {} queries:\n{}".format(
+                url, counter.count, "\n".join(counter.statements)))
+        return response
+
+    def test_post_lists_within_query_budget(self):
+        per_page = self.app.config["POSTS_PER_PAGE"]
+        for url, posts in [("/index", per_page), ("/explore", per_page),
+                           ("/user/user0", 1), ("/user/user1", 1)]:
+            response = self.assertQueryBudget(url)
+            # a page without posts would pass any budget
+            self.assertEqual(response.data.count(b"post from user"), posts, url)
+
+    def test_fragment_cache_invalidation(self):
+        self.assertIn(b"<a href=/user/user0>", self.client.get("/user/user0").data)
+        cache = self.app.extensions["fragments"]
+        self.assertTrue(any(key.startswith("post:") for key in cache.entries))
+
+        self.client.post("/edit_profile", data={"username": "renamed", "about_me": ""})
+        data = self.client.get("/user/renamed").data
+        self.assertIn(b"<a href=/user/renamed>", data)
+        self.assertNotIn(b"<a href=/user/user0>", data)
+
+    def test_session_user_cache(self):
+        self.client.get("/edit_profile")
+        db.session.expunge_all()
+        with QueryCounter(db.engine) as counter:
+            response = self.client.get("/edit_profile")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(counter.statements, [])
+
+        self.client.post("/edit_profile", data={"username": "user0", "about_me": "new bio"})
+        # a worker that still has the old entry, and never saw the new version
+        cache = self.app.extensions["users"]
+        stale_version, data = cache.get("user:{}".format(self.users[0].id))
+        self.assertIsNone(data["about_me"])
+        cache.delete("user-version:{}".format(self.users[0].id))
+        # the session knows better
+        self.assertIn(b"new bio", self.client.get("/edit_profile").data)
+        version, data = cache.get("user:{}".format(self.users[0].id))
+        self.assertGreater(version, stale_version)
+        self.assertEqual(data["about_me"], "new bio")
+
+    def test_explore_conditional_get(self):
+        response = self.client.get("/explore")
+        etag = response.headers["ETag"]
+        self.assertIn("Last-Modified", response.headers)
+
+        with QueryCounter(db.engine) as counter:
+            response = self.client.get("/explore", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b"")
+        # only the session user and the newest post are looked up
+        self.assertLessEqual(counter.count, 2)
+
+        # a new post changes the page
+        db.session.add(Post(body="new post", author=self.users[0]))
+        db.session.commit()
+        response = self.client.get("/explore", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"new post", response.data)
+        self.assertNotEqual(response.headers["ETag"], etag)
+
+        # and so does renaming an author, for validators and the cached page
+        etag = response.headers["ETag"]
+        last_modified = response.headers["Last-Modified"]
+        self.client.post("/edit_profile", data={"username": "renamed", "about_me": ""})
+        response = self.client.get("/explore", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"<a href=/user/renamed>", response.data)
+        self.assertNotEqual(response.headers["ETag"], etag)
+        # a mismatched ETag wins over a matching date
+        response = self.client.get("/explore", headers={
+            "If-None-Match": etag, "If-Modified-Since": response.headers["Last-Modified"]})
+        self.assertEqual(response.status_code, 200)
+
+    def test_search(self):
+        db.session.add_all([
+            Post(body="kittens kittens kittens", author=self.users[1]),
+            Post(body="kittens and puppies", author=self.users[2]),
+            Post(body="Pisicuțe", author=self.users[3]),
+        ])
+        db.session.commit()
+
+        page = search.page("kittens", 10)
+        self.assertEqual([p.body for p in page.items],
+                         ["kittens kittens kittens", "kittens and puppies"])
+        self.assertEqual([p.body for p in search.page("puppies KITTENS", 10).items],
+                         ["kittens and puppies"])
+        self.assertEqual(search.page("pisicute", 10).items[0].body, "Pisicuțe")
+        # never read as FTS operators
+        self.assertEqual(search.page('"NEAR( OR', 10).items, [])
+        self.assertEqual(search.page("", 10).items, [])
+
+        # paginated by (score, id) cursor, every post says "post from"
+        per_page = self.app.config["POSTS_PER_PAGE"]
+        first = search.page("post from", per_page)
+        self.assertTrue(first.has_next)
+        second = search.page("post from", per_page, before=first.next_cursor)
+        self.assertEqual(len(first.items) + len(second.items), len(self.users))
+        self.assertFalse(set(first.items) & set(second.items))
+        self.assertEqual(search.page("post from", per_page, after=second.prev_cursor).items,
+                         first.items)
+
+        response = self.assertQueryBudget("/search?q=post+from")
+        self.assertIn(b"/search?q=post+from&amp;before=", response.data)
+
+        # deleted posts leave the index, a rebuild gives the same results
+        db.session.delete(page.items[0])
+        db.session.commit()
+        search.reindex()
+        self.assertEqual([p.body for p in search.page("kittens", 10).items],
+                         ["kittens and puppies"])
+
+    def test_password_rehash_on_login(self):
+        self.client.get("/logout")
+        old_hash = self.users[1].password_hash
+        self.app.config["PASSWORD_HASH_METHOD"] = "pbkdf2:sha512:2000"
+        self.app.config["PASSWORD_SALT_LENGTH"] = 20
+        self.assertTrue(self.users[1].password_needs_rehash())
+
+        # a failed login changes nothing
+        self.client.post("/login", data={"username": "user1", "password": "dog"})
+        db.session.expire_all()
+        self.assertEqual(self.users[1].password_hash, old_hash)
+
+        response = self.client.post("/login", data={"username": "user1", "password": "cat"})
+        self.assertEqual(response.status_code, 302)
+        self.assertIn("/index", response.headers["Location"])
+        db.session.expire_all()
+        self.assertTrue(self.users[1].password_hash.startswith("pbkdf2:sha512:2000$"))
+        self.assertFalse(self.users[1].password_needs_rehash())
+        self.assertTrue(self.users[1].check_password("cat"))
+
+    def test_login_rate_limits(self):
+        self.client.get("/logout")
+        self.app.config["RATELIMITS"] = dict(self.app.config["RATELIMITS"],
+                **{"login-ip": "6/minute", "login-account": "3/minute"})
+        for _ in range(3):
+            response = self.client.post("/login", data={"username": "User1", "password": "dog"})
+            self.assertEqual(response.status_code, 302)
+        # the account is locked, whatever the password
+        response = self.client.post("/login", data={"username": "user1", "password": "cat"})
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response.headers["Retry-After"]), 0)
+
+        # other accounts only count against the address
+        for _ in range(2):
+            response = self.client.post("/login", data={"username": "user2", "password": "cat"})
+            self.assertEqual(response.status_code, 302)
+            self.client.get("/logout")
+        response = self.client.post("/login", data={"username": "user3", "password": "cat"})
+        self.assertEqual(response.status_code, 429)
+        # the form itself is never limited
+        self.assertEqual(self.client.get("/login").status_code, 200)
+
+    def test_data_export(self):
+        with mock.patch.object(export, "CHUNK_SIZE", 100):
+            response = self.client.get("/export")
+            self.assertEqual(response.mimetype, "application/gzip")
+            self.assertIn("microblog-user0.jsonl.gz", response.headers["Content-Disposition"])
+            self.assertTrue(response.is_streamed)
+            chunks = list(response.response)
+        self.assertGreater(len(chunks), 1)
+        records = [json.loads(line) for line in gzip.decompress(b"".join(chunks)).splitlines()]
+        self.assertEqual(records[0]["username"], "user0")
+        self.assertNotIn("password_hash", records[0])
+        types = [record["type"] for record in records]
+        # user0 follows everyone else, nobody follows user0, and has a single post
+        self.assertEqual(types.count("follow"), len(self.users) - 1)
+        self.assertEqual(types.count("follower"), 0)
+        self.assertEqual([record["body"] for record in records if record["type"] == "post"],
+                         ["post from user0"])
+
+    def test_emails_are_queued(self):
+        self.client.get("/logout")
+        with mail.record_messages() as outbox:
+            response = self.client.post("/reset_password_request",
+                    data={"email": "user1@example.com"})
+            self.assertEqual(response.status_code, 302)
+            # the request only enqueued the message
+            self.assertEqual(outbox, [])
+            self.assertEqual(jobs.store.counts(), {"queued": 1})
+
+            jobs.work(concurrency=2, burst=True)
+        self.assertEqual(len(outbox), 1)
+        self.assertEqual(outbox[0].recipients, ["user1@example.com"])
+        self.assertEqual(jobs.store.counts(), {})
+
+    def upload_chunks(self, data, filename, chunk_size, upload_id):
+        chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)]
+        # out of order, like a retried chunk would arrive
+        for index in reversed(range(len(chunks))):
+            response = self.client.post("/upload", data={
+                "file": (io.BytesIO(chunks[index]), filename),
+                "dzuuid": upload_id,
+                "dzchunkindex": index,
+                "dztotalchunkcount": len(chunks),
+                "dzchunkbyteoffset": index * chunk_size,
+                "dztotalfilesize": len(data),
+            }, content_type="multipart/form-data")
+        return response
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_chunked_upload(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config["UPLOAD_FOLDER"] = directory
+            image = Image.new("RGB", (300, 200), "red")
+            exif = Image.Exif()
+            exif[0x010e] = "secret description"
+            data = io.BytesIO()
+            image.save(data, "JPEG", exif=exif)
+            data = data.getvalue()
+
+            upload_id = "0b1f4a8e-5a4c-4d4e-9a53-1d2f1c0e7f10"
+            response = self.upload_chunks(data, "photo.jpg", 1000, upload_id)
+            self.assertEqual(response.get_json(), {"id": upload_id, "status": "processing"})
+            self.assertEqual(jobs.store.counts(), {"queued": 1})
+
+            jobs.work(burst=True)
+            upload = Upload.query.get(upload_id)
+            self.assertEqual(upload.status, "ready")
+            self.assertEqual(upload.size, len(data))
+            with Image.open(os.path.join(directory, "images", upload_id + ".jpg")) as stored:
+                self.assertEqual(stored.size, (300, 200))
+                self.assertNotIn("exif", stored.info)
+            with Image.open(os.path.join(directory, "images", upload_id + "_64.jpg")) as thumb:
+                self.assertEqual(thumb.size, (64, 43))
+
+    def test_upload_finished_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config["UPLOAD_FOLDER"] = directory
+            upload_id = "3c2a1d9e-7b6f-4e1a-8c3d-2f5e6a7b8c90"
+            response = self.upload_chunks(b"x" * 2500, "photo.png", 1000, upload_id)
+            self.assertEqual(response.get_json()["status"], "processing")
+
+            # the other of two last chunks arriving together
+            upload = Upload.query.get(upload_id)
+            incoming = os.path.join(directory, "incoming")
+            finish_upload(upload, os.path.join(incoming, upload_id + ".part"),
+                          os.path.join(incoming, upload_id + ".chunks"))
+            self.assertEqual(upload.status, "processing")
+            self.assertEqual(upload.size, 2500)
+            self.assertEqual(jobs.store.counts(), {"queued": 1})
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_decompression_bomb(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config["UPLOAD_FOLDER"] = directory
+            data = io.BytesIO()
+            Image.new("RGB", (300, 200), "red").save(data, "PNG")
+            response = self.client.post("/upload", data={
+                "file": (io.BytesIO(data.getvalue()), "bomb.png"),
+            }, content_type="multipart/form-data")
+            with mock.patch.object(Image, "MAX_IMAGE_PIXELS", 100):
+                jobs.work(burst=True)
+            upload = Upload.query.get(response.get_json()["id"])
+            self.assertEqual(upload.status, "failed")
+            self.assertEqual(jobs.store.counts(), {})
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_upload_saved_as_its_extension(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config["UPLOAD_FOLDER"] = directory
+            data = io.BytesIO()
+            Image.new("RGBA", (300, 200), "red").save(data, "PNG")
+            response = self.client.post("/upload", data={
+                "file": (io.BytesIO(data.getvalue()), "photo.jpg"),
+            }, content_type="multipart/form-data")
+            jobs.work(burst=True)
+            upload = Upload.query.get(response.get_json()["id"])
+            self.assertEqual(upload.status, "ready")
+            with Image.open(image_path(upload)) as image:
+                self.assertEqual(image.format, "JPEG")
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_upload_save_failure(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config["UPLOAD_FOLDER"] = directory
+            data = io.BytesIO()
+            Image.new("RGB", (300, 200), "red").save(data, "PNG")
+            response = self.client.post("/upload", data={
+                "file": (io.BytesIO(data.getvalue()), "photo.png"),
+            }, content_type="multipart/form-data")
+            save = Image.Image.save
+            def full_disk(image, fp, *args, **kwargs):
+                save(image, fp, *args, **kwargs)
+                if "_" in os.path.basename(fp):
+                    raise OSError("No space left on device")
+            with mock.patch.object(Image.Image, "save", full_disk):
+                jobs.work(burst=True)
+            upload = Upload.query.get(response.get_json()["id"])
+            self.assertEqual(upload.status, "failed")
+            self.assertEqual(jobs.store.counts(), {})
+            self.assertEqual(os.listdir(os.path.join(directory, "images")), [])
+            self.assertEqual(os.listdir(os.path.join(directory, "incoming")), [])
+
+    def test_expire_uploads(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config["UPLOAD_FOLDER"] = directory
+            incoming = os.path.join(directory, "incoming")
+            os.makedirs(incoming)
+            old = datetime.utcnow() - timedelta(days=2)
+            uploads = [Upload(id=str(uuid.uuid4()), user_id=self.users[0].id, filename="a.png",
+                              status="receiving", timestamp=timestamp)
+                       for timestamp in (old, old, datetime.utcnow())]
+            db.session.add_all(uploads)
+            db.session.commit()
+            orphan = str(uuid.uuid4())
+            for upload_id in [upload.id for upload in uploads] + [orphan]:
+                for ext in (".part", ".chunks"):
+                    with open(os.path.join(incoming, upload_id + ext), "w") as f:
+                        f.write("0\n")
+            # the second one still receives chunks
+            for upload_id in (uploads[0].id, orphan):
+                for ext in (".part", ".chunks"):
+                    os.utime(os.path.join(incoming, upload_id + ext), (0, 0))
+
+            jobs.enqueue("expire_uploads", {})
+            self.assertEqual(jobs.run_batch(), 1)
+            db.session.expire_all()
+            self.assertEqual([upload.status for upload in uploads],
+                             ["expired", "receiving", "receiving"])
+            self.assertEqual(sorted(os.listdir(incoming)), sorted(
+                upload.id + ext for upload in uploads[1:] for ext in (".chunks", ".part")))
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_image_derivatives(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config["UPLOAD_FOLDER"] = directory
+            self.app.config["DERIVATIVES_DIR"] = os.path.join(directory, "derivatives")
+            upload = Upload(id="5d0c7c1e-2f4b-4c55-8c0e-0a3b9d6f2e11", user_id=self.users[0].id,
+                            filename="photo.png", status="ready")
+            Image.new("RGB", (300, 200), "blue").save(image_path(upload))
+            upload.digest = file_digest(image_path(upload))
+            db.session.add(upload)
+            db.session.commit()
+
+            url = "/media/d/{}/128.png".format(upload.digest)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn("immutable", response.headers["Cache-Control"])
+            with Image.open(io.BytesIO(response.data)) as resized:
+                self.assertEqual(resized.size, (128, 85))
+            response.close()
+            path = os.path.join(directory, "derivatives", upload.digest, "128.png")
+            self.assertTrue(os.path.exists(path))
+
+            # handed to nginx when it's in front
+            self.app.config["DERIVATIVES_ACCEL_REDIRECT"] = "/_media/d"
+            response = self.client.get(url)
+            self.assertEqual(response.headers["X-Accel-Redirect"],
+                             "/_media/d/{}/128.png".format(upload.digest))
+            self.assertEqual(response.data, b"")
+
+            self.assertEqual(self.client.get(url.replace("/128.", "/100.")).status_code, 404)
+            self.assertEqual(self.client.get(url.replace(".png", ".jpg")).status_code, 404)
+
+            # the least recently used file goes first, in the periodic job
+            self.client.get(url.replace("/128.", "/64."))
+            os.utime(path, (0, 0))
+            self.app.config["DERIVATIVES_MAX_BYTES"] = os.path.getsize(path)
+            self.assertTrue(os.path.exists(path))
+            jobs.enqueue("prune_derivatives", {})
+            self.assertEqual(jobs.run_batch(), 1)
+            self.assertFalse(os.path.exists(path))
+            self.assertTrue(os.path.exists(path.replace("128.png", "64.png")))
+
+    def test_avatar_cache(self):
+        class StubFetcher(object):
+            def __init__(self):
+                self.calls = []
+
+            def fetch(self, digest, size):
+                self.calls.append((digest, size))
+                if fail:
+                    raise OSError("offline")
+                return "image/png", b"png " + digest.encode()
+
+        fetcher = StubFetcher()
+        self.app.extensions["avatars"] = fetcher
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config["AVATAR_DIR"] = directory
+            user, other_user = self.users[1:3]
+            digest = avatar_digest(user.id, user.email)
+            fail = False
+            for _ in range(2):
+                response = self.client.get("/avatar/{}/{}/64".format(user.id, digest))
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.mimetype, "image/png")
+                self.assertEqual(response.data, b"png " + digest.encode())
+                self.assertEqual(response.cache_control.max_age, self.app.config["AVATAR_MAX_AGE"])
+                response.close()
+            # fetched once
+            self.assertEqual(fetcher.calls, [(digest, 64)])
+
+            # offline, an identicon is served and the fetch is retried later
+            fail = True
+            other = "/avatar/{}/{}/24".format(other_user.id,
+                                              avatar_digest(other_user.id, other_user.email))
+            response = self.client.get(other)
+            self.assertEqual(response.mimetype, "image/svg+xml")
+            self.assertEqual(response.cache_control.max_age, self.app.config["AVATAR_RETRY"])
+            response.close()
+            self.app.config["AVATAR_RETRY"] = -1
+            fail = False
+            response = self.client.get(other)
+            self.assertEqual(response.mimetype, "image/png")
+            response.close()
+            self.assertEqual(len(fetcher.calls), 3)
+
+            # only the sizes in use, of the digests of existing users
+            for url in ["/avatar/{}/{}/128".format(user.id, digest),
+                        "/avatar/{}/{}/64".format(user.id, "0" * 32),
+                        "/avatar/{}/{}/64".format(other_user.id, digest),
+                        "/avatar/{}/{}/64".format(9999, digest),
+                        "/avatar/{}/..%2F..%2Fetc/64".format(user.id)]:
+                self.assertEqual(self.client.get(url).status_code, 404)
+            self.assertEqual(len(fetcher.calls), 3)
+
+            # bounded by the periodic job
+            self.app.config["AVATAR_MAX_BYTES"] = 1
+            jobs.enqueue("prune_avatars", {})
+            self.assertEqual(jobs.run_batch(), 1)
+            self.assertEqual([names for _, _, names in os.walk(directory) if names], [])
+
+    def test_upload_limits(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config["UPLOAD_FOLDER"] = directory
+            response = self.client.post("/upload", data={
+                "file": (io.BytesIO(b"x" * 10), "huge.png"),
+                "dztotalfilesize": self.app.config["UPLOAD_MAX_SIZE"] + 1,
+            }, content_type="multipart/form-data")
+            self.assertEqual(response.status_code, 413)
+
+            response = self.client.post("/upload", data={
+                "file": (io.BytesIO(b"#!/bin/sh"), "script.sh"),
+            }, content_type="multipart/form-data")
+            self.assertEqual(response.status_code, 400)
+
+            # garbage with an image extension is rejected by the worker
+            response = self.client.post("/upload", data={
+                "file": (io.BytesIO(b"not an image"), "fake.png"),
+            }, content_type="multipart/form-data")
+            upload = Upload.query.get(response.get_json()["id"])
+            if Image is not None:
+                jobs.work(burst=True)
+                db.session.refresh(upload)
+                self.assertEqual(upload.status, "rejected")
+
+@jobs.task("flaky")
+def flaky_task(payload):
+    if payload["fail"]:
+        raise RuntimeError("flaky")
+
+class JobQueueCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app.config["JOBS_RETRY_BASE"] = 0
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+
+    def test_retry_and_give_up(self):
+        jobs.enqueue("flaky", {"fail": True})
+        jobs.enqueue("flaky", {"fail": False})
+        self.assertEqual(jobs.run_batch(), 2)
+        self.assertEqual(jobs.store.counts(), {"queued": 1})
+
+        for attempt in range(self.app.config["JOBS_MAX_ATTEMPTS"] - 1):
+            self.assertEqual(jobs.run_batch(), 1)
+        self.assertEqual(jobs.run_batch(), 0)
+        self.assertEqual(jobs.store.counts(), {"failed": 1})
+
+    def test_connection_per_process(self):
+        # Nothing is opened by create_app, forked workers open their own
+        store = JobStore(":memory:", 60)
+        self.assertIsNone(store.connection)
+        store.enqueue("flaky", {"fail": False})
+        parent = store.connection
+        with mock.patch("os.getpid", return_value=os.getpid() + 1):
+            self.assertEqual(store.counts(), {})
+            self.assertIsNot(store.connection, parent)
+
+    def test_periodic(self):
+        jobs.schedule()
+        jobs.schedule()
+        queued = jobs.store.counts()["queued"]
+        self.assertEqual(queued, len(jobs.periodic))
+        self.assertIn("prune_avatars", jobs.periodic)
+        # not due yet
+        self.assertEqual(jobs.run_batch(), 0)
+
+    def test_backoff(self):
+        self.app.config["JOBS_RETRY_BASE"] = 10
+        self.assertGreaterEqual(jobs.backoff(3), 40)
+        self.assertLessEqual(jobs.backoff(3), 44)
+        self.assertIsNone(jobs.backoff(self.app.config["JOBS_MAX_ATTEMPTS"]))
+
+    def test_unknown_task(self):
+        with self.assertRaises(ValueError):
+            jobs.enqueue("missing", {})
+
+class DatabaseCase(unittest.TestCase):
+    def options(self, **config):
+        config = dict(vars(Config), **config)
+        return engine_options(config)
+
+    def test_engine_options(self):
+        self.assertEqual(self.options(SQLALCHEMY_DATABASE_URI="sqlite://"), {})
+        options = self.options(SQLALCHEMY_DATABASE_URI="postgresql://u@db/microblog",
+                               DATABASE_POOL_SIZE=8, DATABASE_STATEMENT_TIMEOUT=5000)
+        self.assertEqual(options["pool_size"], 8)
+        self.assertTrue(options["pool_pre_ping"])
+        self.assertEqual(options["connect_args"], {"options": "-c statement_timeout=5000"})
+        # PgBouncer pools, and refuses startup parameters
+        options = self.options(SQLALCHEMY_DATABASE_URI="postgresql://u@db/microblog",
+                               DATABASE_PGBOUNCER=True)
+        self.assertEqual(options, {"poolclass": NullPool})
+
+    def test_connections_stay_in_their_process(self):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine("sqlite:///" + os.path.join(directory, "pool.db"),
+                                   poolclass=QueuePool)
+            with engine.connect() as connection:
+                first = connection.connection.dbapi_connection
+            with engine.connect() as connection:
+                self.assertIs(connection.connection.dbapi_connection, first)
+                # as if the pool had been inherited through fork()
+                connection.connection._connection_record.info["pid"] = -1
+            with engine.connect() as connection:
+                self.assertIsNot(connection.connection.dbapi_connection, first)
+            engine.dispose()
+
+class ReplicaCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.primary = os.path.join(self.directory, "primary.db")
+        self.replica = os.path.join(self.directory, "replica.db")
+
+        class ReplicaConfig(RoutesConfig):
+            SQLALCHEMY_DATABASE_URI = "sqlite:///" + self.primary
+            DATABASE_REPLICA_URLS = ["sqlite:///" + self.replica]
+
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        for name in ["john", "susan"]:
+            user = User(username=name, email=name + "@example.com")
+            user.set_password("cat")
+            db.session.add(user)
+        db.session.commit()
+        self.replicate()
+
+        self.client = self.app.test_client()
+        self.client.post("/login", data={"username": "john", "password": "cat"})
+
+    def tearDown(self):
+        db.session.remove()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def replicate(self):
+        db.session.remove()
+        shutil.copy(self.primary, self.replica)
+
+    def test_reads_from_replica(self):
+        db.session.add(User(username="mary", email="mary@example.com"))
+        db.session.commit()
+        db.session.remove()
+        # not replicated yet
+        self.assertEqual(self.client.get("/user/mary").status_code, 404)
+        self.replicate()
+        self.assertEqual(self.client.get("/user/mary").status_code, 200)
+
+    def test_reads_own_writes(self):
+        self.client.post("/edit_profile", data={"username": "john", "about_me": "fresh bio"})
+        # written to the primary only
+        primary = db.get_engine(self.app)
+        self.assertEqual(primary.execute("SELECT about_me FROM user WHERE username = 'john'")
+                         .scalar(), "fresh bio")
+        self.assertIn(b"fresh bio", self.client.get("/user/john").data)
+
+        # other users read from the lagging replica
+        other = self.app.test_client()
+        other.post("/login", data={"username": "susan", "password": "cat"})
+        self.assertNotIn(b"fresh bio", other.get("/user/john").data)
+        self.replicate()
+        self.assertIn(b"fresh bio", other.get("/user/john").data)
+
+    def test_user_cache_reads_primary(self):
+        john = User.query.filter_by(username="john").first()
+        john.about_me = "fresh bio"
+        db.session.commit()
+        user_cache.invalidate(john)
+        db.session.remove()
+
+        # filled from the primary, the replica still has the old profile
+        self.assertEqual(user_cache.load(User, john.id).about_me, "fresh bio")
+        db.session.remove()
+        self.assertEqual(user_cache.load(User, john.id).about_me, "fresh bio")
+
+    @unittest.skipIf(Image is None, "Pillow is not installed")
+    def test_jobs_read_primary(self):
+        self.app.config["UPLOAD_FOLDER"] = self.directory
+        john = User.query.filter_by(username="john").first()
+        upload_id = str(uuid.uuid4())
+        upload = Upload(id=upload_id, user_id=john.id, filename="fake.png",
+                        status="processing")
+        with open(incoming_path(upload), "wb") as f:
+            f.write(b"not an image")
+        db.session.add(upload)
+        db.session.commit()
+        jobs.enqueue("process_upload", {"id": upload_id})
+
+        # the replica has no such upload yet
+        self.assertEqual(jobs.run_batch(), 1)
+        primary = db.get_engine(self.app)
+        self.assertEqual(primary.execute("SELECT status FROM upload").scalar(), "rejected")
+
+    def test_bulk_finish_reads_primary(self):
+        john = User.query.filter_by(username="john").first()
+        susan = User.query.filter_by(username="susan").first()
+        john_id, susan_id = john.id, susan.id
+        john.follow(susan)
+        db.session.commit()
+        db.session.remove()
+
+        posts = os.path.join(self.directory, "posts.jsonl")
+        with open(posts, "w") as f:
+            f.write(json.dumps({"username": "susan", "body": "hello"}))
+        loader = bulk.Loader()
+        list(loader.load("posts", bulk.read_records(posts)))
+        # john follows susan on the primary only
+        self.assertEqual(loader.timeline_owners(), {john_id, susan_id})
+        bulk.finish(loader)
+        primary = db.get_engine(self.app)
+        self.assertEqual(primary.execute(
+            "SELECT count(*) FROM timeline_entry JOIN user ON user.id = user_id "
+            "WHERE username = 'john'").scalar(), 1)
+
+class InstrumentationConfig(RoutesConfig):
+    INSTRUMENTATION_ENABLED = True
+    ADMINS = ["john@example.com"]
+    METRICS_TOKEN = "scraper-token"
+
+class InstrumentationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(InstrumentationConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        for name in ["john", "susan"]:
+            user = User(username=name, email=name + "@example.com")
+            user.set_password("cat")
+            db.session.add(user)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def login(self, username):
+        client = self.app.test_client()
+        client.post("/login", data={"username": username, "password": "cat"})
+        return client
+
+    def test_request_metrics(self):
+        client = self.login("susan")
+        with self.assertLogs("app.requests", "INFO") as logs:
+            response = client.get("/user/john")
+        timing = response.headers["Server-Timing"]
+        self.assertRegex(timing, r'^app;dur=[0-9.]+, db;dur=[0-9.]+;desc="\d+ queries", tpl;dur=[0-9.]+$')
+
+        line = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((line["endpoint"], line["status"]), ("main.user", 200))
+        self.assertGreater(line["sql_count"], 0)
+        self.assertGreater(line["template_ms"], 0)
+        self.assertLessEqual(len(line["slowest"]), self.app.config["INSTRUMENTATION_SLOWEST"])
+        self.assertIn("SELECT", line["slowest"][0]["sql"])
+
+    def test_metrics_route(self):
+        self.login("susan").get("/index")
+        # admins and the scraper only, susan logs in twice
+        self.assertEqual(self.login("susan").get("/metrics").status_code, 404)
+        self.assertEqual(self.app.test_client().get(
+            "/metrics", headers={"Authorization": "Bearer wrong"}).status_code, 404)
+        response = self.app.test_client().get(
+            "/metrics", headers={"Authorization": "Bearer scraper-token"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.login("john").get("/metrics").status_code, 200)
+
+        text = response.get_data(as_text=True)
+        self.assertIn("# TYPE microblog_request_duration_seconds histogram", text)
+        self.assertIn('microblog_request_duration_seconds_bucket{endpoint="main.index",le="+Inf"} 1', text)
+        self.assertIn('microblog_request_duration_seconds_count{endpoint="auth.login"} 2', text)
+        self.assertRegex(text, r'microblog_request_sql_queries_total\{endpoint="main.index"\} [1-9]')
+
+class SlowQueryCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        class SlowQueryConfig(RoutesConfig):
+            # a file, the plans are fetched on another connection
+            SQLALCHEMY_DATABASE_URI = "sqlite:///" + os.path.join(self.directory, "app.db")
+            SLOW_QUERY_THRESHOLD_MS = 0.000001
+            SLOW_QUERY_LOG = os.path.join(self.directory, "slow_queries.log")
+            PROFILER_TOKEN = "profile-me"
+            PROFILER_INTERVAL_MS = 1
+            PROFILER_DIR = os.path.join(self.directory, "profiles")
+            PROFILER_MAX_FILES = 2
+
+        self.app = create_app(SlowQueryConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        user = User(username="john", email="john@example.com")
+        user.set_password("cat")
+        db.session.add(user)
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.client.post("/login", data={"username": "john", "password": "cat"})
+
+    def tearDown(self):
+        db.session.remove()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def test_slow_query_plans(self):
+        self.client.get("/user/john")
+        slow_queries.flush()
+        with open(self.app.config["SLOW_QUERY_LOG"]) as f:
+            entries = [json.loads(line) for line in f]
+        entry = [entry for entry in entries if entry["endpoint"] == "main.user"
+                 and "FROM post" in entry["sql"]][0]
+        self.assertIn("'john'", json.dumps(entries))
+        self.assertTrue(entry["plan"])
+        # writes are logged without a plan
+        self.assertTrue(any(entry["sql"].startswith("INSERT") and "plan" not in entry
+                            for entry in entries))
+
+    def test_profiler(self):
+        directory = self.app.config["PROFILER_DIR"]
+        self.client.get("/index")
+        self.assertFalse(os.path.exists(directory))
+
+        for _ in range(3):
+            self.client.get("/index", headers={"X-Profile": "profile-me"})
+            time.sleep(0.01)
+        profiles = os.listdir(directory)
+        # the oldest went over the limit
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue(all(name.endswith("-main.index-{}.folded".format(os.getpid()))
+                            for name in profiles))
+        with open(os.path.join(directory, profiles[0])) as f:
+            stack, count = f.readline().rsplit(" ", 1)
+        self.assertGreater(int(count), 0)
+        self.assertIn("wsgi_app (flask/app.py:", stack)
+
+class RecordingHandler(logging.Handler):
+    def __init__(self, delay=0):
+        logging.Handler.__init__(self)
+        self.delay = delay
+        self.records = []
+
+    def emit(self, record):
+        time.sleep(self.delay)
+        self.records.append(record)
+
+class RecordingSMTPHandler(DigestSMTPHandler):
+    def __init__(self, **kwargs):
+        DigestSMTPHandler.__init__(self, "localhost", "app@example.com", ["admin@example.com"],
+                                   "Failure", **kwargs)
+        self.mails = []
+
+    def send(self, record):
+        self.mails.append((self.getSubject(record), self.format(record)))
+
+class LoggingCase(unittest.TestCase):
+    def logger(self, handler):
+        logger = logging.Logger("test")
+        logger.addHandler(handler)
+        return logger
+
+    def test_async_handler(self):
+        target = RecordingHandler(delay=0.01)
+        handler = AsyncHandler([target], max_size=3)
+        logger = self.logger(handler)
+        start = time.perf_counter()
+        for i in range(10):
+            logger.error("error %d", i)
+        # never waits for the slow handler
+        self.assertLess(time.perf_counter() - start, 0.05)
+        handler.flush()
+        self.assertLess(len(target.records), 10)
+        self.assertEqual(target.records[0].getMessage(), "error 0")
+
+        logger.error("after")
+        handler.close()
+        messages = [record.getMessage() for record in target.records]
+        self.assertRegex(messages[-2], r"^\d+ log records dropped")
+        self.assertEqual(messages[-1], "after")
+
+    def test_mail_digest(self):
+        handler = RecordingSMTPHandler(interval=60, max_records=2)
+        logger = self.logger(handler)
+        for i in range(5):
+            logger.error("error %d", i)
+        # the first is sent at once, the others wait for the digest
+        self.assertEqual(handler.mails, [("Failure", "error 0")])
+        handler.close()
+        self.assertEqual(len(handler.mails), 2)
+        subject, body = handler.mails[1]
+        self.assertEqual(subject, "Failure (4 errors)")
+        self.assertTrue(body.startswith("4 errors since the previous mail, 2 of them left out"))
+        self.assertIn("error 2", body)
+        self.assertNotIn("error 3", body)
+
+class BulkCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def test_parse_timestamp(self):
+        expected = datetime(2021, 1, 1, 12, 30)
+        for value in ["2021-01-01T12:30:00", "2021-01-01T12:30:00Z",
+                      "2021-01-01T14:30:00+02:00", "2021-01-01T07:30:00-05:00"]:
+            self.assertEqual(bulk.parse_timestamp(value), expected)
+        self.assertIsNone(bulk.parse_timestamp(""))
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    def test_import(self):
+        users = self.write("users.jsonl", "\n".join(json.dumps(record) for record in [
+            {"username": "john", "email": "john@example.com", "password": "cat"},
+            {"username": "susan", "email": "susan@example.com", "about_me": "hi"},
+            {"username": "john", "email": "other@example.com"},
+            {"username": "nomail"},
+        ]))
+        follows = self.write("follows.csv", "follower,followed\n"
+                             "john,susan\njohn,susan\nsusan,mary\n")
+        posts = self.write("posts.jsonl", "\n".join(json.dumps(record) for record in [
+            {"username": "susan", "body": "first post", "timestamp": "2021-01-01T00:00:00"},
+            {"username": "susan", "body": "second post", "timestamp": "2021-01-02T00:00:00Z"},
+            {"username": "mary", "body": "unknown author"},
+        ]))
+
+        loader = bulk.Loader(batch_size=2, hash_processes=1)
+        progress = [list(loader.load("users", bulk.read_records(users))),
+                    list(loader.load("follows", bulk.read_records(follows)))]
+        self.assertEqual([step[:2] for step in progress[0]], [(2, 0), (4, 1)])
+        self.assertEqual(progress[1][-1][:2], (3, 2))
+
+        # a failed run committed the first post
+        bulk.Progress(posts + ".progress").save(1)
+        db.session.add(Post(body="first post", author=User.query.filter_by(username="susan").one(),
+                            timestamp=datetime(2021, 1, 1)))
+        db.session.commit()
+        list(loader.load("posts", bulk.read_records(posts), bulk.Progress(posts + ".progress"),
+                         resume=True))
+        self.assertFalse(os.path.exists(posts + ".progress"))
+
+        bulk.drop_indexes()
+        bulk.finish(loader)
+        john = User.query.filter_by(username="john").one()
+        susan = User.query.filter_by(username="susan").one()
+        self.assertEqual(User.query.count(), 2)
+        self.assertEqual(john.email, "john@example.com")
+        self.assertTrue(john.check_password("cat"))
+        self.assertFalse(susan.check_password("cat"))
+        self.assertEqual((susan.followers_count, susan.posts_count), (1, 2))
+        self.assertEqual([post.body for post in timeline.page(john, 10).items],
+                         ["second post", "first post"])
+        self.assertEqual([post.body for post in search.page("second", 10).items], ["second post"])
+        self.assertEqual(len(inspect(db.engine).get_indexes("post")), 3)
+
+    def test_finish_scope(self):
+        bystander = User(username="mary", email="mary@example.com")
+        db.session.add(bystander)
+        db.session.commit()
+        db.session.execute(User.__table__.update().values(posts_count=7))
+        db.session.commit()
+
+        users = self.write("users.jsonl", json.dumps({"username": "john", "email": "j@example.com"}))
+        posts = self.write("posts.jsonl", json.dumps({"username": "john", "body": "hello"}))
+        loader = bulk.Loader(hash_processes=1)
+        list(loader.load("users", bulk.read_records(users)))
+        list(loader.load("posts", bulk.read_records(posts)))
+        # searchable as soon as the batch is committed
+        self.assertEqual([post.body for post in search.page("hello", 10).items], ["hello"])
+
+        # only the users of the load
+        bulk.finish(loader)
+        counts = dict(db.session.query(User.username, User.posts_count))
+        self.assertEqual(counts, {"john": 1, "mary": 7})
+        bulk.finish(loader, full=True)
+        counts = dict(db.session.query(User.username, User.posts_count))
+        self.assertEqual(counts, {"john": 1, "mary": 0})
+
+    def test_failed_import_restores_indexes(self):
+        posts = self.write("posts.jsonl", json.dumps({"username": "john", "body": "hello"}))
+        cli.register(self.app)
+        with mock.patch.object(bulk.Loader, "_posts", side_effect=RuntimeError("lost connection")):
+            result = self.app.test_cli_runner().invoke(
+                args=["data", "import", "--posts", posts, "--defer-indexes"])
+        self.assertIsInstance(result.exception, RuntimeError)
+        self.assertEqual(len(inspect(db.engine).get_indexes("post")), 3)
+
+    def test_export_round_trip(self):
+        records = bulk.seed_records(20, 100, 5, "cat", seed=2)
+        loader = bulk.Loader(batch_size=30)
+        for kind in bulk.KINDS:
+            list(loader.load(kind, records[kind]))
+        paths = dict((kind, os.path.join(self.directory, kind + ".jsonl.gz"))
+                     for kind in bulk.KINDS)
+        self.assertEqual([export.write(kind, paths[kind]) for kind in bulk.KINDS],
+                         [20, db.session.query(followers).count(), 100])
+        with gzip.open(paths["posts"], "rt") as f:
+            exported = f.read()
+
+        # the export imports back
+        db.drop_all()
+        db.create_all()
+        for kind in bulk.KINDS:
+            with gzip.open(paths[kind], "rt") as f:
+                list(loader.load(kind, (json.loads(line) for line in f)))
+        export.write("posts", os.path.join(self.directory, "again.jsonl"))
+        with open(os.path.join(self.directory, "again.jsonl")) as f:
+            self.assertEqual(f.read(), exported)
+
+    def test_seed(self):
+        records = bulk.seed_records(50, 200, 5, "cat", seed=1)
+        loader = bulk.Loader(batch_size=100)
+        for kind in bulk.KINDS:
+            list(loader.load(kind, records[kind]))
+        bulk.finish(loader)
+        self.assertEqual((User.query.count(), Post.query.count()), (50, 200))
+        # popular users have most followers
+        counts = [user.followers_count for user in User.query.order_by(User.id)]
+        self.assertGreater(sum(counts[:5]), sum(counts[-25:]))
+        # the same seed makes the same data in every process, --resume relies on it
+        script = ("import json, sys\n"
+                  "from app import bulk, create_app\n"
+                  "from tests import TestConfig\n"
+                  "with create_app(TestConfig).app_context():\n"
+                  "    json.dump(list(bulk.seed_records(50, 0, 5, 'cat', seed=1)['follows']),"
+                  " sys.stdout)\n")
+        follows = [json.loads(subprocess.run(
+                       [sys.executable, "-c", script], check=True, stdout=subprocess.PIPE,
+                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                       env=dict(os.environ, PYTHONHASHSEED=hash_seed)).stdout)
+                   for hash_seed in ("1", "2")]
+        self.assertGreater(len(follows[0]), 0)
+        self.assertEqual(follows[0], follows[1])
+
+class RateLimitCase(unittest.TestCase):
+    def test_token_bucket(self):
+        rate, burst = parse_limit("3/minute")
+        self.assertEqual((rate, burst), (3 / 60.0, 3))
+        store = MemoryStore(max_entries=2)
+        self.assertEqual([store.consume("a", rate, burst)[0] for _ in range(4)],
+                         [True, True, True, False])
+        # a token is back after 20 seconds
+        tokens, last = store.buckets["a"]
+        allowed, _, retry_after = refill(tokens, last, last + 10, rate, burst, 1)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 10, places=2)
+        self.assertTrue(refill(tokens, last, last + 20, rate, burst, 1)[0])
+
+        # least recently used buckets go first
+        store.consume("b", rate, burst)
+        store.consume("c", rate, burst)
+        self.assertEqual(list(store.buckets), ["b", "c"])
+
+class CacheCase(unittest.TestCase):
+    def check_backend(self, cache):
+        self.assertIsNone(cache.get("missing"))
+        cache.set("a", {"value": 1})
+        cache.set("b", "two", ttl=0.01)
+        self.assertEqual(cache.get_many(["a", "missing"]), {"a": {"value": 1}})
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("b"))
+        cache.delete("a")
+        self.assertIsNone(cache.get("a"))
+
+    def test_memory_cache(self):
+        cache = MemoryCache(max_entries=2)
+        self.check_backend(cache)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        # b was the least recently used
+        self.assertEqual(cache.get_many(["a", "b", "c"]), {"a": 1, "c": 3})
+
+    def test_filesystem_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = FileSystemCache(directory, max_entries=10)
+            self.check_backend(cache)
+            for i in range(FileSystemCache.PRUNE_EVERY):
+                cache.set(str(i), i)
+            self.assertLessEqual(len(os.listdir(directory)), 10)
+
+    def test_auto_backend(self):
+        # shared by the workers under uWSGI, invalidations reach all of them
+        app = create_app(TestConfig)
+        self.assertIsInstance(make_cache(app, "fragments"), MemoryCache)
+        with mock.patch("app.cache.uwsgi", mock.Mock(numproc=4)):
+            self.assertIsInstance(make_cache(app, "fragments"), UwsgiCache)
+
+            # versions in a per-process cache never reach the other workers
+            app.config["CACHE_BACKEND"] = "memory"
+            self.assertIsInstance(make_cache(app, "pages"), MemoryCache)
+            with self.assertRaises(RuntimeError):
+                make_cache(app, "users", shared=True)
+
+class MemoryTimelineConfig(TestConfig):
+    TIMELINE_BACKEND = "memory"
+
+class MemoryTimelineCase(TimelineCase):
+    config_class = MemoryTimelineConfig
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)